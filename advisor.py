@@ -0,0 +1,252 @@
+"""
+    block size advisor: models the storage, padding and query cost of candidate
+    block sizes p on the real partkey volume distribution, before a build
+
+        python advisor.py data.csv [--p 2,4,8,16,32,64] [--q 1] [--objective balanced]
+        python advisor.py --store store/               # volumes of a built store
+        python advisor.py rows.npy --calibrate --json
+
+    the partkeys are counted with numpy (bincount for dense non-negative partkeys,
+    unique otherwise), then every candidate is evaluated on the histogram of the
+    volumes, so that the cost does not grow with the number of candidates. a .npy
+    input ((n, 2) rows or (n,) partkeys) is memory-mapped and skips csv parsing.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+
+CANDIDATES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+LABEL_BYTES = 48            # stored size of a pseudo-label (iv || one or two AES blocks)
+BLOCK_SECONDS = 5e-6        # per block of a query: label, storage lookup, masks
+VALUE_SECONDS = 1e-8        # per value of a block: copy and XOR
+DENSE_LIMIT = 1 << 26       # largest partkey counted with bincount
+
+
+def read_partkeys(path, chunk_size=10000000):
+    """
+        function to stream the partkey column of a dataset as int64 arrays
+        args:
+            path: (partkey, value) csv, or .npy of (n, 2) rows or (n,) partkeys
+            chunk_size: number of rows per array
+    """
+    if path.endswith(".npy"):
+        rows = np.load(path, mmap_mode="r")
+        keys = rows[:, 0] if rows.ndim == 2 else rows
+        for start in range(0, len(keys), chunk_size):
+            yield np.asarray(keys[start : start + chunk_size], dtype=np.int64)
+        return
+    import pandas as pd             # imported here, only csv input needs pandas
+    from ingest import has_header
+    reader = pd.read_csv(path, header=None, usecols=[0], skiprows=int(has_header(path)), chunksize=chunk_size, dtype=np.int64)
+    for chunk in reader:
+        yield chunk[0].to_numpy()
+
+
+def partkey_volumes(chunks, dense_limit=DENSE_LIMIT):
+    """
+        function to count the values of each distinct partkey
+        args:
+            chunks: iterable of int64 partkey arrays
+            dense_limit: chunks whose partkeys are all in [0, dense_limit) are counted
+                         with one bincount, the others with np.unique
+        return:
+            int64 array of the number of values of each partkey, in no particular order
+    """
+    dense = np.zeros(0, dtype=np.int64)
+    sparse_keys, sparse_counts = [], []
+    for keys in chunks:
+        if not len(keys):
+            continue
+        if keys.min() >= 0 and keys.max() < dense_limit:
+            counts = np.bincount(keys, minlength=len(dense))
+            counts[: len(dense)] += dense
+            dense = counts
+        else:
+            keys, counts = np.unique(keys, return_counts=True)
+            sparse_keys.append(keys)
+            sparse_counts.append(counts)
+    if not sparse_keys:
+        return dense[dense > 0]
+    present = np.flatnonzero(dense)
+    keys, inverse = np.unique(np.concatenate([present] + sparse_keys), return_inverse=True)
+    return np.bincount(inverse, weights=np.concatenate([dense[present]] + sparse_counts), minlength=len(keys)).astype(np.int64)
+
+
+def store_volumes(path):
+    """
+        function to get the partkey volumes of a built store from its client snapshot
+        args:
+            path: store directory (client.npz inside) or client snapshot file
+        return:
+            (volumes, p the store was built with)
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "client.npz")
+    with np.load(path) as state:
+        p = int(state["p"])
+        counts = state["counts"]
+        pads = state["pads"]
+    starts = np.cumsum(counts) - counts
+    padded = np.add.reduceat(pads, starts[counts > 0]) if len(pads) else np.zeros(0, dtype=np.int64)
+    volumes = counts * p
+    volumes[counts > 0] -= padded
+    return volumes, p
+
+
+def calibrate(n=4096, sizes=(4, 256)):
+    """
+        function to measure the per-block and per-value cost of a query on this machine
+        return:
+            (block_seconds, value_seconds), fitted on two block sizes
+    """
+    from prf import PRF
+    from untrusted import ColumnarStorage
+    from utils import random_gammas
+    G1 = PRF("advisor")
+    msgs = ["{}|{}|0".format(i, i) for i in range(n)]
+    times = []
+    for p in sizes:
+        Imm = ColumnarStorage(p=p)
+        Imm.multi_set(G1.encrypt_many(msgs), np.random.randint(0, 1 << 30, size=(n, p)), [1] * n)
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            LVg_list = Imm.multi_get(G1.encrypt_many(msgs))
+            gammas = np.array([gamma for _, gamma in LVg_list])
+            gamma_star = random_gammas(n, 4)
+            V_star = np.stack([V for V, _ in LVg_list]) ^ (gammas ^ gamma_star)[:, None]
+            [V ^ gamma for V, gamma in zip(V_star, gamma_star.tolist())]
+            best = min(best, time.perf_counter() - start)
+        times.append(best / n)
+    value_seconds = max((times[1] - times[0]) / (sizes[1] - sizes[0]), 0.0)
+    return max(times[0] - value_seconds * sizes[0], 0.0), value_seconds
+
+
+def model(volumes, candidates=CANDIDATES, q=1, block_seconds=BLOCK_SECONDS, value_seconds=VALUE_SECONDS, label_bytes=LABEL_BYTES):
+    """
+        function to model each candidate block size on a partkey volume distribution
+        args:
+            volumes: number of values of each partkey
+            candidates: block sizes to evaluate
+            q: query batch size (partkeys returned per query)
+            block_seconds, value_seconds: query cost per block and per value
+            label_bytes: stored size of a label
+        return:
+            list of dicts, one per candidate, with the blocks, fake values, storage
+            bytes, blocks per partkey and per query and the estimated query time
+    """
+    sizes, freq = np.unique(np.asarray(volumes, dtype=np.int64), return_counts=True)
+    num_keys = int(freq.sum())
+    num_values = int((sizes * freq).sum())
+    rows = []
+    for p in candidates:
+        blocks = -(-sizes // p)
+        num_blocks = int((blocks * freq).sum())
+        order = np.argsort(blocks)
+        cumulative = np.cumsum(freq[order])
+        p99 = int(blocks[order][np.searchsorted(cumulative, 0.99 * num_keys)]) if num_keys else 0
+        per_query = q * num_blocks / num_keys if num_keys else 0.0
+        rows.append({
+            "p": p,
+            "blocks": num_blocks,
+            "fake_values": num_blocks * p - num_values,
+            "fake_ratio": (num_blocks * p - num_values) / (num_blocks * p) if num_blocks else 0.0,
+            "storage_bytes": num_blocks * (8 * p + 8 + label_bytes),
+            "blocks_per_partkey_p99": p99,
+            "blocks_per_query": per_query,
+            "query_ms": per_query * (block_seconds + value_seconds * p) * 1000,
+        })
+    return rows
+
+
+def recommend(rows, objective="balanced"):
+    """
+        function to pick the best modelled block size
+        args:
+            rows: output of model
+            objective: "query" (estimated query time), "storage" (stored bytes) or
+                       "balanced" (sum of both, each relative to its best candidate)
+    """
+    best_query = min(row["query_ms"] for row in rows) or 1.0
+    best_storage = min(row["storage_bytes"] for row in rows) or 1
+    scores = {
+        "query": lambda row: row["query_ms"],
+        "storage": lambda row: row["storage_bytes"],
+        "balanced": lambda row: row["query_ms"] / best_query + row["storage_bytes"] / best_storage,
+    }
+    return min(rows, key=lambda row: (scores[objective](row), row["p"]))["p"]
+
+
+def advise(path=None, store=None, candidates=CANDIDATES, q=1, objective="balanced", calibrated=False):
+    """
+        function to model the candidates on a dataset or a built store and recommend one
+        return:
+            dict with the volume summary, the modelled candidates and the recommended p
+    """
+    start = time.perf_counter()
+    built_p = None
+    if store is not None:
+        volumes, built_p = store_volumes(store)
+    else:
+        volumes = partkey_volumes(read_partkeys(path))
+    scan_seconds = time.perf_counter() - start
+    costs = calibrate() if calibrated else (BLOCK_SECONDS, VALUE_SECONDS)
+    rows = model(volumes, candidates, q, *costs)
+    return {
+        "partkeys": int(len(volumes)),
+        "values": int(volumes.sum()),
+        "volume_mean": float(volumes.mean()) if len(volumes) else 0.0,
+        "volume_p50": float(np.percentile(volumes, 50)) if len(volumes) else 0.0,
+        "volume_p99": float(np.percentile(volumes, 99)) if len(volumes) else 0.0,
+        "volume_max": int(volumes.max()) if len(volumes) else 0,
+        "built_p": built_p,
+        "scan_seconds": scan_seconds,
+        "block_seconds": costs[0],
+        "value_seconds": costs[1],
+        "candidates": rows,
+        "recommended_p": recommend(rows, objective),
+    }
+
+
+def print_report(report):
+    print("{partkeys} partkeys, {values} values; values per partkey: mean {volume_mean:.1f}, p50 {volume_p50:.0f}, p99 {volume_p99:.0f}, max {volume_max}".format(**report))
+    print("{:>5} {:>12} {:>13} {:>6} {:>12} {:>10} {:>13} {:>10}".format("p", "blocks", "fake values", "fake%", "storage MB", "p99 blk/k", "blocks/query", "query ms"))
+    for row in report["candidates"]:
+        mark = " <-" if row["p"] == report["recommended_p"] else (" (built)" if row["p"] == report["built_p"] else "")
+        print("{:>5} {:>12} {:>13} {:>6.1f} {:>12.2f} {:>10} {:>13.2f} {:>10.4f}{}".format(
+            row["p"], row["blocks"], row["fake_values"], 100 * row["fake_ratio"], row["storage_bytes"] / 1024 / 1024,
+            row["blocks_per_partkey_p99"], row["blocks_per_query"], row["query_ms"], mark))
+    print("Recommended block size: p =", report["recommended_p"])
+
+
+def int_list(text):
+    return [int(x) for x in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="recommend a HybrIDX block size p from the partkey volumes")
+    parser.add_argument("data", nargs="?", help="(partkey, value) csv or .npy to be built")
+    parser.add_argument("--store", help="built store directory (or client snapshot) to re-evaluate instead")
+    parser.add_argument("--p", type=int_list, default=list(CANDIDATES), help="candidate block sizes, comma-separated")
+    parser.add_argument("--q", type=int, default=1, help="query batch size")
+    parser.add_argument("--objective", default="balanced", choices=["balanced", "query", "storage"])
+    parser.add_argument("--calibrate", action="store_true", help="measure the query costs on this machine instead of the defaults")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args(argv)
+    if (args.data is None) == (args.store is None):
+        parser.error("give either a dataset or --store")
+
+    report = advise(args.data, args.store, args.p, args.q, args.objective, args.calibrate)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
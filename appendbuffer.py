@@ -0,0 +1,97 @@
+import time
+import numpy as np
+from collections import OrderedDict
+
+
+class AppendBuffer(object):
+    """
+        enclave-side buffer of the values appended to each partkey that do not fill a
+        whole block yet, so that small inserts are coalesced into full blocks instead
+        of each writing a padded block
+        the buffered values of a partkey form its tail, a virtual block that follows
+        its stored blocks: queries return it padded like a stored block, and the client
+        records its pad length as the last one of the partkey. a tail is written as a
+        padded block at that same index when it is flushed, so the pad lengths of the
+        client are still right afterwards.
+        tails are flushed oldest first once they are older than max_age seconds or the
+        buffer holds more than max_values values
+    """
+    def __init__(self, p, max_values=65536, max_age=60.0):
+        self.p = p
+        self.max_values = max_values            # values held before the oldest tails are flushed
+        self.max_age = max_age                  # seconds a tail is held before it is flushed
+        self.tails = OrderedDict()              # storage of (partkey, (values, time of the oldest)), oldest first
+        self.num_values = 0                     # number of values held
+        self.coalesced = 0                      # values that went into full blocks with buffered ones
+        self.flushed = 0                        # tails written as padded blocks
+
+
+    def __len__(self):
+        return len(self.tails)
+
+
+    def __contains__(self, partkey):
+        return partkey in self.tails
+
+
+    def values(self, partkey):
+        """
+            function to get the buffered values of a partkey, an empty array if none
+        """
+        entry = self.tails.get(partkey)
+        return entry[0] if entry is not None else np.empty(0, dtype=np.int64)
+
+
+    def put(self, partkey, values):
+        """
+            function to replace the buffered values of a partkey
+            args:
+                partkey: key of the tail
+                values: int64 array of fewer than p values, the tail is dropped if empty
+            note:
+                a tail keeps the time and the flush order of its oldest value
+        """
+        entry = self.tails.get(partkey)
+        if entry is not None:
+            self.num_values -= len(entry[0])
+        if not len(values):
+            self.tails.pop(partkey, None)
+            return
+        self.tails[partkey] = (values, entry[1] if entry is not None else time.time())
+        self.num_values += len(values)
+
+
+    def pop(self, partkey):
+        """
+            function to take the buffered values of a partkey out of the buffer
+        """
+        values, _ = self.tails.pop(partkey)
+        self.num_values -= len(values)
+        return values
+
+
+    def due(self, now=None):
+        """
+            function to get the partkeys whose tails must be flushed, oldest first
+        """
+        now = time.time() if now is None else now
+        partkeys = []
+        num_values = self.num_values
+        for partkey, (values, since) in self.tails.items():
+            if num_values <= self.max_values and now - since < self.max_age:
+                break
+            partkeys.append(partkey)
+            num_values -= len(values)
+        return partkeys
+
+
+    def stats(self):
+        """
+            function to get the buffer counters
+        """
+        return {
+            "partkeys": len(self.tails),
+            "values": self.num_values,
+            "coalesced": self.coalesced,
+            "flushed": self.flushed,
+        }
@@ -0,0 +1,307 @@
+"""
+    reproducible benchmarks of the build, query, insert and rebuild paths on
+    synthetic datasets
+
+        python bench.py --keys 2000 --values-per-key 20 --dist zipf,uniform --p 4,8 --cache 25,200
+        python bench.py --preset small --out results.json --compare baseline.json
+
+    every combination of the grid options is one run; a run builds a fresh store,
+    times range queries for each cmp and q, small inserts one by one and as one
+    batch, then the rebuild of the partkeys left in the cache. results are written
+    as json, with the commit and library versions, so that runs of different
+    commits can be compared.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import itertools
+import contextlib
+import subprocess
+import numpy as np
+from prf import PRF
+from cache import Qsgx
+from client import Client
+from enclave import Enclave
+from utils import GammaDRBG
+from untrusted import UntrustedStorage, ColumnarStorage
+
+
+K1 = "rtlZ6JzAq3q8ftuUW3zVuJyd5-NIfzVIVxkK4-6m-vI="
+K2 = "GKgkrTc5_EFQmU0mPnMGJRKaC0kJ_az58y0dQNwp52I="
+PRESETS = {
+    "small": dict(keys=[500], values_per_key=[10], dist=["zipf", "uniform"], p=[8], cache=[25], q=[1, 10], queries=200, inserts=100),
+    "medium": dict(keys=[5000], values_per_key=[20], dist=["zipf", "uniform"], p=[4, 8, 16], cache=[25, 250], q=[1, 10, 50], queries=500, inserts=500),
+    "large": dict(keys=[50000], values_per_key=[40], dist=["zipf"], p=[8, 32], cache=[250, 2500], q=[1, 50], queries=1000, inserts=1000),
+}
+
+
+def generate_dataset(num_keys, values_per_key, dist="zipf", skew=1.1, seed=0):
+    """
+        function to generate a synthetic (partkey, value) table
+        args:
+            num_keys: number of distinct partkeys, drawn as 0..num_keys-1
+            values_per_key: mean number of values per partkey
+            dist: "fixed" (every key has values_per_key values), "uniform" (1 to
+                  2 * values_per_key - 1 values) or "zipf" (the rank-r key gets a share
+                  proportional to 1/r**skew, ranks shuffled over the keys)
+            skew: zipf exponent
+            seed: seed of the generator
+        return:
+            (rows, 2) int64 array sorted by nothing in particular, like a raw csv
+    """
+    rng = np.random.default_rng(seed)
+    if dist == "fixed":
+        counts = np.full(num_keys, values_per_key, dtype=np.int64)
+    elif dist == "uniform":
+        counts = rng.integers(1, 2 * values_per_key, size=num_keys)
+    elif dist == "zipf":
+        weights = 1.0 / np.arange(1, num_keys + 1) ** skew
+        counts = 1 + np.floor(weights / weights.sum() * num_keys * (values_per_key - 1)).astype(np.int64)
+        rng.shuffle(counts)
+    else:
+        raise ValueError("unknown distribution {}".format(dist))
+    partkeys = np.repeat(np.arange(num_keys, dtype=np.int64), counts)
+    values = rng.integers(0, 1 << 31, size=len(partkeys), dtype=np.int64)
+    table = np.stack([partkeys, values], axis=1)
+    return table[rng.permutation(len(table))]
+
+
+def percentiles(seconds):
+    """
+        function to summarize a list of latencies in milliseconds
+    """
+    ms = np.asarray(seconds) * 1000
+    if len(ms) == 0:
+        return {"count": 0}
+    return {
+        "count": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+        context to drop the progress prints of the library while timing
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def run_config(config, seed=0):
+    """
+        function to run one benchmark configuration
+        args:
+            config: dict with keys, values_per_key, dist, p, cache, q, queries, inserts, storage
+                    and optionally appends (inserts go through the enclave append buffer)
+            seed: seed of the dataset, the masks and the query workload
+        return:
+            dict of the config and the build, query, insert and rebuild measurements
+    """
+    random.seed(seed)
+    rng = random.Random(seed)
+    table = generate_dataset(config["keys"], config["values_per_key"], config["dist"], seed=seed)
+    p = config["p"]
+    result = {"config": dict(config, rows=len(table))}
+
+    ### build
+    Imm = ColumnarStorage(p=p) if config["storage"] == "columnar" else UntrustedStorage(LV_store={})
+    client = Client(p=p, k1=K1, k2=K2, prf=PRF, gamma_len=4, gamma_rng=GammaDRBG("client-{}".format(seed)))
+    with quiet():
+        start = time.perf_counter()
+        k2v = client.preprocess(table)
+        preprocess_time = time.perf_counter() - start
+        for partkey in k2v:
+            client.process_partkey(partkey, Imm, k2v)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        enclave = Enclave(p=p, k1=K1, k2=K2, prf=PRF, node_list=client.node_list, gamma_len=4, gamma_rng=GammaDRBG("enclave-{}".format(seed)))
+        index_time = time.perf_counter() - start
+    result["build"] = {
+        "seconds": build_time,
+        "preprocess_seconds": preprocess_time,
+        "index_seconds": index_time,
+        "rows_per_second": len(table) / build_time,
+        "blocks": len(Imm),
+        "blocks_per_second": len(Imm) / build_time,
+        "fake_values": int(sum(sum(pads) for pads in client.pad_len.values())),
+        "storage_bytes": Imm.nbytes(),
+    }
+
+    ### queries, one workload per (cmp, q), all against the same cache
+    cache = Qsgx(config["cache"])
+    partkeys = enclave.tree.partkeys
+    result["query"] = {}
+    for cmp, q in itertools.product([">=", "<="], config["q"]):
+        latencies = []
+        blocks = 0
+        hits, misses = cache.hits, cache.misses
+        with quiet():
+            for _ in range(config["queries"]):
+                v = rng.choice(partkeys)
+                client.clear_results()
+                start = time.perf_counter()
+                token = client.enc_token(v, cmp, q)
+                res_batch, R = enclave.search_query(token, Imm, cache)
+                client.dec_enclave_msg(R, res_batch)
+                latencies.append(time.perf_counter() - start)
+                blocks += sum(len(res) for res in res_batch.values())
+        stats = percentiles(latencies)
+        stats["blocks_per_query"] = blocks / max(config["queries"], 1)
+        lookups = cache.hits - hits + cache.misses - misses
+        stats["hit_rate"] = (cache.hits - hits) / lookups if lookups else 0.0
+        result["query"]["{} q={}".format(cmp, q)] = stats
+
+    ### inserts of 1 to p values to random partkeys
+    if config.get("appends"):
+        enclave.start_appends()
+    blocks = sum(N.c for N in enclave.tree)
+    latencies = []
+    with quiet():
+        for _ in range(config["inserts"]):
+            partkey = rng.choice(partkeys)
+            values = [str(rng.randrange(1 << 31)) for _ in range(rng.randint(1, p))]
+            start = time.perf_counter()
+            token = client.add_token(partkey, values)
+            new_blocks, pad_lens, first = enclave.add_query(token, Imm, cache)
+            client.dec_add_result(partkey, new_blocks, pad_lens, first)
+            latencies.append(time.perf_counter() - start)
+    result["insert"] = percentiles(latencies)
+    result["insert"]["blocks_added"] = sum(N.c for N in enclave.tree) - blocks
+
+    ### the same number of inserts as one batch token
+    items = [(rng.choice(partkeys), [rng.randrange(1 << 31) for _ in range(rng.randint(1, p))]) for _ in range(config["inserts"])]
+    start = time.perf_counter()
+    token = client.add_batch_token(items)
+    client.dec_add_batch_result(enclave.add_batch_query(token, Imm, cache))
+    batch_time = time.perf_counter() - start
+    result["insert_batch"] = {
+        "seconds": batch_time,
+        "partkeys": len(items),
+        "partkeys_per_second": len(items) / batch_time if batch_time else 0.0,
+    }
+
+    enclave.stop_appends(Imm, cache)
+
+    ### rebuild of everything left in the cache
+    cached = list(cache.kL_store.keys())
+    num_blocks = cache.num_blocks
+    start = time.perf_counter()
+    for partkey in cached:
+        enclave.rebuild(partkey, cache, Imm)
+    cache.clear()
+    rebuild_time = time.perf_counter() - start
+    result["rebuild"] = {
+        "seconds": rebuild_time,
+        "partkeys": len(cached),
+        "blocks": num_blocks,
+        "blocks_per_second": num_blocks / rebuild_time if rebuild_time else 0.0,
+    }
+    return result
+
+
+def environment():
+    """
+        function to describe the commit, interpreter and libraries of a run
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def config_key(config):
+    return json.dumps({k: v for k, v in config.items() if k != "rows"}, sort_keys=True)
+
+
+def compare(results, baseline):
+    """
+        function to print the ratio new/old of the main metrics of matching runs
+    """
+    old_runs = {config_key(run["config"]): run for run in baseline["results"]}
+    print("{:<60} {:>12} {:>12} {:>8}".format("metric", "old", "new", "new/old"))
+    for run in results["results"]:
+        old = old_runs.get(config_key(run["config"]))
+        if old is None:
+            continue
+        name = "{dist} keys={keys} vpk={values_per_key} p={p} cache={cache}".format(**run["config"])
+        metrics = [("build rows/s", run["build"]["rows_per_second"], old["build"]["rows_per_second"])]
+        for label in run["query"]:
+            if label in old["query"]:
+                metrics.append(("query {} p50 ms".format(label), run["query"][label]["p50_ms"], old["query"][label]["p50_ms"]))
+                metrics.append(("query {} p99 ms".format(label), run["query"][label]["p99_ms"], old["query"][label]["p99_ms"]))
+        metrics.append(("insert p50 ms", run["insert"].get("p50_ms", 0.0), old["insert"].get("p50_ms", 0.0)))
+        if "insert_batch" in old:
+            metrics.append(("batch insert partkeys/s", run["insert_batch"]["partkeys_per_second"], old["insert_batch"]["partkeys_per_second"]))
+        metrics.append(("rebuild blocks/s", run["rebuild"]["blocks_per_second"], old["rebuild"]["blocks_per_second"]))
+        print(name)
+        for metric, new_value, old_value in metrics:
+            ratio = new_value / old_value if old_value else float("nan")
+            print("  {:<58} {:>12.4g} {:>12.4g} {:>8.3f}".format(metric, old_value, new_value, ratio))
+
+
+def int_list(text):
+    return [int(x) for x in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark HybrIDX on synthetic datasets")
+    parser.add_argument("--preset", choices=sorted(PRESETS), help="grid to run, the grid options below override it")
+    parser.add_argument("--keys", type=int_list, help="numbers of partkeys, comma-separated")
+    parser.add_argument("--values-per-key", type=int_list, help="mean numbers of values per partkey")
+    parser.add_argument("--dist", type=lambda text: text.split(","), help="partkey volume distributions: fixed, uniform, zipf")
+    parser.add_argument("--p", type=int_list, help="block sizes")
+    parser.add_argument("--cache", type=int_list, help="cache capacities in partkeys")
+    parser.add_argument("--q", type=int_list, help="query batch sizes")
+    parser.add_argument("--queries", type=int, help="queries per (cmp, q)")
+    parser.add_argument("--inserts", type=int, help="number of inserts")
+    parser.add_argument("--storage", default="columnar", choices=["columnar", "dict"], help="untrusted storage engine")
+    parser.add_argument("--appends", action="store_true", help="coalesce inserts in the enclave append buffer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="json file to write the results to, stdout if not given")
+    parser.add_argument("--compare", help="json results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    grid = dict(PRESETS[args.preset or "small"])
+    for name in grid:
+        if getattr(args, name, None) is not None:
+            grid[name] = getattr(args, name)
+
+    results = {"environment": environment(), "seed": args.seed, "results": []}
+    for keys, values_per_key, dist, p, cache in itertools.product(grid["keys"], grid["values_per_key"], grid["dist"], grid["p"], grid["cache"]):
+        config = dict(keys=keys, values_per_key=values_per_key, dist=dist, p=p, cache=cache, q=grid["q"], queries=grid["queries"], inserts=grid["inserts"], storage=args.storage)
+        if args.appends:
+            config["appends"] = True
+        print("running", config, file=sys.stderr)
+        results["results"].append(run_config(config, args.seed))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,103 @@
+import random
+from collections import OrderedDict
+
+
+class LRUPolicy(object):
+    """
+        evict the least recently used partkeys first
+    """
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def admit(self, partkey):
+        self.order[partkey] = None
+
+    def touch(self, partkey):
+        self.order.move_to_end(partkey)
+
+    def remove(self, partkey):
+        del self.order[partkey]
+
+    def victims(self, k):
+        return [partkey for partkey, _ in zip(self.order, range(k))]
+
+    def clear(self):
+        self.order.clear()
+
+
+class LFUPolicy(object):
+    """
+        evict the least frequently used partkeys first, oldest first among equals
+    """
+    def __init__(self):
+        self.counts = OrderedDict()
+
+    def admit(self, partkey):
+        self.counts[partkey] = 1
+
+    def touch(self, partkey):
+        self.counts[partkey] += 1
+
+    def remove(self, partkey):
+        del self.counts[partkey]
+
+    def victims(self, k):
+        return sorted(self.counts, key=self.counts.get)[:k]
+
+    def clear(self):
+        self.counts.clear()
+
+
+class RandomPolicy(object):
+    """
+        evict uniformly random partkeys, so that evictions do not reveal the access pattern
+    """
+    def __init__(self, rng=None):
+        self.rng = rng or random.SystemRandom()
+        self.keys = []                 # cached partkeys
+        self.pos = {}                  # storage of (partkey, index in keys)
+
+    def admit(self, partkey):
+        self.pos[partkey] = len(self.keys)
+        self.keys.append(partkey)
+
+    def touch(self, partkey):
+        pass
+
+    def remove(self, partkey):
+        i = self.pos.pop(partkey)
+        last = self.keys.pop()
+        if last != partkey:
+            self.keys[i] = last
+            self.pos[last] = i
+
+    def victims(self, k):
+        return self.rng.sample(self.keys, min(k, len(self.keys)))
+
+    def clear(self):
+        self.keys = []
+        self.pos = {}
+
+
+POLICIES = {"lru": LRUPolicy, "lfu": LFUPolicy, "random": RandomPolicy}
 
 
 class Qsgx(object):
-    def __init__(self, capacity):
-        self.capacity = capacity       # capacity of the cache
+    def __init__(self, capacity, policy="lru", evict_batch=1, max_blocks=None, max_bytes=None):
+        self.capacity = capacity       # capacity of the cache, in partkeys
+        self.max_blocks = max_blocks   # optional capacity of the cache, in blocks
+        self.max_bytes = max_bytes     # optional capacity of the cache, in bytes of (L, V, gamma)
         self.current_size = 0          # number of keys that the cache is currently holding
+        self.num_blocks = 0            # number of blocks that the cache is currently holding
+        self.num_bytes = 0             # number of bytes that the cache is currently holding
+        self.key_size = {}             # storage of (partkey, (blocks, bytes))
         self.LVg_store = {}            # storage of (L, V, gamma)
         self.kL_store = {}             # storage of (partkey, L)
+        self.policy = POLICIES[policy]() if isinstance(policy, str) else policy   # eviction policy
+        self.evict_batch = evict_batch # number of partkeys evicted when the cache is full
+        self.hits = 0                  # lookups served from the cache
+        self.misses = 0                # lookups that had to fetch from untrusted storage
+        self.evictions = 0             # partkeys evicted (rebuilt) one by one
 
 
     def get_current_size(self):
@@ -17,9 +109,47 @@ class Qsgx(object):
 
     def is_full(self):
         """
-            function to check whether the cache is full
+            function to check whether the cache is full, in partkeys, blocks or bytes
+        """
+        return not self.fits(0, 0)
+
+
+    def fits(self, blocks, nbytes):
+        """
+            function to check whether one more partkey of the given size fits in the cache
+            args:
+                blocks: number of blocks of the partkey
+                nbytes: size of its (L, V, gamma) entries in bytes
+        """
+        return (self.current_size < self.capacity
+                and (self.max_blocks is None or self.num_blocks + blocks <= self.max_blocks)
+                and (self.max_bytes is None or self.num_bytes + nbytes <= self.max_bytes))
+
+
+    def over_budget(self):
+        """
+            function to check whether the cache holds more than any of its capacities
+        """
+        return (self.current_size > self.capacity
+                or (self.max_blocks is not None and self.num_blocks > self.max_blocks)
+                or (self.max_bytes is not None and self.num_bytes > self.max_bytes))
+
+
+    @staticmethod
+    def entry_bytes(L, V):
+        """
+            function to get the size of a cached (L, V, gamma) entry in bytes
         """
-        return self.current_size >= self.capacity
+        return len(L) + V.nbytes + 8
+
+
+    def __account(self, partkey, L_list):
+        blocks = len(L_list)
+        nbytes = sum(self.entry_bytes(L, self.LVg_store[L][0]) for L in L_list)
+        old_blocks, old_bytes = self.key_size.get(partkey, (0, 0))
+        self.key_size[partkey] = (old_blocks + blocks, old_bytes + nbytes)
+        self.num_blocks += blocks
+        self.num_bytes += nbytes
 
 
     def clear(self):
@@ -27,8 +157,12 @@ class Qsgx(object):
             function to clear cache
         """
         self.current_size = 0
+        self.num_blocks = 0
+        self.num_bytes = 0
+        self.key_size = {}
         self.LVg_store = {}
         self.kL_store = {}
+        self.policy.clear()
 
 
     def get_from_cache(self, L):
@@ -37,4 +171,97 @@ class Qsgx(object):
             args:
                 L: pseudo-label to get block from
         """
-        return self.LVg_store[L]
\ No newline at end of file
+        return self.LVg_store[L]
+
+
+    def record_hit(self, partkey):
+        """
+            function to account a lookup of a cached partkey
+        """
+        self.hits += 1
+        self.policy.touch(partkey)
+
+
+    def admit(self, partkey, L_list):
+        """
+            function to register a partkey whose blocks were just fetched into LVg_store
+            args:
+                partkey: key fetched from untrusted storage
+                L_list: pseudo-labels of its blocks
+        """
+        self.misses += 1
+        self.kL_store[partkey] = L_list
+        self.current_size += 1
+        self.__account(partkey, L_list)
+        self.policy.admit(partkey)
+
+
+    def extend(self, partkey, L_list):
+        """
+            function to append blocks just fetched into LVg_store to a cached partkey
+            args:
+                partkey: cached key the blocks belong to (e.g. after an insert)
+                L_list: pseudo-labels of the new blocks
+        """
+        self.kL_store[partkey].extend(L_list)
+        self.__account(partkey, L_list)
+
+
+    def replace(self, partkey, LVg_list):
+        """
+            function to swap the blocks of a cached partkey for fewer ones (e.g. after
+            compaction); the first labels are kept as keys, the others are dropped
+            args:
+                partkey: cached key
+                LVg_list: new list of (V, gamma), at most as many as the cached blocks
+        """
+        L_list = self.kL_store[partkey]
+        for L in L_list[len(LVg_list):]:
+            del self.LVg_store[L]
+        L_list = L_list[: len(LVg_list)]
+        self.LVg_store.update(zip(L_list, LVg_list))
+        self.kL_store[partkey] = L_list
+        blocks, nbytes = self.key_size.pop(partkey)
+        self.num_blocks -= blocks
+        self.num_bytes -= nbytes
+        self.__account(partkey, L_list)
+
+
+    def victims(self):
+        """
+            function to choose the next partkeys to evict, according to the policy
+        """
+        return self.policy.victims(self.evict_batch)
+
+
+    def evict(self, partkey):
+        """
+            function to drop a partkey and its blocks from the cache, once they are rebuilt
+        """
+        for L in self.kL_store.pop(partkey):
+            del self.LVg_store[L]
+        blocks, nbytes = self.key_size.pop(partkey)
+        self.num_blocks -= blocks
+        self.num_bytes -= nbytes
+        self.current_size -= 1
+        self.policy.remove(partkey)
+        self.evictions += 1
+
+
+    def stats(self):
+        """
+            function to get the cache counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "current_size": self.current_size,
+            "capacity": self.capacity,
+            "num_blocks": self.num_blocks,
+            "max_blocks": self.max_blocks,
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+        }
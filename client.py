@@ -1,14 +1,25 @@
-from tqdm import trange
+import os
+import base64
 import random
 import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from node import Node
-from utils import random_binary_string
-from collections import defaultdict
+from utils import random_gamma, random_gammas, session_msg
+from metrics import METRICS
+from logs import get_logger
+from ingest import group_table, iter_shuffled_groups
+from collections import defaultdict, OrderedDict, deque
 import json
-import pandas as pd
+import numpy as np
+
+
+logger = get_logger("client")
+
 
 class Client():
-    def __init__(self, p, k1, k2, prf, gamma_len):
+    def __init__(self, p, k1, k2, prf, gamma_len, gamma_rng=None, client_id=None, max_results=4096, lru=False):
         self.p = p                          # fixed block size
         self.k1 = k1                        # secret key 1
         self.k2 = k2                        # secret key 2
@@ -16,13 +27,16 @@ class Client():
         self.F1 = prf(k1)
         self.G1 = prf(k1)
         self.G2 = prf(k2)
-        self.gamma_len = gamma_len          # len of random binary string for encrypting V
+        self.gamma_len = gamma_len          # number of bits of the random masks for encrypting V
+        self.gamma_rng = gamma_rng          # optional seeded GammaDRBG, OS randomness if None
         self.pad_len = defaultdict(list)    # client remembers what is the pad len for each block (zero for unpadded blocks)
         self.node_list = []                 # list of nodes to build the enclave tree
         self.s = 0                          # session number (for querying)
-        self.Qres = {}                      # query decrypted results (plaintext)
-        self.Qres_undec = {}                # query undecrypted results (ciphertext)
-        self.unpadded_keys = []
+        self.client_id = client_id          # id of the session counter kept for this client by the enclave, shared if None
+        self.max_results = max_results      # partkeys kept in the query results, unbounded if None
+        self.lru = lru                      # evict the least recently returned or looked up partkey first, else the oldest
+        self.Qres = OrderedDict()           # query decrypted and unpadded results (plaintext blocks), oldest first
+        self.Qres_undec = OrderedDict()     # query undecrypted results (ciphertext blocks), in the same order
 
 
     def reset_query_sess(self):
@@ -30,28 +44,67 @@ class Client():
             function to reset query session
         """
         self.s = 0
-        self.Qres = {}
-        self.Qres_undec = {}
-        self.unpadded_keys = []
+        self.clear_results()
+
+
+    def clear_results(self):
+        """
+            function to drop the decrypted results without resetting the session number
+        """
+        self.Qres = OrderedDict()
+        self.Qres_undec = OrderedDict()
+
+
+    def save_state(self, path):
+        """
+            function to snapshot the client pad lengths and session counter to a binary file
+            args:
+                path: file to write
+            note:
+                keys are not saved, the restoring client is constructed with them
+        """
+        partkeys = np.array(list(self.pad_len.keys()), dtype=np.int64)
+        counts = np.array([len(pads) for pads in self.pad_len.values()], dtype=np.int64)
+        pads = np.fromiter((pad for pads in self.pad_len.values() for pad in pads), dtype=np.int64, count=int(counts.sum()))
+        with open(path, "wb") as f:
+            np.savez(f, p=self.p, s=self.s, partkeys=partkeys, counts=counts, pads=pads)
 
 
-    def preprocess(self, table, progress_bar):
+    def load_state(self, path, Imm=None):
+        """
+            function to restore the client state saved by save_state
+            args:
+                path: file written by save_state
+                Imm: optional untrusted store, checked to hold one block per pad length
+        """
+        with np.load(path) as state:
+            if int(state["p"]) != self.p:
+                raise ValueError("state was saved with p={}, client has p={}".format(int(state["p"]), self.p))
+            counts = state["counts"]
+            if Imm is not None and len(Imm) != int(counts.sum()):
+                raise ValueError("untrusted store holds {} blocks, client state has {}".format(len(Imm), int(counts.sum())))
+            self.s = int(state["s"])
+            pads = state["pads"].tolist()
+            self.pad_len = defaultdict(list)
+            start = 0
+            for partkey, count in zip(state["partkeys"].tolist(), counts.tolist()):
+                self.pad_len[partkey] = pads[start : start + count]
+                start += count
+
+
+    def preprocess(self, table, progress_bar=None):
         """
             function to preprocess csv to hash map
             args:
                 table: csv data, in numpy array format
-                progress_bar: to show the preprocessing progress
+                progress_bar: optional, to show the preprocessing progress
             return:
                 hashmap: the key-value store in hash map format
         """
-        hashmap = {}
-        partkey_list = list(set(table[:, 0]))
-        for partkey in partkey_list:
-            hashmap[partkey] = []
-        for i in range(len(table)):
-            partkey = table[i, 0]
-            hashmap[partkey].append(table[i, 1])
-            progress_bar.setValue( int((i+1) / len(table) * 100) )
+        partkeys, groups = group_table(table)
+        hashmap = {partkey: values.tolist() for partkey, values in zip(partkeys.tolist(), groups)}
+        if progress_bar is not None:
+            progress_bar.setValue(100)
         return hashmap
 
 
@@ -70,6 +123,7 @@ class Client():
         print(f"Finish preparing hashmap in {time.time() - start_time} seconds")
 
         print("Buiding the L-V store for untrusted storage...")
+        from tqdm import trange         # imported here, only the interactive build shows a progress bar
         partkey_list = list(set(table[:, 0]))
         random.shuffle(partkey_list)
         
@@ -79,7 +133,28 @@ class Client():
             self.process_partkey(partkey, Imm, k2v)
 
         print(f"Finish building L-V store in {time.time() - start_time} seconds")
-        
+
+
+    def build_from_csv(self, path, Imm, chunk_size=1000000, spill_dir=None, progress=None):
+        """
+            function to build the untrusted storage straight from a csv file, streaming it
+            in chunks so that peak memory is bounded by chunk_size, not by the dataset
+            args:
+                path: csv file of (partkey, value) rows
+                Imm: untrusted server
+                chunk_size: number of rows grouped in memory at once
+                spill_dir: directory for the sorted runs and shuffle buckets of files
+                           larger than one chunk
+                progress: optional callback taking the percentage of the file read
+            note:
+                as in build, partkeys are written in a uniformly random order (see
+                ingest.iter_shuffled_groups), not in the partkey order of the csv
+        """
+        start_time = time.time()
+        for partkey, values in iter_shuffled_groups(path, chunk_size, spill_dir, progress):
+            self.process_records(partkey, values, Imm)
+        print(f"Finish building L-V store in {time.time() - start_time} seconds")
+
 
     def process_partkey(self, partkey, Imm, k2v):
         """
@@ -89,45 +164,152 @@ class Client():
                 Imm: untrusted server
                 k2v: the original key-value store in hash map format
         """
-        partkey_records = k2v[partkey]
+        self.process_records(partkey, k2v[partkey], Imm)
 
-        ### determine whether to pad the last block
-        if len(partkey_records) % self.p:
-            pad_last_block = True
-        else:
-            pad_last_block = False
 
-        ### total number of ciphertext blocks
-        num_blocks = len(partkey_records) // self.p + int(pad_last_block)
-        
+    def process_records(self, partkey, partkey_records, Imm):
+        """
+            function to encrypt the given values of a partkey into cipher blocks
+            args:
+                partkey: the key to be encrypted
+                partkey_records: values of the partkey
+                Imm: untrusted server
+        """
+        L_list, V_blocks, gammas, pad_len = self.encrypt_records(partkey, partkey_records)
+        Imm.multi_set(L_list, V_blocks, gammas.tolist())
+
+        pads = [0] * (len(L_list) - 1) + [pad_len]
+        self.pad_len[partkey].extend(pads)
+        self.node_list.append( Node(partkey, len(L_list), 0, pads) )
+
+
+    def encrypt_records(self, partkey, partkey_records, raw_labels=False):
+        """
+            function to pad, mask and label the values of a partkey without storing them
+            args:
+                partkey: the key to be encrypted
+                partkey_records: values of the partkey
+                raw_labels: return labels as raw bytes instead of base64 strings
+            return:
+                L_list: pseudo-label of each block
+                V_blocks: (num_blocks, p) int64 array of cipher blocks
+                gammas: int64 array of the masks
+                pad_len: number of padded values in the last block
+        """
+        partkey_records = np.asarray(partkey_records, dtype=np.int64)
+
+        ### total number of ciphertext blocks, and padding of the last one
+        num_blocks = -(-len(partkey_records) // self.p)
+        pad_len = num_blocks * self.p - len(partkey_records)
+
         ### construct ciphertext blocks for the current range-based index v
-        if pad_last_block:
-            partkey_blocks = [partkey_records[i*self.p : (i+1)*self.p] for i in range(num_blocks-1)]
-            last_block = partkey_records[(num_blocks-1)*self.p :]
-            pad_len = self.p - len(last_block)
-            pad_values = random.choices(range(1,10001), k=pad_len)
-            last_block = last_block + pad_values
-            partkey_blocks.append(last_block)
-        else:
-            partkey_blocks = [partkey_records[i*self.p : (i+1)*self.p] for i in range(num_blocks)]
-            pad_len = 0
-
-        ### generate pseudo labels and encrypt all ciphertext blocks
-        for c, block in enumerate(partkey_blocks):
-            v_c_t = str(partkey) + "|" + str(c) + "|" + str(0)
-            L = self.G1.encrypt(v_c_t)
-            gamma = random_binary_string(self.gamma_len)    # random binary string for XOR encryption
-            V = [supp_key ^ int(gamma, 2) for supp_key in block]
-
-            if L not in Imm.storage:
-                Imm.storage[L] = (V, gamma)
-
-            if c == len(partkey_blocks) - 1:
-                self.pad_len[partkey].append(pad_len)
-            else:
-                self.pad_len[partkey].append(0)
+        partkey_blocks = np.empty(num_blocks * self.p, dtype=np.int64)
+        partkey_blocks[: len(partkey_records)] = partkey_records
+        partkey_blocks[len(partkey_records) :] = random.choices(range(1,10001), k=pad_len)
+        partkey_blocks = partkey_blocks.reshape(num_blocks, self.p)
 
-        self.node_list.append( Node(partkey, c+1, 0) )
+        ### generate pseudo labels and encrypt all ciphertext blocks in one XOR
+        L_list = self.G1.encrypt_many([str(partkey) + "|" + str(c) + "|" + str(0) for c in range(num_blocks)], raw_labels)
+        gammas = random_gammas(num_blocks, self.gamma_len, self.gamma_rng)
+        V_blocks = partkey_blocks ^ gammas[:, None]
+        if METRICS.enabled:
+            METRICS.inc("blocks_encrypted", num_blocks)
+        return L_list, V_blocks, gammas, pad_len
+
+
+    def build_parallel(self, groups, Imm, workers=None, shard_blocks=16384, label_width=48):
+        """
+            function to build the untrusted storage with a pool of processes
+            args:
+                groups: iterable of (partkey, values) in the order they are written, e.g.
+                        ingest.iter_shuffled_groups, consumed as the shards are handed out
+                Imm: untrusted server
+                workers: number of processes, os.cpu_count() if None
+                shard_blocks: number of blocks handed to a process at a time
+                label_width: maximum length of a raw label in bytes, the one of Imm if set
+            actions:
+                - cut the groups into shards of about shard_blocks blocks as they arrive
+                - each worker pads, masks and labels its shard straight into the shard's
+                  shared-memory label/block/gamma buffers
+                - merge each finished shard into Imm (one bulk load with load_arrays if
+                  Imm has it), and into pad_len/node_list in shard order
+            note:
+                at most 2 * workers shards are in flight, so memory is bounded by
+                shard_blocks whatever the dataset size
+                workers always draw masks from the OS CSPRNG, gamma_rng is not shared
+        """
+        start_time = time.time()
+        workers = workers or os.cpu_count()
+        label_width = getattr(Imm, "label_width", label_width)
+        pending = deque()          # (future, shared memory and layout of the output buffers) of each shard in flight
+        with ProcessPoolExecutor(max_workers=workers, initializer=random.seed) as pool:
+            try:
+                shard, total = [], 0
+                for partkey, values in groups:
+                    shard.append((partkey, values))
+                    total += -(-len(values) // self.p)
+                    if total >= shard_blocks:
+                        pending.append(self.__submit_shard(pool, shard, total, label_width))
+                        shard, total = [], 0
+                        if len(pending) >= 2 * workers:
+                            self.__merge_shard(*pending.popleft(), Imm)
+                if shard:
+                    pending.append(self.__submit_shard(pool, shard, total, label_width))
+                while pending:
+                    self.__merge_shard(*pending.popleft(), Imm)
+            finally:
+                for future, shms, _ in pending:
+                    future.cancel()
+                    _release(shms)
+        print(f"Finish building L-V store with {workers} workers in {time.time() - start_time} seconds")
+
+
+    def __submit_shard(self, pool, shard, total, label_width):
+        """
+            function to allocate the shared output buffers of a shard and hand it to a worker
+            return:
+                (future, shared memory by buffer name, layout of the buffers)
+        """
+        buffers = {
+            "labels": ((total, label_width), np.uint8),
+            "values": ((total, self.p), np.int64),
+            "gammas": ((total,), np.int64),
+            "label_lens": ((total,), np.int64),
+        }
+        shms = {}
+        try:
+            for name, (shape, dtype) in buffers.items():
+                shms[name] = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            layout = {name: (shms[name].name, shape, dtype) for name, (shape, dtype) in buffers.items()}
+            return pool.submit(_build_shard, self.p, self.k1, self.k2, self.prf, self.gamma_len, shard, layout), shms, layout
+        except BaseException:
+            _release(shms)
+            raise
+
+
+    def __merge_shard(self, future, shms, layout, Imm):
+        """
+            function to merge a finished shard into Imm, pad_len and node_list
+            actions:
+                - bulk-load the shared buffers with Imm.load_arrays, or multi_set base64
+                  labels into a storage without it
+                - release the shared buffers
+        """
+        try:
+            meta = future.result()
+            labels, values, gammas, label_lens = (np.ndarray(shape, dtype=dtype, buffer=shms[name].buf) for name, (_, shape, dtype) in layout.items())
+            if hasattr(Imm, "load_arrays"):
+                Imm.load_arrays(labels, values, gammas)
+            else:
+                L_list = [base64.b64encode(L[:n].tobytes()).decode("utf-8") for L, n in zip(labels, label_lens.tolist())]
+                Imm.multi_set(L_list, values.copy(), gammas.tolist())
+            del labels, values, gammas, label_lens
+        finally:
+            _release(shms)
+        for partkey, count, pad_len in meta:
+            pads = [0] * (count - 1) + [pad_len]
+            self.pad_len[partkey].extend(pads)
+            self.node_list.append( Node(partkey, count, 0, pads) )
 
 
     def enc_token(self, partkey, cmp, q):
@@ -140,12 +322,26 @@ class Client():
         """
         # print("Client is encrypting query predicate...")
         msg = str(partkey) + cmp + str(q)
-        self.k0 = self.F1.encrypt(str(self.s))
+        self.k0 = self.F1.encrypt(session_msg(self.s, self.client_id))
         token_encoder = self.prf(self.k0)
         token = token_encoder.encrypt(msg)
         self.s += 1
         return token
 
+
+    def enc_tokens(self, predicates):
+        """
+            generate the tokens of a batch of queries, for Enclave.search_queries
+            args:
+                predicates: list of (partkey, cmp, q), as for enc_token
+            return:
+                list of tokens; the session keys are derived in one PRF call and kept
+                in self.k0_batch to decrypt the batch results
+        """
+        self.k0_batch = self.F1.encrypt_many([session_msg(self.s + i, self.client_id) for i in range(len(predicates))])
+        self.s += len(predicates)
+        return [self.prf(k0).encrypt(str(partkey) + cmp + str(q)) for (partkey, cmp, q), k0 in zip(predicates, self.k0_batch)]
+
     def add_token(self, partkey, f_new):
         """
             function to encrypt the insert query predicate
@@ -156,54 +352,276 @@ class Client():
                 token: token to be sent to the enclave
         """
         # print("Client is encrypting insert query predicate...")
-        gamma = random_binary_string(self.gamma_len)
-        t_add_msg = str(partkey) + "|" + gamma + "|" + json.dumps(f_new)
-        self.k0 = self.F1.encrypt(str(self.s))
+        gamma = random_gamma(self.gamma_len, self.gamma_rng)
+        t_add_msg = str(partkey) + "|" + str(gamma) + "|" + json.dumps(f_new)
+        self.k0 = self.F1.encrypt(session_msg(self.s, self.client_id))
         token_encoder = self.prf(self.k0)
         token = token_encoder.encrypt(t_add_msg)
         return token
 
 
-    def dec_enclave_msg(self, R, res_batch):
+    def add_batch_token(self, items):
+        """
+            function to encrypt the values of many partkeys into one insert token
+            args:
+                items: dict or iterable of (partkey, values), values as ints or digit strings
+            return:
+                token: token to be sent to Enclave.add_batch_query
+            note:
+                the values travel as one base64 int64 array, so the enclave parses no
+                number strings; each partkey gets its own mask
+        """
+        items = list(items.items()) if isinstance(items, dict) else list(items)
+        arrays = [np.asarray(values).astype(np.int64).ravel() for _, values in items]
+        gammas = random_gammas(len(items), self.gamma_len, self.gamma_rng)
+        values = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64)
+        t_add_msg = json.dumps({
+            "partkeys": [int(partkey) for partkey, _ in items],
+            "gammas": gammas.tolist(),
+            "counts": [len(a) for a in arrays],
+            "values": base64.b64encode(values.astype("<i8").tobytes()).decode("utf-8"),
+        })
+        self.k0 = self.F1.encrypt(session_msg(self.s, self.client_id))
+        return self.prf(self.k0).encrypt(t_add_msg)
+
+
+    def dec_add_batch_result(self, results):
+        """
+            function to record the blocks written by a batch insert
+            args:
+                results: dict partkey -> (new_blocks, pad_lens, start), from Enclave.add_batch_query
+        """
+        for partkey, (new_blocks, pad_lens, start) in results.items():
+            self.dec_add_result(partkey, new_blocks, pad_lens, start)
+
+
+    def dec_add_result(self, partkey, new_blocks, pad_lens, start=None):
+        """
+            function to record the blocks written by an insert
+            args:
+                partkey: key that received new values
+                new_blocks: list of the new (V, gamma), as returned by Enclave.add_query
+                pad_lens: number of padded values in each new block
+                start: index of the first new block, as returned by Enclave.add_query;
+                       the blocks from there on are replaced (the buffered tail of the
+                       partkey), None to append
+            actions:
+                - extend the pad lengths of the partkey
+                - append the decrypted blocks to the results if the partkey was queried
+        """
+        if start is not None:
+            del self.pad_len[partkey][start:]
+        self.pad_len[partkey].extend(pad_lens)
+        if partkey in self.Qres:
+            if start is not None:
+                del self.Qres[partkey][start:]
+                del self.Qres_undec[partkey][start:]
+            for (V, gamma), num_pad in zip(new_blocks, pad_lens):
+                self.Qres_undec[partkey].append(V)
+                plaintext = (V ^ gamma)[: self.p - num_pad]
+                self.Qres[partkey].append(plaintext)
+
+
+    def compaction_savings(self):
+        """
+            function to get, for each partkey, the number of blocks that repacking its
+            real values into full blocks would save
+        """
+        return {partkey: len(pads) - -(-sum(self.p - pad for pad in pads) // self.p) for partkey, pads in self.pad_len.items()}
+
+
+    def compact_token(self, partkeys=None, min_saving=1):
+        """
+            function to encrypt a compaction query, for Enclave.compact_query
+            args:
+                partkeys: keys to compact, by default those where it saves min_saving blocks
+                min_saving: number of blocks a partkey must save to be compacted by default
+            return:
+                token: token carrying the pad lengths of the partkeys
+        """
+        if partkeys is None:
+            partkeys = [partkey for partkey, saving in self.compaction_savings().items() if saving >= min_saving]
+        msg = json.dumps({"pads": {str(partkey): self.pad_len[partkey] for partkey in partkeys}})
+        self.k0 = self.F1.encrypt(session_msg(self.s, self.client_id))
+        return self.prf(self.k0).encrypt(msg)
+
+
+    def dec_compact_result(self, results):
+        """
+            function to record the pad lengths of compacted partkeys
+            args:
+                results: dict partkey -> new pad lengths, from Enclave.compact_query
+            actions:
+                - replace the pad lengths of each partkey
+                - drop its query results, whose blocks no longer match
+        """
+        for partkey, pads in results.items():
+            self.pad_len[partkey] = list(pads)
+            self.Qres.pop(partkey, None)
+            self.Qres_undec.pop(partkey, None)
+
+
+    def dec_enclave_msgs(self, results):
+        """
+            function to decrypt the results of a batch of queries from Enclave.search_queries
+            args:
+                results: list of (res_batch, R), in the order of the tokens
+            return:
+                list of the total match counts n, one per query
+        """
+        return [self.dec_enclave_msg(R, res_batch, k0) for (res_batch, R), k0 in zip(results, self.k0_batch)]
+
+
+    @METRICS.section("client_decrypt_seconds")
+    def dec_enclave_msg(self, R, res_batch, k0=None):
         """
             function to decrypt the results fetched by the enclave
             args:
                 R: encrypted result size
                 res_batch: result batch for the current query
+                k0: session key of the query, the one of the last enc_token if None
             actions:
                 - decrypt the result size and result batch
-                - unpad the decrypted blocks to get cleartext results without padded values
+                - unpad the decrypted blocks into the query results Qres
+            return:
+                total number of matched partkeys n
         """
-        # decrypt result size
-        R_decoder = self.prf(self.k0)
-        R = R_decoder.decrypt(R)
-        # v_q = int(R.split('|')[0])
-        n = int(R.split('|')[1])
-
-        print(f"Current batch has {len(res_batch)} partkeys, from partkey {min(res_batch.keys())} to partkey {max(res_batch.keys())}")
-        
-        # for each of the partkeys, decrypt the blocks associated with that partkey
-        for partkey in res_batch:
-            if partkey not in self.Qres:
-                self.Qres[partkey] = []
-                self.Qres_undec[partkey] = []
-                for res in res_batch[partkey]:
-                    V_star = res[0]
-                    gamma_star = res[1]
-                    plaintext = [ciphertext ^ int(gamma_star, 2) for ciphertext in V_star]
-                    self.Qres[partkey].append(plaintext)
-                    self.Qres_undec[partkey].append(V_star)
-
-        # unpad the blocks of all partkeys
-        for partkey in self.Qres:
-            if partkey not in self.unpadded_keys:
-                pad_history = self.pad_len[partkey]
-                c = 0
-                for block, pad_num in zip(self.Qres[partkey], pad_history):
-                    unpadded_block = block[: self.p - pad_num]
-                    self.Qres[partkey][c] = unpadded_block
-                    c += 1
-                self.unpadded_keys.append(partkey)
+        n, results = self.dec_enclave_stream(R, res_batch, k0)
+        for _ in results:
+            pass
         return n
 
-    
\ No newline at end of file
+
+    def dec_enclave_stream(self, R, res_batch, k0=None):
+        """
+            function to decrypt the results fetched by the enclave one partkey at a time
+            args:
+                R: encrypted result size
+                res_batch: result batch for the current query
+                k0: session key of the query, the one of the last enc_token if None
+            return:
+                n: total number of matched partkeys
+                results: generator of (partkey, int64 array of its values), which decrypts
+                         and unpads each partkey only when it is reached
+        """
+        # decrypt result size, and the current pad lengths of the result partkeys
+        R = self.prf(k0 or self.k0).decrypt(R).split('|', 2)
+        # v_q = int(R[0])
+        n = int(R[1])
+        if len(R) > 2:
+            # another client may have inserted or compacted since
+            for partkey, pads in json.loads(R[2]).items():
+                self.pad_len[int(partkey)] = pads
+
+        if logger.isEnabledFor(logging.DEBUG) and res_batch:
+            logger.debug("query results", extra={"fields": {"client_id": self.client_id, "partkeys": len(res_batch), "first": min(res_batch), "last": max(res_batch), "total": n}})
+        if METRICS.enabled:
+            METRICS.inc("blocks_decrypted", sum(len(res) for res in res_batch.values()))
+        return n, self.__iter_results(res_batch)
+
+
+    def __iter_results(self, res_batch):
+        for partkey, res in res_batch.items():
+            yield partkey, self.dec_partkey(partkey, res)
+
+
+    def dec_partkey(self, partkey, res):
+        """
+            function to decrypt and unpad the blocks returned for a partkey
+            args:
+                partkey: key of the blocks
+                res: list of (V_star, gamma_star) blocks, as in a result batch
+            actions:
+                - unmask all blocks in one XOR and drop their padded values
+                - keep the blocks in the query results, evicting the oldest (or least
+                  recently used) partkey past max_results
+            return:
+                int64 array of the values of the partkey
+        """
+        if not res:
+            self.__remember(partkey, [], [])
+            return np.empty(0, dtype=np.int64)
+        V_star = np.stack([V for V, _ in res])
+        blocks = V_star ^ np.array([gamma for _, gamma in res], dtype=np.int64)[:, None]
+        pads = np.zeros(len(res), dtype=np.int64)
+        pad_history = self.pad_len[partkey][: len(res)]
+        pads[: len(pad_history)] = pad_history
+        lens = self.p - pads
+        values = blocks[np.arange(self.p) < lens[:, None]]
+        self.__remember(partkey, np.split(values, np.cumsum(lens)[:-1]), list(V_star))
+        return values
+
+
+    def __remember(self, partkey, plain_blocks, cipher_blocks):
+        self.Qres.pop(partkey, None)
+        self.Qres_undec.pop(partkey, None)
+        self.Qres[partkey] = plain_blocks
+        self.Qres_undec[partkey] = cipher_blocks
+        while self.max_results is not None and len(self.Qres) > self.max_results:
+            self.Qres.popitem(last=False)
+            self.Qres_undec.popitem(last=False)
+
+
+    def get_result(self, partkey, cipher=False):
+        """
+            function to look up the kept query result of a partkey
+            args:
+                partkey: key returned by a recent query
+                cipher: return the ciphertext blocks instead of the plaintext values
+            return:
+                int64 array of the values (or list of ciphertext blocks); KeyError if the
+                partkey was not returned or was evicted
+        """
+        blocks = (self.Qres_undec if cipher else self.Qres)[partkey]
+        if self.lru:
+            self.Qres.move_to_end(partkey)
+            self.Qres_undec.move_to_end(partkey)
+        if cipher:
+            return blocks
+        return np.concatenate(blocks) if blocks else np.empty(0, dtype=np.int64)
+
+
+def _release(shms):
+    """
+        function to close and unlink the shared memory blocks of a shard
+    """
+    for shm in shms.values():
+        shm.close()
+        shm.unlink()
+
+
+def _build_shard(p, k1, k2, prf, gamma_len, shard, layout):
+    """
+        worker of Client.build_parallel: encrypt a shard of partkeys into its shared buffers
+        args:
+            shard: list of (partkey, values)
+            layout: name -> (shared memory name, shape, dtype) of the output buffers
+        return:
+            list of (partkey, number of blocks, pad length of the last block)
+    """
+    client = Client(p, k1, k2, prf, gamma_len)
+    shms = {name: shared_memory.SharedMemory(name=shm_name) for name, (shm_name, _, _) in layout.items()}
+    try:
+        out = {name: np.ndarray(shape, dtype=dtype, buffer=shms[name].buf) for name, (_, shape, dtype) in layout.items()}
+        label_width = out["labels"].shape[1]
+        meta = []
+        labels = []
+        pos = 0
+        for partkey, records in shard:
+            L_list, V_blocks, gammas, pad_len = client.encrypt_records(partkey, records, raw_labels=True)
+            n = len(L_list)
+            out["values"][pos : pos + n] = V_blocks
+            out["gammas"][pos : pos + n] = gammas
+            labels.extend(L_list)
+            meta.append((partkey, n, pad_len))
+            pos += n
+        label_lens = np.fromiter(map(len, labels), dtype=np.int64, count=len(labels))
+        if len(labels) and label_lens.max() > label_width:
+            raise ValueError("label of {} bytes does not fit in label_width={}".format(label_lens.max(), label_width))
+        out["label_lens"][:] = label_lens
+        out["labels"][:] = np.frombuffer(b"".join(L.ljust(label_width, b"\0") for L in labels), dtype=np.uint8).reshape(-1, label_width)
+        del out
+        return meta
+    finally:
+        for shm in shms.values():
+            shm.close()
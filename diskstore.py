@@ -0,0 +1,345 @@
+import os
+import struct
+import numpy as np
+from logs import get_logger
+from untrusted import label_key
+
+
+logger = get_logger("storage")
+
+
+MAGIC = b"HXLVSTOR"
+HEADER = struct.Struct("<8sqqqq")      # magic, version, p, label_width, count
+HEADER_SIZE = 64
+VERSION = 1
+OP_SET = 1
+OP_DEL = 2
+
+
+def write_store(path, Imm, p, label_width=48):
+    """
+        function to save an untrusted L-V store in the on-disk format
+        args:
+            path: file to write, the append log next to it is removed
+            Imm: UntrustedStorage or ColumnarStorage to save
+            p: block size
+            label_width: width of the label keys in bytes
+        format:
+            64-byte header, then the count label keys sorted bytewise, then the count
+            gammas (int64), then the count blocks (int64[p]), all little-endian
+    """
+    labels, values, gammas = Imm.to_arrays(p, label_width)
+    write_arrays(path, labels, values, gammas)
+    if os.path.exists(path + ".log"):
+        os.remove(path + ".log")
+
+
+def write_arrays(path, labels, values, gammas):
+    """
+        function to write (labels, values, gammas) arrays sorted by label, atomically
+    """
+    count, label_width = labels.shape
+    p = values.shape[1]
+    order = np.argsort(labels.view("S{}".format(label_width)).ravel(), kind="stable")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, p, label_width, count).ljust(HEADER_SIZE, b"\0"))
+        f.write(np.ascontiguousarray(labels[order]).tobytes())
+        f.write(np.ascontiguousarray(gammas[order], dtype="<i8").tobytes())
+        f.write(np.ascontiguousarray(values[order], dtype="<i8").tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class MappedStorage(object):
+    """
+        untrusted storage served from a memory-mapped file written by write_store
+        reads go straight to the mapping (binary search over the sorted labels, blocks
+        returned as zero-copy read-only views); set_block/del_block are appended to
+        <path>.log and folded back into the file by compact()
+    """
+    def __init__(self, path, compact_threshold=None):
+        self.path = path
+        self.log_path = path + ".log"
+        self.compact_threshold = compact_threshold      # log records before an automatic compact
+        self.overlay = {}                               # storage of (label, (V, gamma) or None) from the log
+        self.log_records = 0                            # number of records in the append log
+        self.__map()
+        self.__replay_log()
+        self.log = open(self.log_path, "ab")
+
+
+    def __map(self):
+        """
+            function to map the base file: header, sorted labels, gammas and blocks
+        """
+        with open(self.path, "rb") as f:
+            magic, version, p, label_width, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} L-V store".format(self.path, VERSION))
+        self.p = p
+        self.label_width = label_width
+        self.count = count
+        self.record = struct.Struct("<B{}sq{}q".format(label_width, p))     # log record: op, label, gamma, V
+        if count == 0:
+            self.labels = np.zeros(0, dtype="S{}".format(label_width))
+            self.gammas = np.zeros(0, dtype="<i8")
+            self.values = np.zeros((0, p), dtype="<i8")
+            return
+        offset = HEADER_SIZE
+        self.labels = np.memmap(self.path, dtype="S{}".format(label_width), mode="r", offset=offset, shape=(count,))
+        offset += count * label_width
+        self.gammas = np.memmap(self.path, dtype="<i8", mode="r", offset=offset, shape=(count,))
+        offset += count * 8
+        self.values = np.memmap(self.path, dtype="<i8", mode="r", offset=offset, shape=(count, p))
+
+
+    def __replay_log(self):
+        """
+            function to load the append log into the in-memory overlay, dropping a torn
+            trailing record left by a crash
+        """
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "rb") as f:
+            data = f.read()
+        size = self.record.size
+        whole = len(data) - len(data) % size
+        for offset in range(0, whole, size):
+            op, key, gamma, *V = self.record.unpack_from(data, offset)
+            key = key.ljust(self.label_width, b"\0")
+            if op == OP_SET:
+                self.overlay[key] = (np.array(V, dtype=np.int64), gamma)
+            else:
+                self.overlay[key] = None
+        self.log_records = whole // size
+        if whole != len(data):
+            with open(self.log_path, "r+b") as f:
+                f.truncate(whole)
+
+
+    def __base_slot(self, key):
+        """
+            function to binary-search the mapped labels for a key
+            return: record index, or -1 if the key is not in the base file
+        """
+        i = int(np.searchsorted(self.labels, key))
+        if i < self.count and self.labels[i] == key.rstrip(b"\0"):
+            return i
+        return -1
+
+
+    def __len__(self):
+        live = self.count
+        for key, entry in self.overlay.items():
+            in_base = self.__base_slot(key) >= 0
+            live += (entry is not None) - in_base
+        return live
+
+
+    def __contains__(self, L):
+        key = label_key(L, self.label_width)
+        if key in self.overlay:
+            return self.overlay[key] is not None
+        return self.__base_slot(key) >= 0
+
+
+    def get_block(self, L):
+        """
+            function to get ciphertext block from pseudo-label
+            args: 
+                L: pseudo-label of the block
+            return:
+                V: ciphertext block, a read-only view of the mapping for unmodified blocks
+                gamma: the integer to decrypt V
+        """
+        key = label_key(L, self.label_width)
+        if key in self.overlay:
+            entry = self.overlay[key]
+            if entry is not None:
+                return entry
+        else:
+            i = self.__base_slot(key)
+            if i >= 0:
+                return self.values[i], int(self.gammas[i])
+        logger.warning("Pseudo-label is not correct. Cannot access the cipher block!")
+
+
+    def set_block(self, L, V_new, gamma_new):
+        """
+            function to set new value for a ciphertext block
+            args:
+                L: pseudo-label of the block
+                V_new: list of new values for the block
+                gamma_new: integer mask of the block
+        """
+        key = label_key(L, self.label_width)
+        V_new = np.asarray(V_new, dtype=np.int64)
+        self.log.write(self.record.pack(OP_SET, key, int(gamma_new), *V_new.tolist()))
+        self.overlay[key] = (V_new, int(gamma_new))
+        self.__logged()
+
+
+    def del_block(self, L):
+        """
+            function to delete a block from the storage using its label
+            args:
+                L: label of the deleted block
+        """
+        key = label_key(L, self.label_width)
+        if not self.__contains__(key):
+            logger.warning("Wrong label, cannot delete cipherblock.")
+            return
+        self.log.write(self.record.pack(OP_DEL, key, 0, *([0] * self.p)))
+        self.overlay[key] = None
+        self.__logged()
+
+
+    def multi_get(self, L_list):
+        """
+            function to get the ciphertext blocks of several pseudo-labels at once; labels
+            not in the log overlay are binary-searched in the mapping in one call
+            args:
+                L_list: pseudo-labels of the blocks
+            return:
+                list of (V, gamma), None for a label that is not stored
+        """
+        keys = [label_key(L, self.label_width) for L in L_list]
+        res = [None] * len(keys)
+        base = []           # indices of the keys to look up in the base file
+        for i, key in enumerate(keys):
+            if key in self.overlay:
+                res[i] = self.overlay[key]
+            else:
+                base.append(i)
+        if base and self.count:
+            probe = np.array([keys[i] for i in base], dtype="S{}".format(self.label_width))
+            idx = np.searchsorted(self.labels, probe)
+            found = idx < self.count
+            found[found] &= self.labels[idx[found]] == probe[found]
+            for i, j, ok in zip(base, idx.tolist(), found.tolist()):
+                if ok:
+                    res[i] = (self.values[j], int(self.gammas[j]))
+        if any(entry is None for entry in res):
+            logger.warning("Pseudo-label is not correct. Cannot access the cipher block!")
+        return res
+
+
+    def multi_set(self, L_list, V_blocks, gammas):
+        """
+            function to set several ciphertext blocks at once, with one write to the log
+            args:
+                L_list: pseudo-labels of the blocks
+                V_blocks: new blocks, a (len(L_list), p) array or a list of blocks
+                gammas: integer masks of the blocks
+        """
+        V_blocks = np.asarray(V_blocks, dtype=np.int64).reshape(len(L_list), self.p)
+        records = []
+        for L, V, gamma in zip(L_list, V_blocks, gammas):
+            key = label_key(L, self.label_width)
+            records.append(self.record.pack(OP_SET, key, int(gamma), *V.tolist()))
+            self.overlay[key] = (V, int(gamma))
+        self.log.write(b"".join(records))
+        self.__logged(len(records))
+
+
+    def multi_del(self, L_list):
+        """
+            function to delete several blocks at once, with one write to the log
+            args:
+                L_list: labels of the deleted blocks
+            return:
+                number of blocks deleted
+        """
+        records = []
+        for L in L_list:
+            key = label_key(L, self.label_width)
+            if not self.__contains__(key):
+                logger.warning("Wrong label, cannot delete cipherblock.")
+                continue
+            records.append(self.record.pack(OP_DEL, key, 0, *([0] * self.p)))
+            self.overlay[key] = None
+        self.log.write(b"".join(records))
+        self.__logged(len(records))
+        return len(records)
+
+
+    def __logged(self, records=1):
+        self.log_records += records
+        if self.compact_threshold is not None and self.log_records >= self.compact_threshold:
+            self.compact()
+
+
+    def flush(self):
+        """
+            function to push buffered log records to the operating system
+        """
+        self.log.flush()
+
+
+    def compact(self):
+        """
+            function to fold the append log into a new base file and empty the log
+        """
+        keys = list(self.overlay)
+        keep = np.ones(self.count, dtype=bool)
+        if keys and self.count:
+            probe = np.array(keys, dtype="S{}".format(self.label_width))
+            idx = np.searchsorted(self.labels, probe)
+            found = idx < self.count
+            found[found] &= self.labels[idx[found]] == probe[found]
+            keep[idx[found]] = False
+        live = [(key, entry) for key, entry in self.overlay.items() if entry is not None]
+
+        n_base = int(keep.sum())
+        labels = np.zeros((n_base + len(live), self.label_width), dtype=np.uint8)
+        values = np.zeros((len(labels), self.p), dtype=np.int64)
+        gammas = np.zeros(len(labels), dtype=np.int64)
+        labels[:n_base] = np.frombuffer(self.labels[keep].tobytes(), dtype=np.uint8).reshape(n_base, self.label_width)
+        values[:n_base] = self.values[keep]
+        gammas[:n_base] = self.gammas[keep]
+        for i, (key, (V, gamma)) in enumerate(live, n_base):
+            labels[i] = np.frombuffer(key, dtype=np.uint8)
+            values[i] = V
+            gammas[i] = gamma
+
+        # drop the mapping before the file is replaced
+        self.log.close()
+        self.labels = self.gammas = self.values = None
+        write_arrays(self.path, labels, values, gammas)
+        self.log = open(self.log_path, "wb")
+        self.overlay = {}
+        self.log_records = 0
+        self.__map()
+
+
+    def close(self):
+        self.log.close()
+
+
+    def nbytes(self):
+        """
+            function to get the resident memory of the storage (the log overlay);
+            the mapped file is paged in by the operating system on demand
+        """
+        return sum(V.nbytes + 64 for V, _ in filter(None, self.overlay.values())) + 64 * len(self.overlay)
+
+
+    def disk_bytes(self):
+        """
+            function to get the size on disk of the base file and append log
+        """
+        size = os.path.getsize(self.path)
+        if os.path.exists(self.log_path):
+            size += os.path.getsize(self.log_path)
+        return size
+
+
+    def to_arrays(self, p=None, label_width=None):
+        """
+            function to export the stored blocks as (labels, values, gammas) arrays
+        """
+        self.compact()
+        labels = np.frombuffer(self.labels.tobytes(), dtype=np.uint8).reshape(self.count, self.label_width)
+        return labels, np.asarray(self.values), np.asarray(self.gammas)
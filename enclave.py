@@ -1,12 +1,24 @@
 import time
+import threading
 import json
+import base64
+import logging
 import random
+import numpy as np
 from node import Node
-from utils import random_binary_string
+from index import OrderedIndex
+from utils import random_gammas, session_msg
+from metrics import METRICS
+from logs import get_logger
+from writeback import WriteBackWorker
+from appendbuffer import AppendBuffer
+
+
+logger = get_logger("enclave")
 
 
 class Enclave(object):
-    def __init__(self, p, k1, k2, prf, node_list):
+    def __init__(self, p, k1, k2, prf, node_list, gamma_len=4, gamma_rng=None):
         self.p = p                      # fixed size of each ciphertext block
         self.k1 = k1                    # secret key 1
         self.k2 = k2                    # secret key 2
@@ -15,172 +27,553 @@ class Enclave(object):
         self.G1 = prf(k1)
         self.G2 = prf(k2)
         self.node_list = node_list      # list of all nodes to build tree
-        self.tree = None                # empty tree
+        self.gamma_len = gamma_len      # number of bits of the random masks
+        self.gamma_rng = gamma_rng      # optional seeded GammaDRBG, OS randomness if None
+        self.tree = OrderedIndex()      # empty ordered index
         self.s = 0                      # query session number
+        self.sessions = {}              # storage of (client_id, session number) of named clients
+        self.writeback = None           # background write-back worker, if enabled
+        self.appends = None             # append buffer coalescing small inserts, if enabled
+        self.imm_lock = threading.Lock()            # guards the untrusted storage, shared with the write-back worker and concurrent prefetches
+        self.prefetching = set()        # partkeys read by a planned query that is not finished yet
         self.__build_tree()             # build tree inside the constructor
 
-    def reset_query_sess(self):
+    def reset_query_sess(self, client_id=None):
         """
             function to reset query session
+            args:
+                client_id: client whose counter is reset, the shared counter if None
         """
-        self.s = 0
+        if client_id is None:
+            self.s = 0
+        else:
+            self.sessions.pop(client_id, None)
 
 
-    def __build_tree(self):
+    def session_number(self, client_id=None):
         """
-            function to build the enclave binary tree
+            function to get the next query session number of a client
         """
-        for N in self.node_list:
-            if self.tree is None:
-                self.tree = N
-                self.root = N
+        if client_id is None:
+            return self.s
+        return self.sessions.get(client_id, 0)
+
+
+    def session_keys(self, count=1, client_id=None, advance=True):
+        """
+            function to derive the next session keys k0 of a client in one PRF call
+            args:
+                count: number of sessions
+                client_id: client owning the counter, the shared counter if None
+                advance: move the counter past the sessions (inserts reuse the next key)
+        """
+        s = self.session_number(client_id)
+        k0_list = self.F1.encrypt_many([session_msg(s + i, client_id) for i in range(count)])
+        if advance:
+            if client_id is None:
+                self.s = s + count
             else:
-                self.tree.insert(N)
+                self.sessions[client_id] = s + count
+        return k0_list
+
+
+    def __build_tree(self):
+        """
+            function to bulk-load the enclave ordered index from the node list
+        """
+        self.tree.bulk_load(self.node_list)
 
 
-    def traverse(self, root):
+    def traverse(self):
         """
-            function to traverse the entire binary tree
+            function to get all nodes of the index in partkey order
         """
-        nodes = []
-        if root is not None:
-            nodes = self.traverse(root.left)
-            nodes.append(root)
-            nodes = nodes + self.traverse(root.right)
-        return nodes
+        return list(self.tree)
 
 
     def search(self, partkey):
         """
-            function to search for a node in the tree given its partkey
+            function to search for a node in the index given its partkey
         """
-        if self.tree is None:
-            return None
-        else:
-            return self.tree.get_node(partkey)
+        return self.tree.get_node(partkey)
 
 
     def insert(self, node):
         """
-            function to insert a node into the enclave binary tree
+            function to insert a node into the enclave ordered index
         """
-        if self.tree is not None:
-            self.tree.insert(node)
+        self.tree.insert(node)
 
 
-    def __dec_token(self, token):
+    def start_writeback(self, Imm):
+        """
+            function to switch evictions to asynchronous write-back by a background worker
+            args:
+                Imm: untrusted server the worker writes to
+        """
+        if self.writeback is None:
+            self.writeback = WriteBackWorker(self, Imm)
+        return self.writeback
+
+
+    def stop_writeback(self):
+        """
+            function to drain the write-back queue and go back to synchronous rebuilds
+            note:
+                if a write fails, the error is raised and write-back stays enabled: the
+                worker keeps retrying, and queries can still reclaim its queued blocks
+        """
+        if self.writeback is not None:
+            self.writeback.stop()
+            self.writeback = None
+
+
+    def start_appends(self, max_values=65536, max_age=60.0):
+        """
+            function to buffer inserted values that do not fill a block, so that small
+            inserts to a partkey are coalesced into full blocks
+            args:
+                max_values: values held before the oldest tails are flushed
+                max_age: seconds a tail is held before it is flushed
+        """
+        if self.appends is None:
+            self.appends = AppendBuffer(self.p, max_values, max_age)
+        return self.appends
+
+
+    def stop_appends(self, Imm, Qsgx):
+        """
+            function to flush every buffered tail and go back to unbuffered inserts
+        """
+        if self.appends is not None:
+            self.flush_appends(Imm, Qsgx)
+            self.appends = None
+
+
+    def flush_appends(self, Imm, Qsgx, force=True):
+        """
+            function to write buffered tails as padded blocks
+            args:
+                Imm: untrusted server
+                Qsgx: enclave cache
+                force: flush every tail, else only those past the age or size threshold
+            return:
+                number of tails flushed
+        """
+        if self.appends is None:
+            return 0
+        partkeys = list(self.appends.tails) if force else self.appends.due()
+        for partkey in partkeys:
+            gamma = int(random_gammas(1, self.gamma_len, self.gamma_rng)[0])
+            new_blocks_L, _ = self.addData(partkey, gamma, self.appends.pop(partkey), Imm)
+            if partkey in Qsgx.kL_store:
+                self.cache_new_blocks(partkey, new_blocks_L, Imm, Qsgx)
+        self.appends.flushed += len(partkeys)
+        if METRICS.enabled and partkeys:
+            METRICS.inc("tails_flushed", len(partkeys))
+        return len(partkeys)
+
+
+    def save_state(self, path, Qsgx=None):
+        """
+            function to snapshot the enclave index and session counter to a binary file
+            args:
+                path: file to write
+                Qsgx: enclave cache, must be empty (rebuilt) so that the persisted
+                      untrusted store holds every block
+            note:
+                keys are not saved, the restoring enclave is constructed with them
+        """
+        if self.writeback is not None:
+            self.writeback.drain()
+        if Qsgx is not None and len(Qsgx.kL_store):
+            raise ValueError("cache holds {} partkeys, rebuild it before saving the enclave state".format(len(Qsgx.kL_store)))
+        if self.appends is not None and len(self.appends):
+            raise ValueError("append buffer holds {} partkeys, flush it before saving the enclave state".format(len(self.appends)))
+        partkeys = np.array(self.tree.partkeys, dtype=np.int64)
+        c = np.array([N.c for N in self.tree], dtype=np.int64)
+        t = np.array([N.t for N in self.tree], dtype=np.int64)
+        session_ids = np.array(list(self.sessions.keys()), dtype=str)
+        session_s = np.array(list(self.sessions.values()), dtype=np.int64)
+        arrays = {}
+        if all(N.pads is not None for N in self.tree):
+            arrays["pads"] = np.fromiter((pad for N in self.tree for pad in N.pads), dtype=np.int64, count=int(c.sum()))
+        with open(path, "wb") as f:
+            np.savez(f, p=self.p, s=self.s, partkeys=partkeys, c=c, t=t, num_blocks=c.sum(), session_ids=session_ids, session_s=session_s, **arrays)
+
+
+    def load_state(self, path, Imm=None):
+        """
+            function to restore the enclave index and session counter saved by save_state
+            args:
+                path: file written by save_state
+                Imm: optional untrusted store, checked to hold exactly the indexed blocks
+        """
+        with np.load(path) as state:
+            if int(state["p"]) != self.p:
+                raise ValueError("state was saved with p={}, enclave has p={}".format(int(state["p"]), self.p))
+            if Imm is not None and len(Imm) != int(state["num_blocks"]):
+                raise ValueError("untrusted store holds {} blocks, enclave state indexes {}".format(len(Imm), int(state["num_blocks"])))
+            self.s = int(state["s"])
+            if "session_ids" in state:
+                self.sessions = dict(zip(state["session_ids"].tolist(), state["session_s"].tolist()))
+            c = state["c"]
+            # states saved before the enclave tracked pad lengths have none
+            pads = np.split(state["pads"], np.cumsum(c)[:-1]) if "pads" in state and len(c) else [None] * len(c)
+            self.node_list = [Node(partkey, count, t, None if pad is None else pad.tolist()) for partkey, count, t, pad in zip(state["partkeys"].tolist(), c.tolist(), state["t"].tolist(), pads)]
+        self.tree.load_sorted(self.node_list)
+
+
+    def __dec_token(self, token, client_id=None):
         """
             function to decrypt query token from the client
+            return:
+                raw: decrypted query predicate
+                k0: session key of the query
         """
         # print("Enclave decrypting token from client...")
-        self.k0 = self.F1.encrypt(str(self.s))
-        token_decoder = self.prf(self.k0)
+        k0 = self.session_keys(1, client_id)[0]
+        token_decoder = self.prf(k0)
         raw = token_decoder.decrypt(token)
-        self.s += 1
-        return raw
+        return raw, k0
 
 
-    def __get_match_nodes(self, token):
+    def __get_match_nodes(self, token, client_id=None):
         """
             fucntion to get matched nodes from the query predicate
+            return:
+                match_nodes, n, cmp and the session key k0 of the query
         """
         # decrypt token from the client
-        query = self.__dec_token(token)
+        query, k0 = self.__dec_token(token, client_id)
+        v_query, cmp, q = self.__parse_query(query)
+        match_nodes, n = self.__match(v_query, cmp, q)
+        return match_nodes, n, cmp, k0
+
+
+    @staticmethod
+    def __parse_query(query):
+        """
+            function to split a decrypted query predicate into (v_query, cmp, q)
+        """
         v_query = int(query.split('=')[0][:-1])
         cmp = query.split('=')[0][-1] + '='
-        self.cmp = cmp
         q = int(query.split('=')[1])
+        return v_query, cmp, q
+
 
+    def __match(self, v_query, cmp, q):
+        """
+            function to get the first q matched nodes and the total match count n
+            note:
+                a predicate out of the partkey range, or with q < 1, matches no node and
+                gets n = 0
+        """
         # print("Enclave is getting match nodes...")
-        all_nodes = self.traverse(self.root)
-        all_partkeys = [node.partkey for node in all_nodes]
-
-        # exception handling for the validity of the query predicate
-        try:                  # if v_query can match exactly
-            match_idx = all_partkeys.index(v_query)
-        except ValueError:    # if v_query cannot match exactly
-            if v_query < all_partkeys[0] and cmp == ">=":
-                match_idx = 0
-            elif v_query > all_partkeys[-1] and cmp == "<=":
-                match_idx = len(all_partkeys) - 1
-            else:
-                match_idx = [i for i in range(len(all_partkeys)-1) if all_partkeys[i] < v_query and all_partkeys[i+1] > v_query][0]
-                if cmp == ">=":
-                    match_idx += 1
+        if q < 1:
+            return [], 0
         if cmp == ">=":
-            n = len(all_nodes) - match_idx
-            match_nodes = all_nodes[match_idx : match_idx + q]
+            match_nodes, n = self.tree.range_ge(v_query, q)
         elif cmp == "<=":
-            n = match_idx + 1
-            left_idx = max(0, match_idx - q + 1)
-            match_nodes = all_nodes[left_idx : match_idx+1]
+            match_nodes, n = self.tree.range_le(v_query, q)
         return match_nodes, n
 
 
-    def search_query(self, token, Imm, Qsgx):
+    def __result_size(self, k0, cmp, match_nodes, n):
+        """
+            function to encrypt the result size message R of a query with its session key
+            note:
+                R also carries the pad lengths of the matched partkeys, so that a client
+                unpads them correctly after inserts or compactions by other clients
+        """
+        if not match_nodes:
+            v_q = ""        # nothing matched, n = 0
+        elif cmp == ">=":
+            v_q = match_nodes[-1].partkey
+        else:
+            v_q = match_nodes[0].partkey
+        msg = str(v_q) + "|" + str(n)
+        pads = {str(node.partkey): self.pads(node) for node in match_nodes if node.pads is not None}
+        if pads:
+            msg += "|" + json.dumps(pads, separators=(",", ":"))
+        R_encoder = self.prf(k0)
+        return R_encoder.encrypt(msg)
+
+
+    @METRICS.section("query_seconds")
+    def search_query(self, token, Imm, Qsgx, client_id=None):
         """
             function to execute search query
             args:
                 token: query token from client
                 Imm: untrusted storage
                 Qsgx: enclave cache
+                client_id: client whose session counter the token was made with
+            note:
+                runs the enclave and storage steps of the query (plan_query, prefetch,
+                finish_queries, release) one after the other; the query server runs the
+                storage steps outside its enclave lock
         """
-        match_nodes, n = self.__get_match_nodes(token)
-        print("Total number of match nodes:", len(match_nodes))
-        res_batch = {}     # to save the batch results
-
-        # process encrypted data for each matched nodes, fetch cipher blocks to client
-        for _, node in enumerate(match_nodes):
-            res_batch[node.partkey] = []
-            res_each_node = []
-
-            # if the current node is already in the cache, fetch from the cache
-            if node.partkey in Qsgx.kL_store.keys():   
-                L_list = Qsgx.kL_store[node.partkey]
-                for L in L_list:
-                    V, gamma = Qsgx.LVg_store[L]
-                    gamma_star = random_binary_string(4)
-                    V_star = [supp_key ^ int(gamma, 2) ^ int(gamma_star, 2) for supp_key in V]
-                    res_batch[node.partkey].append((V_star, gamma_star))
-
-            # if current node is not in cache, fetch blocks from untrusted storage
-            else:
-                if Qsgx.is_full():
-                    for partkey in Qsgx.kL_store:
-                        self.rebuild(partkey, Qsgx, Imm)
-                    Qsgx.clear()
-                c = 0
-                ci = self.tree.get_node(node.partkey).c
-                ti = self.tree.get_node(node.partkey).t
-                Qsgx.kL_store[node.partkey] = []
-                while c < ci:
-                    # get partkey label
-                    vi_c_ti = str(node.partkey) + "|" + str(c) + "|" + str(ti)
-                    L = self.G1.encrypt(vi_c_ti)
-                    # cache vi and label in Qsgx
-                    Qsgx.kL_store[node.partkey].append(L)
-                    # get block and gamma via Server.Fetch()
-                    V, gamma = self.fetch(L, Imm, Qsgx)
-                    res_each_node.append((L, V, gamma))
-                    c += 1
-                Qsgx.current_size += 1
-                # self.rebuild(node.partkey, Qsgx, Imm)
-                for res in res_each_node:
-                    gamma = res[2]
-                    V = res[1]
-                    gamma_star = random_binary_string(4)
-                    V_star = [supp_key ^ int(gamma, 2) ^ int(gamma_star, 2) for supp_key in V]
-                    res_batch[node.partkey].append((V_star, gamma_star))
-        
-        if self.cmp == ">=":
-            v_q = match_nodes[-1].partkey
+        plan = self.plan_query(token, Qsgx, client_id)
+        return self.finish_and_release(plan, self.prefetch(plan, Imm), Imm, Qsgx)[0]
+
+
+    @METRICS.section("query_batch_seconds")
+    def search_queries(self, tokens, Imm, Qsgx, client_id=None):
+        """
+            function to execute a batch of search queries at once
+            args:
+                tokens: query tokens from Client.enc_tokens, one session number each
+                Imm: untrusted storage
+                Qsgx: enclave cache
+                client_id: client whose session counter the tokens were made with
+            return:
+                list of (res_batch, R), one per token, as returned by search_query
+            note:
+                the session keys are derived in one PRF call, and a partkey matched by
+                several queries is loaded from the cache or untrusted storage only once;
+                each query still gets its own fresh masks
+        """
+        plan = self.plan_queries(tokens, Qsgx, client_id)
+        return self.finish_and_release(plan, self.prefetch(plan, Imm), Imm, Qsgx)
+
+
+    def plan_query(self, token, Qsgx, client_id=None):
+        """
+            function to run the enclave step of a query before any storage access:
+            decrypt the token, match the nodes and label the blocks to prefetch
+            return:
+                plan: (queries, wanted), for prefetch and finish_queries
+        """
+        match_nodes, n, cmp, k0 = self.__get_match_nodes(token, client_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("search query", extra={"fields": {"client_id": client_id, "cmp": cmp, "match_nodes": len(match_nodes)}})
+        return self.__plan([(k0, cmp, match_nodes, n)], Qsgx)
+
+
+    def plan_queries(self, tokens, Qsgx, client_id=None):
+        """
+            function to run the enclave step of a batch of queries before any storage
+            access, as plan_query
+        """
+        k0_list = self.session_keys(len(tokens), client_id)
+        queries = []
+        for token, k0 in zip(tokens, k0_list):
+            v_query, cmp, q = self.__parse_query(self.prf(k0).decrypt(token))
+            match_nodes, n = self.__match(v_query, cmp, q)
+            queries.append((k0, cmp, match_nodes, n))
+        return self.__plan(queries, Qsgx)
+
+
+    def __plan(self, queries, Qsgx):
+        """
+            function to list the matched partkeys that are neither cached, queued for
+            write-back nor read by another planned query, with the counters and labels
+            of their stored blocks
+            return:
+                (queries, wanted): wanted is a dict partkey -> (t, c, L_list)
+        """
+        nodes = {}
+        for _, _, match_nodes, _ in queries:
+            for node in match_nodes:
+                if node.partkey in Qsgx.kL_store or node.partkey in self.prefetching or (self.writeback is not None and node.partkey in self.writeback.queue):
+                    continue
+                nodes.setdefault(node.partkey, node)
+        self.prefetching.update(nodes)
+        msgs = [str(node.partkey) + "|" + str(c) + "|" + str(node.t) for node in nodes.values() for c in range(node.c)]
+        L_all = self.G1.encrypt_many(msgs) if msgs else []
+        wanted = {}
+        start = 0
+        for partkey, node in nodes.items():
+            wanted[partkey] = (node.t, node.c, L_all[start : start + node.c])
+            start += node.c
+        return queries, wanted
+
+
+    def prefetch(self, plan, Imm):
+        """
+            function to run the storage step of a query: read the blocks listed by the
+            plan in one multi_get, without deleting them or touching enclave state, so
+            that it can run while other requests use the enclave
+            return:
+                dict partkey -> (t, c, L_list, LVg_list), for finish_queries; empty if the
+                read failed, finish_queries then reads the blocks itself
+        """
+        _, wanted = plan
+        L_all = [L for _, _, L_list in wanted.values() for L in L_list]
+        if not L_all:
+            return {}
+        try:
+            with METRICS.timer("fetch_seconds"), self.imm_lock:
+                LVg_all = Imm.multi_get(L_all)
+        except Exception as e:
+            logger.warning("prefetch failed: %s: %s", type(e).__name__, e, extra={"fields": {"partkeys": len(wanted)}})
+            return {}
+        fetched = {}
+        start = 0
+        for partkey, (t, c, L_list) in wanted.items():
+            fetched[partkey] = (t, c, L_list, LVg_all[start : start + c])
+            start += c
+        return fetched
+
+
+    def finish_and_release(self, plan, fetched, Imm, Qsgx):
+        """
+            function to run finish_queries then release, releasing the blocks it cached
+            even if it fails
+        """
+        consumed = []
+        try:
+            return self.finish_queries(plan, fetched, Imm, Qsgx, consumed)
+        finally:
+            self.release(consumed, Imm)
+
+
+    def finish_queries(self, plan, fetched, Imm, Qsgx, consumed):
+        """
+            function to run the enclave step of queries after prefetch: cache the
+            prefetched blocks that are still current, load the others as usual, and
+            remask the results
+            args:
+                plan: from plan_query or plan_queries
+                fetched: from prefetch
+                consumed: list receiving the labels of the prefetched blocks cached, as
+                          soon as they are; release must delete them from the untrusted
+                          storage, also if this raises
+            return:
+                list of (res_batch, R), one per query
+        """
+        queries, wanted = plan
+        needed = {}        # storage of (partkey, node) over all queries
+        for _, _, match_nodes, _ in queries:
+            for node in match_nodes:
+                needed.setdefault(node.partkey, node)
+        try:
+            blocks = {partkey: self.load_node(node, Imm, Qsgx, fetched.get(partkey), consumed) for partkey, node in sorted(needed.items())}
+        finally:
+            self.prefetching.difference_update(wanted)
+
+        results = []
+        for k0, cmp, match_nodes, n in queries:
+            res_batch = {}
+            for node in match_nodes:
+                # re-mask all blocks of the node with fresh gammas in one XOR
+                res_each_node = blocks[node.partkey] + self.__tail(node.partkey)
+                V_star, gamma_star = self.remask([res[0] for res in res_each_node], [res[1] for res in res_each_node])
+                res_batch[node.partkey] = list(zip(V_star, gamma_star))
+            results.append((res_batch, self.__result_size(k0, cmp, match_nodes, n)))
+        return results
+
+
+    def release(self, L_list, Imm):
+        """
+            function to run the last storage step of a query: delete the blocks that
+            finish_queries moved to the cache
+            note:
+                deferring the delete is safe: once cached, a partkey is read from the
+                cache, and its blocks are written back under a new counter t
+        """
+        if L_list:
+            with self.imm_lock:
+                Imm.multi_del(L_list)
+
+
+    def pads(self, node):
+        """
+            function to get the pad lengths of the blocks a query returns for a node: its
+            stored blocks, then its buffered tail if any
+        """
+        if self.appends is None or node.partkey not in self.appends:
+            return node.pads
+        return node.pads + [self.p - len(self.appends.values(node.partkey))]
+
+
+    def __tail(self, partkey):
+        """
+            function to get the buffered values of a partkey as a list of at most one
+            padded, unmasked (V, 0) block, to be masked with the stored blocks
+        """
+        if self.appends is None or partkey not in self.appends:
+            return []
+        block, _ = self.get_new_V(self.appends.values(partkey))
+        return [(block[0], 0)]
+
+
+    def load_node(self, node, Imm, Qsgx, prefetched=None, consumed=None):
+        """
+            function to get the (V, gamma) blocks of a matched node, from the cache or
+            else from untrusted storage (caching them)
+            args:
+                node: matched node
+                Imm: untrusted storage
+                Qsgx: enclave cache
+                prefetched: optional (t, c, L_list, LVg_list) read by prefetch, used if
+                            the node still has that t and c and was not cached since
+                consumed: list receiving the labels of the prefetched blocks used, to be
+                          deleted by release; they are deleted here if None
+        """
+        res_each_node = []
+
+        # if the current node is already in the cache, fetch from the cache
+        if node.partkey in Qsgx.kL_store.keys():   
+            Qsgx.record_hit(node.partkey)
+            if METRICS.enabled:
+                METRICS.inc("cache_hits")
+            L_list = Qsgx.kL_store[node.partkey]
+            for L in L_list:
+                res_each_node.append(Qsgx.LVg_store[L])
+
+        # if current node is not in cache, fetch blocks from untrusted storage
         else:
-            v_q = match_nodes[0].partkey
-        msg = str(v_q) + "|" + str(n)
-        R_encoder = self.prf(self.k0)
-        R = R_encoder.encrypt(msg)
-        return res_batch, R
-    
+            if METRICS.enabled:
+                METRICS.inc("cache_misses")
+            # blocks still queued for write-back are taken back instead of fetched
+            reclaimed = self.writeback.reclaim(node.partkey) if self.writeback is not None else None
+            reclaimed = reclaimed or []
+            # prefetched blocks are current if the labels did not change since: blocks are
+            # only ever rewritten under a new t, and new ones change c
+            current = prefetched is not None and not reclaimed and prefetched[:2] == (node.t, node.c) and None not in prefetched[3]
+            # get all partkey labels in one batch
+            L_list = prefetched[2] if current else self.G1.encrypt_many([str(node.partkey) + "|" + str(c) + "|" + str(node.t) for c in range(node.c)])
+            self.make_room(Qsgx, Imm, len(L_list), sum(len(L) for L in L_list) + node.c * (8 * self.p + 8))
+            for L, LVg in zip(L_list, reclaimed):
+                Qsgx.LVg_store[L] = LVg
+            if current:
+                res_each_node = list(prefetched[3])
+                Qsgx.LVg_store.update(zip(L_list, res_each_node))
+                if METRICS.enabled:
+                    METRICS.inc("blocks_fetched", len(L_list))
+                    METRICS.inc("bytes_from_storage", len(L_list) * (8 * self.p + 8))
+                if consumed is not None:
+                    consumed.extend(L_list)
+                else:
+                    self.release(L_list, Imm)
+            else:
+                # get the other blocks and gammas via Server.Fetch() in one batch, caching them in Qsgx
+                res_each_node = list(reclaimed) + self.fetch_many(L_list[len(reclaimed) :], Imm, Qsgx)
+            Qsgx.admit(node.partkey, L_list)
+            # a partkey larger than the whole cache is written back right away
+            if Qsgx.over_budget():
+                self.retire(node.partkey, Qsgx, Imm)
+        return res_each_node
+
+
+    def remask(self, V_list, gamma_list):
+        """
+            function to swap the masks of a list of cipher blocks for fresh ones
+            args:
+                V_list: cipher blocks, each an int64 array of length p
+                gamma_list: integer masks of the blocks
+            return:
+                V_star: 2-D int64 array, row i is V_list[i] ^ gamma_list[i] ^ gamma_star[i]
+                gamma_star: list of the fresh integer masks
+        """
+        gamma_star = random_gammas(len(V_list), self.gamma_len, self.gamma_rng)
+        if not V_list:
+            return np.empty((0, self.p), dtype=np.int64), []
+        delta = np.array(gamma_list, dtype=np.int64) ^ gamma_star
+        return np.stack(V_list) ^ delta[:, None], gamma_star.tolist()
+
 
     def fetch(self, L, Imm, Qsgx):
         """
@@ -190,14 +583,106 @@ class Enclave(object):
                 Imm: untrusted server
                 Qsgx: enclave cache
         """
-        V, gamma = Imm.get_block(L)
+        with self.imm_lock:
+            V, gamma = Imm.get_block(L)
+            # delete the block from the untrusted storage
+            Imm.del_block(L)
         # cache L, V, gamma in Qsgx
         Qsgx.LVg_store[L] = (V, gamma)
-        # delete the block from the untrusted storage
-        Imm.del_block(L)
         return V, gamma
 
 
+    def fetch_many(self, L_list, Imm, Qsgx):
+        """
+            function to fetch several cipher blocks from untrusted storage with one
+            multi_get and one multi_del, caching them in Qsgx
+            args:
+                L_list: pseudo-labels of the blocks to be fetched
+                Imm: untrusted server
+                Qsgx: enclave cache
+            return:
+                list of (V, gamma), in the order of L_list
+        """
+        if not L_list:
+            return []
+        with METRICS.timer("fetch_seconds"), self.imm_lock:
+            LVg_list = Imm.multi_get(L_list)
+            Imm.multi_del(L_list)
+        if METRICS.enabled:
+            METRICS.inc("blocks_fetched", len(L_list))
+            METRICS.inc("bytes_from_storage", len(L_list) * (8 * self.p + 8))
+        Qsgx.LVg_store.update(zip(L_list, LVg_list))
+        return LVg_list
+
+
+    def make_room(self, Qsgx, Imm, blocks, nbytes):
+        """
+            function to evict cached partkeys until one more partkey of the given size
+            fits within the partkey, block and byte capacities of the cache
+            args:
+                Qsgx: enclave cache
+                Imm: untrusted server
+                blocks: number of blocks of the incoming partkey
+                nbytes: size of its (L, V, gamma) entries in bytes
+        """
+        while Qsgx.current_size and not Qsgx.fits(blocks, nbytes):
+            self.evict(Qsgx, Imm)
+
+
+    def cache_new_blocks(self, partkey, L_list, Imm, Qsgx):
+        """
+            function to keep the cache coherent after an insert: if the partkey is cached,
+            its new blocks are moved from the untrusted storage into the cache too, so
+            that the next rebuild re-labels all of them
+            args:
+                partkey: key that received new blocks
+                L_list: pseudo-labels of the new blocks
+                Imm: untrusted server
+                Qsgx: enclave cache
+            return:
+                list of the new (V, gamma), read from the cache or the untrusted storage
+        """
+        if partkey not in Qsgx.kL_store:
+            if METRICS.enabled:
+                METRICS.inc("bytes_from_storage", len(L_list) * (8 * self.p + 8))
+            with self.imm_lock:
+                return Imm.multi_get(L_list)
+        blocks = self.fetch_many(L_list, Imm, Qsgx)
+        Qsgx.extend(partkey, L_list)
+        while Qsgx.over_budget() and Qsgx.current_size:
+            self.evict(Qsgx, Imm)
+        return blocks
+
+
+    def evict(self, Qsgx, Imm):
+        """
+            function to make room in a full cache: the partkeys chosen by the cache
+            policy (evict_batch of them) are rebuilt into the untrusted storage and dropped
+            args:
+                Qsgx: enclave cache
+                Imm: untrusted server
+        """
+        for partkey in Qsgx.victims():
+            self.retire(partkey, Qsgx, Imm)
+
+
+    def retire(self, partkey, Qsgx, Imm):
+        """
+            function to write a cached partkey back to the untrusted storage and drop it
+            from the cache; with write-back enabled the re-encryption is queued to the
+            background worker instead of done here
+        """
+        if METRICS.enabled:
+            METRICS.inc("evictions")
+        if self.writeback is None:
+            self.rebuild(partkey, Qsgx, Imm)
+        else:
+            cur_node = self.search(partkey)
+            cur_node.t += 1
+            self.writeback.submit(partkey, cur_node.t, [Qsgx.LVg_store[L] for L in Qsgx.kL_store[partkey]])
+        Qsgx.evict(partkey)
+
+
     def rebuild(self, partkey, Qsgx, Imm):
         """
             function to rebuild the enclave cache
@@ -206,6 +691,8 @@ class Enclave(object):
                 Qsgx: enclave cache
                 Imm: untrusted server
         """
+        if METRICS.enabled:
+            METRICS.inc("rebuilds")
         # search for the node of the given partkey
         cur_node = self.search(partkey)
         # from the cache, get the list of pseudo-labels of the given partkey
@@ -214,35 +701,296 @@ class Enclave(object):
         # increment node.t to encrypt new L values
         cur_node.t += 1
         # encrypt cache blocks and send back to the untrusted storage
-        c = 0
-        for L in L_list:
-            V, gamma = Qsgx.LVg_store[L]
-            vi_c_ti = str(partkey) + "|" + str(c) + "|" + str(cur_node.t)
-            Lp = self.G1.encrypt(vi_c_ti)
-            gammap = random_binary_string(4)
-            Vp = [s ^ int(gamma, 2) ^ int(gammap, 2) for s in V]
-            Imm.set_block(Lp, Vp, gammap)
-            c += 1
+        self.write_back(partkey, cur_node.t, [Qsgx.LVg_store[L] for L in L_list], Imm)
+
+
+    def write_back(self, partkey, t, LVg_list, Imm, G1=None):
+        """
+            function to re-label blocks of a partkey with counter t, re-mask them and
+            write them to the untrusted storage
+            args:
+                partkey: key the blocks belong to
+                t: counter of the new labels
+                LVg_list: list of (V, gamma), in block order
+                Imm: untrusted server
+                G1: PRF for the labels, the enclave's own if None
+        """
+        G1 = G1 or self.G1
+        start_time = time.perf_counter() if METRICS.enabled else 0.0
+        Lp_list = G1.encrypt_many([str(partkey) + "|" + str(c) + "|" + str(t) for c in range(len(LVg_list))])
+        Vp_blocks, gammap_list = self.remask([V for V, _ in LVg_list], [gamma for _, gamma in LVg_list])
+        with self.imm_lock:
+            Imm.multi_set(Lp_list, Vp_blocks, gammap_list)
+        if METRICS.enabled:
+            METRICS.observe("write_back_seconds", time.perf_counter() - start_time)
+            METRICS.inc("blocks_reencrypted", len(Lp_list))
+            METRICS.inc("bytes_to_storage", len(Lp_list) * (8 * self.p + 8))
+
+
+    @METRICS.section("compact_seconds")
+    def compact_query(self, token, Imm, Qsgx, client_id=None):
+        """
+            function to execute a compaction query: repack the real values of each given
+            partkey into the fewest blocks
+            args:
+                token: compaction token from Client.compact_token, with the pad lengths
+                       the client holds for each partkey
+                Imm: untrusted server
+                Qsgx: enclave cache
+                client_id: client whose session counter the token was made with
+            return:
+                dict partkey -> new pad lengths, for Client.dec_compact_result; partkeys
+                left unchanged are not included
+        """
+        k0 = self.session_keys(1, client_id, advance=False)[0]
+        msg = json.loads(self.prf(k0).decrypt(token))
+        results = {}
+        for partkey, pads in msg["pads"].items():
+            new_pads = self.compact(int(partkey), pads, Imm, Qsgx)
+            if new_pads is not None:
+                results[int(partkey)] = new_pads
+        return results
+
+
+    def compact(self, partkey, pads, Imm, Qsgx):
+        """
+            function to repack the real values of a partkey into the fewest blocks
+            a cached partkey is repacked in the cache, so that its next rebuild writes
+            the fewer blocks; otherwise its blocks are taken from the untrusted storage
+            and written back re-labelled with the next counter t
+            args:
+                partkey: key to compact
+                pads: pad lengths of its blocks, as held by the client (plus the pad of
+                      its buffered tail, which is kept); only used if the enclave does
+                      not know them (state saved by an older version)
+                Imm: untrusted server
+                Qsgx: enclave cache
+            return:
+                the new pad lengths of the partkey, or None if it is left unchanged
+                (no block to save, or pads does not match its blocks)
+        """
+        node = self.search(partkey)
+        if node is None:
+            return None
+        if node.pads is not None:
+            pads = self.pads(node)
+        tail = 1 if self.appends is not None and partkey in self.appends else 0
+        if len(pads) != node.c + tail:
+            return None
+        pads, tail_pads = pads[: node.c], pads[node.c :]
+        real = sum(self.p - pad for pad in pads)
+        if -(-real // self.p) >= node.c:
+            return None
+        if partkey in Qsgx.kL_store:
+            LVg_list, new_pads = self.repack([Qsgx.LVg_store[L] for L in Qsgx.kL_store[partkey]], pads)
+            Qsgx.replace(partkey, LVg_list)
+            # the next inserts label blocks from the lower c on: a new t keeps them from
+            # reusing the labels of the dropped blocks, which the server has seen
+            node.t += 1
+        else:
+            # blocks still queued for write-back are taken back instead of fetched
+            reclaimed = self.writeback.reclaim(partkey) if self.writeback is not None else None
+            reclaimed = reclaimed or []
+            L_list = self.G1.encrypt_many([str(partkey) + "|" + str(c) + "|" + str(node.t) for c in range(len(reclaimed), node.c)])
+            with self.imm_lock:
+                stored = Imm.multi_get(L_list)
+                Imm.multi_del(L_list)
+            LVg_list, new_pads = self.repack(list(reclaimed) + stored, pads)
+            node.t += 1
+            self.write_back(partkey, node.t, LVg_list, Imm)
+        if METRICS.enabled:
+            METRICS.inc("blocks_compacted", node.c - len(LVg_list))
+        node.c = len(LVg_list)
+        node.pads = list(new_pads)
+        return new_pads + tail_pads
 
 
-    def add(self, token, Imm):
+    def repack(self, LVg_list, pads):
+        """
+            function to unmask blocks, drop their padded values and split the real values
+            into full blocks, the last one padded, under fresh masks
+            args:
+                LVg_list: list of (V, gamma), in block order
+                pads: number of padded values at the end of each block
+            return:
+                list of the new (V, gamma) and their pad lengths
+        """
+        plain = np.stack([V ^ gamma for V, gamma in LVg_list])
+        real = np.arange(self.p)[None, :] < self.p - np.array(pads, dtype=np.int64)[:, None]
+        blocks, new_pads = self.get_new_V(plain[real])
+        gammas = random_gammas(len(blocks), self.gamma_len, self.gamma_rng)
+        return list(zip(blocks ^ gammas[:, None], gammas.tolist())), new_pads
+
+
+    def add(self, token, Imm, client_id=None):
         """
             function to insert 
             args:
                 token: token from the client
                 Imm: untrusted server
+                client_id: client whose session counter the token was made with
+            raises:
+                RuntimeError with the append buffer started: the blocks are written
+                directly, behind any buffered tail; use add_query, which coalesces them
+        """
+        self.__check_unbuffered("add_query")
+        partkey, gamma, f_new_intlist = self.__dec_add_token(token, client_id)
+        # print("Need to insert new values for partkey:", partkey, ":", f_new_intlist)
+        return self.addData(partkey, gamma, f_new_intlist, Imm)
+
+
+    def __check_unbuffered(self, instead):
+        if self.appends is not None:
+            raise RuntimeError("the append buffer is started, inserts must go through {} to be coalesced with the buffered tails".format(instead))
+
+
+    @METRICS.section("insert_seconds")
+    def add_query(self, token, Imm, Qsgx, client_id=None):
+        """
+            function to execute an insert query: add the values, then keep the cache coherent
+            args:
+                token: token from the client
+                Imm: untrusted server
+                Qsgx: enclave cache
+                client_id: client whose session counter the token was made with
+            return:
+                new_blocks: list of the new (V, gamma), for Client.dec_add_result
+                pad_lens: number of padded values in each new block
+                start: index of the first new block; with the append buffer, the tail
+                       of the partkey is rewritten from there and is the last new block
+        """
+        partkey, gamma, f_new_intlist = self.__dec_add_token(token, client_id)
+        node = self.search(partkey)
+        start = node.c if node is not None else 0
+        tail = []
+        if self.appends is not None:
+            f_new_intlist, tail = self.__coalesce(partkey, f_new_intlist)
+        new_blocks_L, pad_lens = self.addData(partkey, gamma, f_new_intlist, Imm)
+        new_blocks = self.cache_new_blocks(partkey, new_blocks_L, Imm, Qsgx)
+        if len(tail):
+            new_blocks, pad_lens = self.__with_tail(new_blocks, pad_lens, tail, gamma)
+        self.flush_appends(Imm, Qsgx, force=False)
+        return new_blocks, pad_lens, start
+
+
+    def __coalesce(self, partkey, f_new):
+        """
+            function to put the buffered values of a partkey in front of new values and
+            keep in the buffer those that do not fill a block
+            return:
+                values of the full blocks to write, values left in the buffer
+        """
+        buffered = self.appends.values(partkey)
+        values = np.concatenate([buffered, f_new]) if len(buffered) else f_new
+        full = len(values) // self.p * self.p
+        self.appends.put(partkey, values[full:])
+        if full:
+            self.appends.coalesced += min(len(buffered), full)
+        return values[:full], values[full:]
+
+
+    def __with_tail(self, new_blocks, pad_lens, tail, gamma):
+        """
+            function to append the padded tail of a partkey to the blocks returned by an insert
+        """
+        block, tail_pad = self.get_new_V(tail)
+        return list(new_blocks) + [(block[0] ^ gamma, gamma)], list(pad_lens) + tail_pad
+
+
+    def add_batch(self, token, Imm, client_id=None):
+        """
+            function to insert the values of many partkeys from one batch token
+            args:
+                token: batch token from Client.add_batch_token
+                Imm: untrusted server
+                client_id: client whose session counter the token was made with
+            return:
+                dict partkey -> (L_list, V_blocks, gamma, pad_lens, start) of the new blocks
+            raises:
+                RuntimeError with the append buffer started, as add; use add_batch_query
+        """
+        self.__check_unbuffered("add_batch_query")
+        return self.addDataBatch(*self.__dec_add_batch_token(token, client_id), Imm)
+
+
+    @METRICS.section("insert_batch_seconds")
+    def add_batch_query(self, token, Imm, Qsgx, client_id=None):
+        """
+            function to execute a batch insert query: add the values, then keep the cache
+            coherent for the partkeys that are cached
+            args:
+                token: batch token from Client.add_batch_token
+                Imm: untrusted server
+                Qsgx: enclave cache
+                client_id: client whose session counter the token was made with
+            return:
+                dict partkey -> (new_blocks, pad_lens, start), for Client.dec_add_batch_result
+        """
+        partkeys, gammas, counts, values = self.__dec_add_batch_token(token, client_id)
+        tails = {}
+        if self.appends is not None:
+            partkeys, gammas, counts, values, tails = self.__coalesce_batch(partkeys, gammas, counts, values)
+        results = {}
+        for partkey, (L_list, V_blocks, gamma, pad_lens, start) in self.addDataBatch(partkeys, gammas, counts, values, Imm).items():
+            if partkey in Qsgx.kL_store:
+                new_blocks = self.cache_new_blocks(partkey, L_list, Imm, Qsgx)
+            else:
+                new_blocks = list(zip(V_blocks, [gamma] * len(L_list)))
+            if partkey in tails:
+                new_blocks, pad_lens = self.__with_tail(new_blocks, pad_lens, tails[partkey], gamma)
+            results[partkey] = (new_blocks, pad_lens, start)
+        self.flush_appends(Imm, Qsgx, force=False)
+        return results
+
+
+    def __coalesce_batch(self, partkeys, gammas, counts, values):
+        """
+            function to coalesce the values of a batch with the buffered ones, per partkey
+            return:
+                (partkeys, gammas, counts, values) of the full blocks, one entry per
+                partkey, and the dict partkey -> values left in the buffer
+        """
+        grouped = {}
+        for partkey, gamma, segment in zip(partkeys.tolist(), gammas.tolist(), np.split(values, np.cumsum(counts)[:-1])):
+            grouped.setdefault(partkey, (gamma, []))[1].append(segment)
+        full_values, full_counts, tails = [], [], {}
+        for partkey, (_, segments) in grouped.items():
+            full, tail = self.__coalesce(partkey, np.concatenate(segments))
+            full_values.append(full)
+            full_counts.append(len(full))
+            if len(tail):
+                tails[partkey] = tail
+        return (np.array(list(grouped), dtype=np.int64), np.array([gamma for gamma, _ in grouped.values()], dtype=np.int64),
+                np.array(full_counts, dtype=np.int64), np.concatenate(full_values) if full_values else values[:0], tails)
+
+
+    def __dec_add_batch_token(self, token, client_id=None):
+        """
+            function to decrypt a batch insert token into (partkeys, gammas, counts, values)
+        """
+        k0 = self.session_keys(1, client_id, advance=False)[0]
+        msg = json.loads(self.prf(k0).decrypt(token))
+        partkeys = np.array(msg["partkeys"], dtype=np.int64)
+        gammas = np.array(msg["gammas"], dtype=np.int64)
+        counts = np.array(msg["counts"], dtype=np.int64)
+        values = np.frombuffer(base64.b64decode(msg["values"]), dtype="<i8").astype(np.int64)
+        return partkeys, gammas, counts, values
+
+
+    def __dec_add_token(self, token, client_id=None):
         """
-        self.k0 = self.F1.encrypt(str(self.s))
-        token_decoder = self.prf(self.k0)
+            function to decrypt an insert token into (partkey, gamma, new values)
+        """
+        k0 = self.session_keys(1, client_id, advance=False)[0]
+        token_decoder = self.prf(k0)
         raw_msg = token_decoder.decrypt(token)
         raw_msg_splitted = raw_msg.split("|")
         partkey = int(raw_msg_splitted[0])
-        gamma = raw_msg_splitted[1]
+        gamma = int(raw_msg_splitted[1])
         f_new_str = raw_msg_splitted[2]
         f_new_str_list = json.loads(f_new_str)
-        f_new_intlist = [int(x, 10) for x in f_new_str_list]
-        # print("Need to insert new values for partkey:", partkey, ":", f_new_intlist)
-        return self.addData(partkey, gamma, f_new_intlist, self.tree, Imm)
+        f_new_intlist = np.array([int(x, 10) for x in f_new_str_list], dtype=np.int64)
+        return partkey, gamma, f_new_intlist
 
 
     def get_new_V(self, f_new):
@@ -250,77 +998,122 @@ class Enclave(object):
             function to split new cleartext values into equal blocks and encrypt + pad the blocks
             args:
                 f_new: new cleartext values
+            return:
+                new_blocks: (num_blocks, p) int64 array of padded blocks
+                pad_lens: number of padded values in each block
         """
-        if len(f_new) % self.p:
-            pad_last_block = True
-        else:
-            pad_last_block = False
-
-        pad_lens = []
-        ### total number of ciphertext blocks    
-        num_blocks = len(f_new) // self.p + int(pad_last_block)
-        new_blocks = []
-        ### construct ciphertext blocks for the current range-based index v
-
-        if pad_last_block:
-            new_blocks = [f_new[i*self.p : (i+1)*self.p] for i in range(num_blocks-1)]
-            last_block = f_new[(num_blocks-1)*self.p :]
-            pad_len = self.p-len(last_block)
-            pad_values = random.choices(range(1, 10001), k=pad_len)
-            last_block += pad_values
-            new_blocks.append(last_block)
-            pad_lens.extend([0]*(num_blocks-1))
-            pad_lens.append(pad_len)
-        else:
-            new_blocks = [f_new[i*self.p : (i+1)*self.p] for i in range(num_blocks)]
-            pad_lens.extend([0]*(num_blocks))
+        ### total number of ciphertext blocks, and padding of the last one
+        num_blocks = -(-len(f_new) // self.p)
+        pad_len = num_blocks * self.p - len(f_new)
+        pad_lens = [0] * (num_blocks - 1) + [pad_len] if num_blocks else []
+
+        ### construct the (num_blocks, p) array of blocks for the current range-based index v
+        new_blocks = np.empty(num_blocks * self.p, dtype=np.int64)
+        new_blocks[: len(f_new)] = f_new
+        new_blocks[len(f_new) :] = random.choices(range(1, 10001), k=pad_len)
+        new_blocks = new_blocks.reshape(num_blocks, self.p)
         return new_blocks, pad_lens
 
 
-    def addData(self, partkey, gamma, f_new, cur_node, Imm):
+    def addData(self, partkey, gamma, f_new, Imm):
         """
             function to add new key to the enclave, then add new L-V pairs to the untrusted server
             args:
                 partkey: new key to add
                 f_new: new values to add
-                gamma: random binary string for encryption
-                cur_node: current node
+                gamma: integer mask for encryption
                 Imm: untrusted server
         """
-        if cur_node is not None and cur_node.partkey == partkey:
-            c = cur_node.c
+        cur_node = self.search(partkey)
+        if cur_node is not None:
+            c_prime = cur_node.c
             t = cur_node.t
-            
-            new_blocks, pad_lens = self.get_new_V(f_new)
-            new_blocks_L = []
-            c_prime = c
-
-            for block in new_blocks:
-                v_c_t = str(partkey) + "|" + str(c_prime) + "|" + str(t)
-                L = self.G1.encrypt(v_c_t)
-                V = [supp_key ^ int(gamma, 2) for supp_key in block]
-                c_prime += 1
-                Imm.set_block(L, V, gamma)
-                new_blocks_L.append(L)
+        else:
+            c_prime = 0
+            t = 0
 
+        new_blocks, pad_lens = self.get_new_V(f_new)
+        new_blocks_L = self.G1.encrypt_many([str(partkey) + "|" + str(c_prime + i) + "|" + str(t) for i in range(len(new_blocks))])
+        with self.imm_lock:
+            Imm.multi_set(new_blocks_L, new_blocks ^ gamma, [gamma] * len(new_blocks_L))
+        if METRICS.enabled:
+            METRICS.inc("blocks_inserted", len(new_blocks_L))
+            METRICS.inc("bytes_to_storage", len(new_blocks_L) * (8 * self.p + 8))
+        c_prime += len(new_blocks_L)
+
+        if cur_node is not None:
             cur_node.c = c_prime
-        elif cur_node is not None and cur_node.partkey < partkey:
-            return self.addData(partkey, gamma, f_new, cur_node.right, Imm)
-        elif cur_node is not None and cur_node.partkey > partkey:
-            return self.addData(partkey, gamma, f_new, cur_node.left, Imm)
+            if cur_node.pads is not None:
+                cur_node.pads.extend(pad_lens)
         else:
-            c_prime = 0
+            self.insert(Node(partkey, c_prime, 0, list(pad_lens)))
+        return new_blocks_L, pad_lens
+
+
+    def addDataBatch(self, partkeys, gammas, counts, values, Imm):
+        """
+            function to add the values of many partkeys at once: the pairs are sorted
+            and grouped by partkey, padded into blocks with one vectorized scatter,
+            labelled with one PRF call and written with one multi_set; new partkeys
+            are merged into the index in one pass
+            args:
+                partkeys: int64 array of the partkeys, repeats allowed
+                gammas: int64 array of their masks (the first mask of a partkey is used)
+                counts: int64 array of the number of values of each partkey
+                values: int64 array of all values, partkey after partkey
+                Imm: untrusted server
+            return:
+                dict partkey -> (L_list, V_blocks, gamma, pad_lens, start) of the new
+                blocks, start being the index of the first one
+        """
+        if len(partkeys) == 0:
+            return {}
+        p = self.p
+        ### group the values of repeated partkeys, keeping their order
+        order = np.argsort(partkeys, kind="stable")
+        starts = np.cumsum(counts) - counts
+        counts = counts[order]
+        new_starts = np.cumsum(counts) - counts
+        values = values[np.arange(len(values)) + np.repeat(starts[order] - new_starts, counts)]
+        keys, first = np.unique(partkeys[order], return_index=True)
+        gammas = gammas[order][first]
+        totals = np.add.reduceat(counts, first) if len(first) else counts
+
+        ### scatter the values into padded blocks, the free slots get random values
+        num_blocks = -(-totals // p)
+        pads = num_blocks * p - totals
+        block_starts = np.cumsum(num_blocks) - num_blocks
+        value_starts = np.cumsum(totals) - totals
+        dest = np.arange(len(values)) + np.repeat(block_starts * p - value_starts, totals)
+        flat = np.empty(int(num_blocks.sum()) * p, dtype=np.int64)
+        padded = np.ones(len(flat), dtype=bool)
+        padded[dest] = False
+        flat[dest] = values
+        flat[padded] = random.choices(range(1, 10001), k=int(pads.sum()))
+        V_blocks = flat.reshape(-1, p) ^ np.repeat(gammas, num_blocks)[:, None]
+
+        ### one label per block, continuing the counter of existing partkeys
+        nodes, new_nodes, msgs = [], [], []
+        for partkey, nb in zip(keys.tolist(), num_blocks.tolist()):
+            node = self.search(partkey)
+            if node is None:
+                node = Node(partkey, 0, 0, [])
+                new_nodes.append(node)
+            nodes.append(node)
+            msgs.extend(str(partkey) + "|" + str(node.c + i) + "|" + str(node.t) for i in range(nb))
+        L_all = self.G1.encrypt_many(msgs)
+        with self.imm_lock:
+            Imm.multi_set(L_all, V_blocks, np.repeat(gammas, num_blocks).tolist())
+        if METRICS.enabled:
+            METRICS.inc("blocks_inserted", len(L_all))
+            METRICS.inc("bytes_to_storage", len(L_all) * (8 * p + 8))
 
-            new_blocks, pad_lens = self.get_new_V(f_new)
-            new_blocks_L = []
-            for block in new_blocks:
-                v_c_t = str(partkey) + "|" + str(c_prime) + "|" + str(0)
-                L = self.G1.encrypt(v_c_t)
-                V = [supp_key ^ int(gamma, 2) for supp_key in block]
-                c_prime += 1
-                Imm.set_block(L, V, gamma)
-                new_blocks_L.append(L)
-
-            new_node = Node(partkey, c_prime, 0)
-            self.tree.insert(new_node)
-        return new_blocks_L, pad_lens
\ No newline at end of file
+        results = {}
+        for node, gamma, start, nb, pad in zip(nodes, gammas.tolist(), block_starts.tolist(), num_blocks.tolist(), pads.tolist()):
+            pad_lens = [0] * (nb - 1) + [pad] if nb else []
+            results[node.partkey] = (L_all[start : start + nb], V_blocks[start : start + nb], gamma, pad_lens, node.c)
+            node.c += nb
+            if node.pads is not None:
+                node.pads.extend(pad_lens)
+        self.tree.merge(new_nodes)
+        return results
@@ -0,0 +1,342 @@
+"""
+    headless command line for HybrIDX, without the PyQt5 GUI
+
+        python -m hybridx build data.csv store/ [--p 8|auto] [--workers N]
+        python -m hybridx query store/ 120 ">=" [--q 5] [--values]
+        python -m hybridx insert store/ 120 4,8,15
+        python -m hybridx load store/ new_rows.csv [--batch-keys 10000]
+        python -m hybridx compact store/ [--min-saving 1]
+        python -m hybridx bench store/ [--queries 1000]
+
+    a store directory holds the on-disk L-V store (store.bin), the enclave and
+    client snapshots (enclave.npz, client.npz) and, when the keys were generated by
+    build, keys.json. keys can be given with --k1/--k2 or $HYBRIDX_K1/$HYBRIDX_K2.
+    modules are imported inside the commands, so that a query does not load the
+    csv ingestion (pandas) or the build (multiprocessing, tqdm) code.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+
+STORE_FILE = "store.bin"
+ENCLAVE_FILE = "enclave.npz"
+CLIENT_FILE = "client.npz"
+KEYS_FILE = "keys.json"
+
+
+def parse_address(address):
+    """
+        function to turn "host:port" into a TCP address, anything else is a Unix socket path
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+def load_keys(args, create=False):
+    """
+        function to get (k1, k2) from the arguments, the environment or keys.json
+        args:
+            create: generate and save new keys if none are found (for build)
+    """
+    k1 = args.k1 or os.environ.get("HYBRIDX_K1")
+    k2 = args.k2 or os.environ.get("HYBRIDX_K2")
+    if k1 and k2:
+        return k1, k2
+    path = os.path.join(args.store, KEYS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            keys = json.load(f)
+        return keys["k1"], keys["k2"]
+    if not create:
+        raise SystemExit("no keys: give --k1/--k2, set $HYBRIDX_K1/$HYBRIDX_K2 or keep {} in the store".format(KEYS_FILE))
+    import base64
+    k1, k2 = (base64.urlsafe_b64encode(os.urandom(32)).decode("utf-8") for _ in range(2))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"k1": k1, "k2": k2}, f)
+    print("Generated new keys in", path)
+    return k1, k2
+
+
+class Session(object):
+    """
+        client, enclave and untrusted storage of a store directory, opened for one command
+        close() writes the cached blocks back and saves both snapshots, since a query
+        moves blocks from the untrusted storage into the cache and bumps the counters
+        with connect, only the client is opened: the enclave and storage belong to the
+        query server at that address
+    """
+    def __init__(self, args, connect=None):
+        import numpy as np
+        self.args = args
+        if args.metrics or args.profile:
+            from metrics import METRICS
+            METRICS.enable(profile=args.profile)
+        from prf import PRF
+        from client import Client
+        self.dir = args.store
+        k1, k2 = load_keys(args)
+        with np.load(os.path.join(self.dir, CLIENT_FILE)) as state:
+            p = int(state["p"])
+        self.client = Client(p=p, k1=k1, k2=k2, prf=PRF, gamma_len=args.gamma_len)
+        self.client.load_state(os.path.join(self.dir, CLIENT_FILE))
+        self.conn = None
+        if connect:
+            from server import QueryConnection
+            self.s = self.client.s
+            self.conn = QueryConnection(parse_address(connect), self.client)
+            return
+        from cache import Qsgx
+        from enclave import Enclave
+        from diskstore import MappedStorage
+        self.Imm = MappedStorage(os.path.join(self.dir, STORE_FILE), compact_threshold=args.compact_threshold)
+        self.enclave = Enclave(p=p, k1=k1, k2=k2, prf=PRF, node_list=[], gamma_len=args.gamma_len)
+        self.enclave.load_state(os.path.join(self.dir, ENCLAVE_FILE))
+        self.Qsgx = Qsgx(args.cache)
+        if getattr(args, "append_buffer", False):
+            self.enclave.start_appends(args.append_max_values, float("inf"))
+
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            # the shared counter saved locally is untouched by the server session
+            self.client.client_id, self.client.s = None, self.s
+        else:
+            self.enclave.stop_appends(self.Imm, self.Qsgx)
+            for partkey in list(self.Qsgx.kL_store.keys()):
+                self.enclave.rebuild(partkey, self.Qsgx, self.Imm)
+            self.Qsgx.clear()
+            self.enclave.save_state(os.path.join(self.dir, ENCLAVE_FILE), self.Qsgx)
+            self.Imm.close()
+        self.client.save_state(os.path.join(self.dir, CLIENT_FILE))
+        if self.args.metrics or self.args.profile:
+            from metrics import METRICS
+            if self.args.metrics:
+                print(METRICS.prometheus(), end="")
+            if self.args.profile:
+                print(METRICS.profile_report())
+
+
+def block_size(text):
+    return text if text == "auto" else int(text)
+
+
+def cmd_build(args):
+    from prf import PRF
+    from client import Client
+    from enclave import Enclave
+    from untrusted import ColumnarStorage
+    from diskstore import write_store
+    os.makedirs(args.store, exist_ok=True)
+    k1, k2 = load_keys(args, create=True)
+    if args.p == "auto":
+        from advisor import advise
+        report = advise(args.csv)
+        args.p = report["recommended_p"]
+        print("Block size p = {} recommended for {} partkeys of {:.1f} values on average".format(args.p, report["partkeys"], report["volume_mean"]))
+    start_time = time.time()
+    Imm = ColumnarStorage(p=args.p)
+    client = Client(p=args.p, k1=k1, k2=k2, prf=PRF, gamma_len=args.gamma_len)
+    if args.workers > 1:
+        from ingest import iter_shuffled_groups
+        client.build_parallel(iter_shuffled_groups(args.csv, args.chunk_size), Imm, workers=args.workers)
+    else:
+        client.build_from_csv(args.csv, Imm, chunk_size=args.chunk_size)
+    enclave = Enclave(p=args.p, k1=k1, k2=k2, prf=PRF, node_list=client.node_list, gamma_len=args.gamma_len)
+    write_store(os.path.join(args.store, STORE_FILE), Imm, args.p)
+    enclave.save_state(os.path.join(args.store, ENCLAVE_FILE))
+    client.save_state(os.path.join(args.store, CLIENT_FILE))
+    fake = sum(sum(pads) for pads in client.pad_len.values())
+    print("Built {} partkeys in {} blocks ({} fake values) in {:.3f} seconds".format(len(client.node_list), len(Imm), fake, time.time() - start_time))
+
+
+def cmd_query(args):
+    session = Session(args, args.connect)
+    try:
+        partkeys = session.client.pad_len.keys()
+        if (args.cmp == ">=" and args.partkey > max(partkeys)) or (args.cmp == "<=" and args.partkey < min(partkeys)):
+            raise SystemExit("InvalidQuery: query outside range of partkeys.")
+        if session.conn is not None:
+            n, results = session.conn.query_stream(args.partkey, args.cmp, args.q)
+        else:
+            token = session.client.enc_token(args.partkey, args.cmp, args.q)
+            res_batch, R = session.enclave.search_query(token, session.Imm, session.Qsgx)
+            n, results = session.client.dec_enclave_stream(R, res_batch)
+        print("Total match:", n)
+        for partkey, values in results:
+            if args.values:
+                print(partkey, values.tolist())
+            else:
+                print(partkey)
+    finally:
+        session.close()
+
+
+def cmd_insert(args):
+    values = [int(v, 10) for v in args.values.split(",")]
+    session = Session(args, args.connect)
+    try:
+        if session.conn is not None:
+            session.conn.insert(args.partkey, values)
+        else:
+            token = session.client.add_token(args.partkey, [str(v) for v in values])
+            new_blocks, pad_lens, start = session.enclave.add_query(token, session.Imm, session.Qsgx)
+            session.client.dec_add_result(args.partkey, new_blocks, pad_lens, start)
+        print("Pad lengths for partkey:", args.partkey, "->", session.client.pad_len[args.partkey])
+    finally:
+        session.close()
+
+
+def cmd_load(args):
+    from ingest import iter_partkey_groups
+    session = Session(args, args.connect)
+    start_time = time.time()
+    rows = keys = 0
+    try:
+        groups = iter_partkey_groups(args.csv, args.chunk_size)
+        while True:
+            batch = [group for _, group in zip(range(args.batch_keys), groups)]
+            if not batch:
+                break
+            if session.conn is not None:
+                session.conn.insert_many(batch)
+            else:
+                token = session.client.add_batch_token(batch)
+                results = session.enclave.add_batch_query(token, session.Imm, session.Qsgx)
+                session.client.dec_add_batch_result(results)
+            keys += len(batch)
+            rows += sum(len(values) for _, values in batch)
+    finally:
+        session.close()
+    print("Inserted {} values for {} partkeys in {:.3f} seconds".format(rows, keys, time.time() - start_time))
+
+
+def cmd_compact(args):
+    session = Session(args, args.connect)
+    try:
+        before = sum(len(pads) for pads in session.client.pad_len.values())
+        if session.conn is not None:
+            results = session.conn.compact(min_saving=args.min_saving)
+        else:
+            token = session.client.compact_token(min_saving=args.min_saving)
+            results = session.enclave.compact_query(token, session.Imm, session.Qsgx)
+            session.client.dec_compact_result(results)
+        after = sum(len(pads) for pads in session.client.pad_len.values())
+        print("Compacted {} partkeys: {} -> {} blocks".format(len(results), before, after))
+    finally:
+        session.close()
+
+
+def cmd_bench(args):
+    import random
+    import numpy as np
+    session = Session(args)
+    try:
+        partkeys = session.enclave.tree.partkeys
+        rng = random.Random(args.seed)
+        latencies = np.empty(args.queries)
+        for i in range(args.queries):
+            session.client.clear_results()
+            cmp = rng.choice([">=", "<="])
+            v = rng.choice(partkeys)
+            start_time = time.perf_counter()
+            token = session.client.enc_token(v, cmp, args.q)
+            res_batch, R = session.enclave.search_query(token, session.Imm, session.Qsgx)
+            session.client.dec_enclave_msg(R, res_batch)
+            latencies[i] = time.perf_counter() - start_time
+        ms = latencies * 1000
+        print(json.dumps({
+            "queries": args.queries,
+            "q": args.q,
+            "cache": args.cache,
+            "qps": args.queries / latencies.sum(),
+            "mean_ms": ms.mean(),
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "cache_stats": session.Qsgx.stats(),
+        }, indent=2))
+    finally:
+        session.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="hybridx", description="HybrIDX encrypted index, headless")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def common(cmd):
+        cmd.add_argument("--k1", help="secret key 1, or $HYBRIDX_K1")
+        cmd.add_argument("--k2", help="secret key 2, or $HYBRIDX_K2")
+        cmd.add_argument("--gamma-len", type=int, default=4, help="number of bits of the masks")
+        cmd.add_argument("--log-level", help="DEBUG traces each query; WARNING (default, or $HYBRIDX_LOG_LEVEL) logs storage errors only")
+        cmd.add_argument("--log-format", default="text", choices=["text", "json"], help="json writes one object per line")
+        return cmd
+
+    def opened(cmd):
+        common(cmd)
+        cmd.add_argument("store", help="store directory written by build")
+        cmd.add_argument("--metrics", action="store_true", help="print the metrics in Prometheus text format at the end")
+        cmd.add_argument("--profile", action="store_true", help="run each query or insert under cProfile and print the summed profile")
+        cmd.add_argument("--cache", type=int, default=25, help="enclave cache capacity in partkeys")
+        cmd.add_argument("--compact-threshold", type=int, default=100000, help="log records before the store file is compacted")
+        return cmd
+
+    build = common(sub.add_parser("build", help="encrypt a (partkey, value) csv into a store directory"))
+    build.add_argument("csv")
+    build.add_argument("store")
+    build.add_argument("--p", type=block_size, default=8, help="block size, or auto to pick it from the partkey volumes of the csv")
+    build.add_argument("--chunk-size", type=int, default=1000000, help="csv rows read at a time")
+    build.add_argument("--workers", type=int, default=1, help="processes for a parallel build")
+    build.set_defaults(func=cmd_build)
+
+    query = opened(sub.add_parser("query", help="run a range query"))
+    query.add_argument("partkey", type=int)
+    query.add_argument("cmp", choices=[">=", "<="])
+    query.add_argument("--q", type=int, default=1, help="number of partkeys returned")
+    query.add_argument("--values", action="store_true", help="print the values of the returned partkeys")
+    query.add_argument("--connect", help="query server address (host:port or socket path) instead of a local enclave")
+    query.set_defaults(func=cmd_query)
+
+    insert = opened(sub.add_parser("insert", help="insert values for a partkey"))
+    insert.add_argument("partkey", type=int)
+    insert.add_argument("values", help="comma-separated integers")
+    insert.add_argument("--connect", help="query server address (host:port or socket path) instead of a local enclave")
+    insert.set_defaults(func=cmd_insert)
+
+    load = opened(sub.add_parser("load", help="insert the (partkey, value) rows of a csv in batches"))
+    load.add_argument("csv")
+    load.add_argument("--batch-keys", type=int, default=10000, help="partkeys per batch insert token")
+    load.add_argument("--chunk-size", type=int, default=1000000, help="csv rows read at a time")
+    load.add_argument("--connect", help="query server address (host:port or socket path) instead of a local enclave")
+    load.add_argument("--append-buffer", action="store_true", help="coalesce the partial blocks of successive batches, flushed at the end")
+    load.add_argument("--append-max-values", type=int, default=1000000, help="values buffered before the oldest partial blocks are flushed")
+    load.set_defaults(func=cmd_load)
+
+    compact = opened(sub.add_parser("compact", help="repack the partkeys left with padded blocks by inserts into full blocks"))
+    compact.add_argument("--min-saving", type=int, default=1, help="blocks a partkey must save to be compacted")
+    compact.add_argument("--connect", help="query server address (host:port or socket path) instead of a local enclave")
+    compact.set_defaults(func=cmd_compact)
+
+    bench = opened(sub.add_parser("bench", help="time random range queries against a store"))
+    bench.add_argument("--queries", type=int, default=1000)
+    bench.add_argument("--q", type=int, default=1)
+    bench.add_argument("--seed", type=int, default=0)
+    bench.set_defaults(func=cmd_bench)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from logs import configure
+    configure(args.log_level, args.log_format)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
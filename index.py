@@ -0,0 +1,139 @@
+from bisect import bisect_left, bisect_right
+
+
+class OrderedIndex(object):
+    """
+        balanced ordered index of enclave nodes, kept as two parallel sorted arrays
+        (partkeys and nodes) searched with bisection, so lookups are O(log n) and
+        there is no recursion depth limit whatever the insertion order
+    """
+    def __init__(self, node_list=None):
+        self.partkeys = []              # sorted partkeys
+        self.nodes = []                 # nodes, in the same order as partkeys
+        if node_list:
+            self.bulk_load(node_list)
+
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+
+    def bulk_load(self, node_list):
+        """
+            function to (re)build the index from an unordered list of nodes in one sort
+            args:
+                node_list: list of nodes, e.g. Client.node_list
+            note:
+                as for single inserts, the first node seen for a partkey wins
+        """
+        unique = {}
+        for N in node_list:
+            unique.setdefault(N.partkey, N)
+        self.partkeys = sorted(unique)
+        self.nodes = [unique[partkey] for partkey in self.partkeys]
+
+
+    def load_sorted(self, node_list):
+        """
+            function to (re)build the index from nodes already in strictly increasing
+            partkey order, e.g. a snapshot, without sorting
+        """
+        self.nodes = list(node_list)
+        self.partkeys = [N.partkey for N in self.nodes]
+
+
+    def get_node(self, partkey):
+        """
+            function to search for a node given its partkey
+            return:
+                the node, or None if the partkey is not indexed
+        """
+        i = bisect_left(self.partkeys, partkey)
+        if i < len(self.partkeys) and self.partkeys[i] == partkey:
+            return self.nodes[i]
+        return None
+
+
+    def insert(self, new_node):
+        """
+            function to insert a node, keeping the arrays sorted
+            new keys at either edge (e.g. monotonic ids) are appended in O(1)
+            args:
+                new_node: node to be inserted, ignored if its partkey already exists
+        """
+        partkey = new_node.partkey
+        if not self.partkeys or partkey > self.partkeys[-1]:
+            self.partkeys.append(partkey)
+            self.nodes.append(new_node)
+            return
+        i = bisect_left(self.partkeys, partkey)
+        if self.partkeys[i] != partkey:
+            self.partkeys.insert(i, partkey)
+            self.nodes.insert(i, new_node)
+
+
+    def merge(self, new_nodes):
+        """
+            function to insert many nodes in one linear merge of the sorted arrays,
+            instead of one O(n) list insert per node
+            args:
+                new_nodes: nodes in strictly increasing partkey order; as for insert,
+                           those whose partkey already exists are ignored
+        """
+        if not new_nodes:
+            return
+        if not self.partkeys or new_nodes[0].partkey > self.partkeys[-1]:
+            self.partkeys.extend(N.partkey for N in new_nodes)
+            self.nodes.extend(new_nodes)
+            return
+        partkeys, nodes = [], []
+        i = 0
+        for N in new_nodes:
+            j = bisect_left(self.partkeys, N.partkey, i)
+            partkeys.extend(self.partkeys[i:j])
+            nodes.extend(self.nodes[i:j])
+            i = j
+            if j < len(self.partkeys) and self.partkeys[j] == N.partkey:
+                continue
+            partkeys.append(N.partkey)
+            nodes.append(N)
+        partkeys.extend(self.partkeys[i:])
+        nodes.extend(self.nodes[i:])
+        self.partkeys, self.nodes = partkeys, nodes
+
+
+    def range_ge(self, partkey, q):
+        """
+            function to get the first q nodes whose partkey is >= the given partkey
+            args:
+                partkey: lower bound of the range
+                q: batch size
+            return:
+                match_nodes: at most q nodes, in partkey order
+                n: total number of nodes in the range (rank-based, no scan)
+        """
+        i = bisect_left(self.partkeys, partkey)
+        return self.nodes[i : i + q], len(self.nodes) - i
+
+
+    def range_le(self, partkey, q):
+        """
+            function to get the last q nodes whose partkey is <= the given partkey
+            args:
+                partkey: upper bound of the range
+                q: batch size
+            return:
+                match_nodes: at most q nodes, in partkey order
+                n: total number of nodes in the range (rank-based, no scan)
+        """
+        j = bisect_right(self.partkeys, partkey)
+        return self.nodes[max(0, j - q) : j], j
+
+
+    def print_tree(self):
+        for N in self.nodes:
+            N.get_node_info()
@@ -0,0 +1,198 @@
+import os
+import heapq
+import random
+import shutil
+import tempfile
+import itertools
+import numpy as np
+
+
+def group_table(table):
+    """
+        function to group a (n, 2) table of (partkey, value) rows by partkey
+        args:
+            table: integer array, one row per record
+        return:
+            partkeys: sorted array of distinct partkeys
+            groups: list of value arrays, groups[i] holds the values of partkeys[i]
+                    in their original row order
+    """
+    table = np.asarray(table)
+    order = np.argsort(table[:, 0], kind="stable")
+    keys = table[order, 0]
+    values = table[order, 1]
+    partkeys, starts = np.unique(keys, return_index=True)
+    return partkeys, np.split(values, starts[1:])
+
+
+def has_header(path):
+    """
+        function to check whether the first line of a csv is a header rather than data
+    """
+    with open(path) as f:
+        first = f.readline().split(",")[0].strip()
+    return not first.lstrip("-").isdecimal()
+
+
+def read_chunks(path, chunk_size, progress=None):
+    """
+        function to read a (partkey, value) csv as int64 arrays of at most chunk_size rows
+        args:
+            path: csv file, with or without a header line
+            chunk_size: number of rows per chunk
+            progress: optional callback taking an integer percentage of the file read,
+                      called only when the percentage changes
+    """
+    import pandas as pd             # imported here, only csv ingestion needs pandas
+    file_size = max(os.path.getsize(path), 1)
+    last_percent = -1
+    with open(path, "rb") as f:
+        reader = pd.read_csv(f, header=None, usecols=[0, 1], skiprows=int(has_header(path)), chunksize=chunk_size, dtype=np.int64)
+        for chunk in reader:
+            if progress is not None:
+                percent = min(100, int(f.tell() / file_size * 100))
+                if percent != last_percent:
+                    progress(percent)
+                    last_percent = percent
+            yield chunk.to_numpy()
+    if progress is not None and last_percent != 100:
+        progress(100)
+
+
+def iter_run_groups(run, window):
+    """
+        function to stream (partkey, values) groups out of a run sorted by partkey,
+        reading at most window rows of the (possibly memory-mapped) run at a time
+    """
+    carry_key = None
+    carry = []
+    for start in range(0, len(run), window):
+        block = np.asarray(run[start : start + window])
+        keys = block[:, 0]
+        bounds = [0, *(np.flatnonzero(np.diff(keys)) + 1).tolist(), len(keys)]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            key = int(keys[lo])
+            if carry and key != carry_key:
+                yield carry_key, np.concatenate(carry)
+                carry = []
+            carry_key = key
+            carry.append(block[lo:hi, 1])
+    if carry:
+        yield carry_key, np.concatenate(carry)
+
+
+def iter_partkey_groups(path, chunk_size=1000000, spill_dir=None, progress=None):
+    """
+        function to stream a (partkey, value) csv as (partkey, values) groups in
+        partkey order, with values in file order, using memory bounded by chunk_size
+        args:
+            path: csv file
+            chunk_size: number of rows sorted in memory at once
+            spill_dir: directory for the sorted runs, a temporary one if None
+            progress: optional callback taking the percentage of the file read
+        note:
+            each chunk is sorted with a stable argsort and spilled to disk as a run;
+            the runs are then merged through memory maps, so files larger than RAM
+            are supported. a file that fits in one chunk never touches the disk.
+    """
+    chunks = read_chunks(path, chunk_size, progress)
+    first = next(chunks, None)
+    if first is None:
+        return
+    second = next(chunks, None)
+    if second is None:
+        partkeys, groups = group_table(first)
+        yield from zip(partkeys.tolist(), groups)
+        return
+
+    run_dir = tempfile.mkdtemp(prefix="hybridx-runs-", dir=spill_dir)
+    try:
+        run_paths = []
+        for chunk in itertools.chain((first, second), chunks):
+            run_path = os.path.join(run_dir, "run{}.npy".format(len(run_paths)))
+            np.save(run_path, chunk[np.argsort(chunk[:, 0], kind="stable")])
+            run_paths.append(run_path)
+
+        window = max(1, chunk_size // len(run_paths))
+        runs = [iter_run_groups(np.load(run_path, mmap_mode="r"), window) for run_path in run_paths]
+        # heapq.merge keeps earlier runs first on equal partkeys, preserving file order
+        cur_key = None
+        cur = []
+        for key, values in heapq.merge(*runs, key=lambda group: group[0]):
+            if cur and key != cur_key:
+                yield cur_key, np.concatenate(cur)
+                cur = []
+            cur_key = key
+            cur.append(values)
+        if cur:
+            yield cur_key, np.concatenate(cur)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def iter_shuffled_groups(path, chunk_size=1000000, spill_dir=None, progress=None, row_bytes=8):
+    """
+        function to stream a (partkey, value) csv as (partkey, values) groups in a
+        uniformly random partkey order, with values in file order, using memory
+        bounded by chunk_size
+        args:
+            path: csv file
+            chunk_size: number of rows grouped or shuffled in memory at once
+            spill_dir: directory for the sorted runs and the shuffle buckets
+            progress: optional callback taking the percentage of the file read
+            row_bytes: assumed size of a csv row, to size the buckets from the file size
+        note:
+            a random-keyed external sort: each group is appended to one of num_buckets
+            spill files picked at random, then each bucket is read back and shuffled in
+            memory. that sorts the partkeys on (random bucket, random rank), a uniform
+            permutation whatever their order in the file, so the order in which blocks
+            are written does not leak the partkey order. a bucket holds about chunk_size
+            rows; a file that fits in one bucket is shuffled in memory.
+    """
+    num_buckets = max(1, -(-os.path.getsize(path) // (chunk_size * row_bytes)))
+    groups = iter_partkey_groups(path, chunk_size, spill_dir, progress)
+    if num_buckets == 1:
+        groups = list(groups)
+        random.shuffle(groups)
+        yield from groups
+        return
+
+    bucket_dir = tempfile.mkdtemp(prefix="hybridx-shuffle-", dir=spill_dir)
+    try:
+        bucket_paths = [os.path.join(bucket_dir, "bucket{}.bin".format(i)) for i in range(num_buckets)]
+        pending = [[] for _ in range(num_buckets)]      # buffered (n, 2) rows of each bucket
+        pending_rows = [0] * num_buckets
+        flush_rows = max(1, chunk_size // num_buckets)
+        for partkey, values in groups:
+            i = random.randrange(num_buckets)
+            pending[i].append(np.column_stack((np.full(len(values), partkey, dtype=np.int64), values)))
+            pending_rows[i] += len(values)
+            if pending_rows[i] >= flush_rows:
+                with open(bucket_paths[i], "ab") as f:
+                    np.concatenate(pending[i]).tofile(f)
+                pending[i], pending_rows[i] = [], 0
+        for i in range(num_buckets):
+            if pending[i]:
+                with open(bucket_paths[i], "ab") as f:
+                    np.concatenate(pending[i]).tofile(f)
+        pending = None
+
+        for bucket_path in bucket_paths:
+            if not os.path.exists(bucket_path):
+                continue
+            partkeys, values = group_table(np.fromfile(bucket_path, dtype=np.int64).reshape(-1, 2))
+            os.remove(bucket_path)
+            bucket = list(zip(partkeys.tolist(), values))
+            random.shuffle(bucket)
+            yield from bucket
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+
+
+def partkey_values(path, partkey, chunk_size=1000000):
+    """
+        function to scan a csv for the values of one partkey, in file order, holding one
+        chunk in memory at a time
+    """
+    values = [chunk[chunk[:, 0] == partkey, 1] for chunk in read_chunks(path, chunk_size)]
+    return np.concatenate(values) if values else np.empty(0, dtype=np.int64)
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import logging
+
+
+ROOT = "hybridx"            # every module logs under this logger
+
+
+class JsonFormatter(logging.Formatter):
+    """
+        formatter writing one JSON object per record; the fields passed with
+        extra={"fields": {...}} become keys of the object
+    """
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + ".{:03d}".format(int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+        formatter appending the extra fields to the message as key=value pairs
+    """
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join("{}={}".format(key, value) for key, value in fields.items())
+        return line
+
+
+def get_logger(name):
+    """
+        function to get the logger of a module, a child of the hybridx logger
+    """
+    return logging.getLogger(ROOT + "." + name)
+
+
+def configure(level=None, fmt="text", stream=None):
+    """
+        function to set the level and output of every hybridx logger
+        args:
+            level: level name or number, $HYBRIDX_LOG_LEVEL or WARNING if None
+            fmt: "text" or "json" (one object per line, for log collectors)
+            stream: output stream, stderr if None
+        note:
+            hot paths build their debug messages only when DEBUG is enabled, so the
+            default WARNING level costs one cached level test per call
+    """
+    level = level or os.environ.get("HYBRIDX_LOG_LEVEL", "WARNING")
+    if isinstance(level, str):
+        level = level.upper()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger = logging.getLogger(ROOT)
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
@@ -1,18 +1,21 @@
 from PyQt5.QtWidgets import *
 from PyQt5 import uic, QtWidgets,QtCore
-import pandas as pd
-from untrusted import UntrustedStorage
+from untrusted import ColumnarStorage
 from client import Client
 from enclave import Enclave
 from prf import PRF
 from cache import Qsgx
+from logs import configure, get_logger
+from ingest import partkey_values
+import os
 import sys
-import random
 import time
-import itertools
 import sys
 
 
+logger = get_logger("gui")
+
+
 class MyGUI(QMainWindow):
     """ GUI object using PyQt5 """
     def __init__(self):
@@ -65,6 +68,9 @@ class MyGUI(QMainWindow):
         """
         cur_size = self.Qsgx.get_current_size()
         self.box_cache_size.setText("Current size: " + str(cur_size) + '/' + str(self.Qsgx.capacity))
+        stats = self.Qsgx.stats()
+        self.cache_status.setText("Status: hit rate {:.1%}, {} evictions".format(stats["hit_rate"], stats["evictions"]))
+        logger.info("cache stats", extra={"fields": stats})
 
 
     def build_untrusted_and_enclave(self):
@@ -74,52 +80,35 @@ class MyGUI(QMainWindow):
                 - build the encrypted key-value (L-V) store in the untrusted storage
                 - build enclave binary tree
         """
-        data = pd.read_csv(self.fileName, header=None).to_numpy()
-        if not str(data[0, 0]).isdecimal():
-            data = data[1:]
-        data = data.astype(int)
-        self.Imm = UntrustedStorage(LV_store={})
-        self.client = Client(p=8, k1=self.k1, k2=self.k2, prf=PRF, gamma_len=4)
-        self.__client_build(data)
-        self.enclave = Enclave(p=8, k1=self.k1, k2=self.k2, prf=PRF, node_list=self.client.node_list)
+        self.Imm = ColumnarStorage(p=8)
+        self.client = Client(p=8, k1=self.k1, k2=self.k2, prf=PRF, gamma_len=4, lru=True)
+        self.__client_build()
+        self.enclave = Enclave(p=8, k1=self.k1, k2=self.k2, prf=PRF, node_list=self.client.node_list, gamma_len=4)
         print("Finish building HybrIDX!")
 
 
-    def __client_build(self, table):
+    def __client_build(self):
         """
-            client builds the untrusted storage
-            args:
-                table: the original key-value store
+            client builds the untrusted storage, streaming the csv in chunks
+            (Client.build_from_csv), so the dataset is never held in memory
         """
-        start_time = time.time()
         data_name = self.fileName.split('/')[-1].split('.')[0]
-        print("Preparing hashmap for {} dataset".format(data_name))
-        self.k2v = self.client.preprocess(table, self.progress_hashmap)
-        print(f"Finish building hashmap in {time.time() - start_time} seconds")
-
-        print("Buiding the L-V store for untrusted storage...")
-        partkey_list = list(set(table[:, 0]))
-        self.max_partkey = max(partkey_list)
-        self.min_partkey = min(partkey_list)
-        random.shuffle(partkey_list)
-        for i, partkey in enumerate(partkey_list):
-            self.progress_LV.setValue( int((i+1) / len(partkey_list) * 100) )
-            self.client.process_partkey(partkey, self.Imm, self.k2v)
-        print(f"Finish building L-V store in {time.time() - start_time} seconds")
-        # df = pd.DataFrame.from_dict(self.Imm.storage, orient='index')
-        # df.reset_index(inplace=True)
-        # df.columns = ["label", "cipherblock", "gamma"]
-        # df.to_csv('./{}_encrypted.csv'.format(self.data_name), index=False)
+        print("Buiding the L-V store for {} dataset...".format(data_name))
+        self.inserted = {}
+        self.progress_LV.setValue(0)
+        self.client.build_from_csv(self.fileName, self.Imm, progress=self.progress_hashmap.setValue)
+        self.progress_LV.setValue(100)
+        self.__update_partkey_range()
         self.__get_all_fake()
-        print(f"Size of cleartext database is: {sys.getsizeof(self.k2v) / 1024 / 1024} MB")
-        print(f"Size of the encrypted database is: {sys.getsizeof(self.Imm.storage) / 1024 / 1024} MB")
+        print(f"Size of cleartext database is: {os.path.getsize(self.fileName) / 1024 / 1024} MB")
+        print(f"Size of the encrypted database is: {self.Imm.nbytes() / 1024 / 1024} MB")
 
     
     def __update_partkey_range(self):
         """
             function to get the max and min values of all partkeys
         """
-        all_partkeys = list( self.k2v.keys() )
+        all_partkeys = list( self.client.pad_len.keys() )
         self.max_partkey = max(all_partkeys)
         self.min_partkey = min(all_partkeys)
 
@@ -154,11 +143,11 @@ class MyGUI(QMainWindow):
         token = self.client.enc_token(v_query, cmp, q)
         res_batch, res_size = self.enclave.search_query(token, self.Imm, self.Qsgx)
 
-        n = self.client.dec_enclave_msg(res_size, res_batch)
+        n, results = self.client.dec_enclave_stream(res_size, res_batch)
+        keys = [partkey for partkey, _ in results]
         self.total_match.setText(str(n))
-        keys = list(self.client.Qres.keys())
         self.all_returned_keys.setText(str(keys))
-        print(f"Done querying in {time.time() - start_time} second")
+        logger.info("Done querying in %s second", time.time() - start_time)
 
 
     def get_cipher_text(self):
@@ -169,7 +158,7 @@ class MyGUI(QMainWindow):
         """
         partkey = self.query_key.text()
         try:
-            msg = str(self.client.Qres_undec[ int(partkey) ])
+            msg = str([V.tolist() for V in self.client.get_result(int(partkey), cipher=True)])
         except KeyError:
             msg = "Partkey {} is not in the returned results.".format(partkey)
         self.query_ciphertext.setText(msg)
@@ -183,8 +172,7 @@ class MyGUI(QMainWindow):
         """
         partkey = self.query_key.text()
         try:
-            msg = self.client.Qres[ int(partkey) ]
-            msg = str(list(itertools.chain(*msg)))
+            msg = str(self.client.get_result(int(partkey)).tolist())
         except KeyError:
             msg = "Partkey {} is not in the returned results.".format(partkey)
         self.query_plaintext.setText(msg)
@@ -192,17 +180,17 @@ class MyGUI(QMainWindow):
 
     def get_ground_truth(self):
         """
-            function to get ground truth value from the hashmap
+            function to get ground truth value from the csv and the inserted values
             args:
                 partkey (from text field)
         """
         partkey = self.query_key.text()
-        try:
-            msg = str(self.k2v[ int(partkey) ])
-            self.true_plaintext.setText(msg)
-        except KeyError:
+        values = partkey_values(self.fileName, int(partkey)).tolist() + self.inserted.get(int(partkey), [])
+        if values:
+            msg = str(values)
+        else:
             msg = "Partkey {} does not exist in the database.".format(partkey)
-            self.true_plaintext.setText(msg)
+        self.true_plaintext.setText(msg)
 
 
     def rebuild_cache(self):
@@ -231,9 +219,6 @@ class MyGUI(QMainWindow):
         self.enclave.reset_query_sess()
         self.all_returned_keys.setText("")
         self.total_match.setText("")
-        # self.client.Qres = {}
-        # self.client.Qres_undec = {}
-        # self.client.unpadded_keys = []
 
 
     def insert(self):
@@ -244,7 +229,7 @@ class MyGUI(QMainWindow):
         values_insert = self.f_new_list.text()
         values_insert_list = values_insert.split(",")
         
-        # insert new key value to hashmap
+        # parse the new values
         try:
             new_int_list = [int(x, 10) for x in values_insert_list]
         except ValueError:
@@ -255,14 +240,6 @@ class MyGUI(QMainWindow):
             msg.exec_()
             return
 
-        if int(key_insert) in self.k2v:
-            for x in new_int_list:
-                self.k2v[int(key_insert)].append(x)
-        else:
-            self.k2v[int(key_insert)] = new_int_list
-
-        self.__update_partkey_range()
-
         msg = QMessageBox()
 
         if not hasattr(self,'client') or not hasattr(self,'enclave') or not key_insert.isnumeric() or len(values_insert_list) == 0:
@@ -272,16 +249,11 @@ class MyGUI(QMainWindow):
         else:
             add_token = self.client.add_token(int(key_insert), values_insert_list)
             new_blocks_L, pad_lens = self.enclave.add(add_token, self.Imm)
-            self.client.pad_len[int(key_insert)].extend(pad_lens)
-            print("Pad lengths for partkey:", key_insert, "->", self.client.pad_len[int(key_insert)])
-            if int(key_insert) in self.client.Qres:
-                for L, num_pad in zip(new_blocks_L, pad_lens):
-                    V, gamma = self.enclave.fetch(L, self.Imm, self.Qsgx)
-                    self.Qsgx.kL_store[int(key_insert)].append(L)
-                    self.Qsgx.LVg_store[L] = (V, gamma)
-                    self.client.Qres_undec[int(key_insert)].append(V)
-                    plaintext = [ciphertext ^ int(gamma, 2) for ciphertext in V][: self.client.p - num_pad]
-                    self.client.Qres[int(key_insert)].append(plaintext)
+            new_blocks = self.enclave.cache_new_blocks(int(key_insert), new_blocks_L, self.Imm, self.Qsgx)
+            self.client.dec_add_result(int(key_insert), new_blocks, pad_lens)
+            self.inserted.setdefault(int(key_insert), []).extend(new_int_list)
+            self.__update_partkey_range()
+            logger.info("Pad lengths for partkey: %s -> %s", key_insert, self.client.pad_len[int(key_insert)])
                     
             msg.setWindowTitle("Success!")
             msg.setIcon(QMessageBox.Information)
@@ -303,6 +275,7 @@ class MyGUI(QMainWindow):
 
 
 def main():
+    configure("INFO")
     app = QApplication([])
     window = MyGUI()
     window.setWindowTitle("HybrIDX Program")
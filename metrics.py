@@ -0,0 +1,237 @@
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import contextlib
+from bisect import bisect_left
+from collections import defaultdict
+
+
+# upper bounds of the timing histogram buckets, in seconds
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Histogram(object):
+    """
+        per-bucket counts of observed durations, plus their sum and count
+    """
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)      # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+            function to estimate a quantile as the upper bound of the bucket holding it
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics(object):
+    """
+        registry of counters and timing histograms for the client, enclave and storage
+        hot paths; disabled by default, every call site checks `metrics.enabled` first,
+        so that a disabled registry costs one attribute test per instrumented call
+    """
+    def __init__(self):
+        self.enabled = False
+        self.profiling = False                  # cProfile each profiled() section
+        self.profile_hook = None                # optional callback(name, cProfile.Profile) per section
+        self.lock = threading.Lock()            # the write-back worker reports from its own thread
+        self.reset()
+
+
+    def reset(self):
+        """
+            function to zero every counter and histogram and drop the profiles
+        """
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.profile_stats = None
+
+
+    def enable(self, profile=False, profile_hook=None):
+        """
+            function to start collecting
+            args:
+                profile: also run each profiled() section (one query, insert...) under cProfile
+                profile_hook: callback(name, profile) given each section's cProfile.Profile;
+                              the profiles are otherwise summed in profile_stats
+        """
+        self.enabled = True
+        self.profiling = profile
+        self.profile_hook = profile_hook
+
+
+    def disable(self):
+        self.enabled = False
+        self.profiling = False
+
+
+    def inc(self, name, value=1):
+        """
+            function to add to a counter
+        """
+        with self.lock:
+            self.counters[name] += value
+
+
+    def observe(self, name, seconds):
+        """
+            function to record a duration in a timing histogram
+        """
+        with self.lock:
+            self.histograms[name].observe(seconds)
+
+
+    def timer(self, name):
+        """
+            function to get a context that records its duration in a histogram,
+            a shared no-op context when disabled
+        """
+        if not self.enabled:
+            return NULL_CONTEXT
+        return _Timer(self, name)
+
+
+    def profiled(self, name):
+        """
+            function to get a context that times a section and, when profiling, runs
+            it under cProfile
+        """
+        if not self.enabled:
+            return NULL_CONTEXT
+        if not self.profiling:
+            return _Timer(self, name)
+        return self.__profile(name)
+
+
+    def section(self, name):
+        """
+            function to get a decorator that runs a whole function as a profiled()
+            section, calling it directly when disabled
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with self.profiled(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    @contextlib.contextmanager
+    def __profile(self, name):
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.observe(name, time.perf_counter() - start)
+            if self.profile_hook is not None:
+                self.profile_hook(name, profile)
+            else:
+                with self.lock:
+                    if self.profile_stats is None:
+                        self.profile_stats = pstats.Stats(profile)
+                    else:
+                        self.profile_stats.add(profile)
+
+
+    def snapshot(self):
+        """
+            function to get the counters and histogram summaries as a plain dict
+        """
+        with self.lock:
+            histograms = {}
+            for name, hist in self.histograms.items():
+                histograms[name] = {
+                    "count": hist.count,
+                    "sum": hist.sum,
+                    "mean": hist.sum / hist.count if hist.count else 0.0,
+                    "p50": hist.quantile(0.5),
+                    "p99": hist.quantile(0.99),
+                    "buckets": dict(zip([str(b) for b in hist.bounds] + ["+Inf"], hist.counts)),
+                }
+            return {"counters": dict(self.counters), "histograms": histograms}
+
+
+    def prometheus(self, prefix="hybridx", gauges=None):
+        """
+            function to render the metrics in the Prometheus text exposition format
+            args:
+                prefix: prefix of every metric name
+                gauges: optional dict of extra point-in-time values (cache size...)
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+                lines.append("{}_{}_total {}".format(prefix, name, self.counters[name]))
+            for name in sorted(self.histograms):
+                hist = self.histograms[name]
+                metric = "{}_{}".format(prefix, name)
+                lines.append("# TYPE {} histogram".format(metric))
+                cumulative = 0
+                for bound, count in zip([repr(b) for b in hist.bounds] + ["+Inf"], hist.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+                lines.append("{}_sum {}".format(metric, hist.sum))
+                lines.append("{}_count {}".format(metric, hist.count))
+        for name, value in sorted((gauges or {}).items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append("# TYPE {}_{} gauge".format(prefix, name))
+                lines.append("{}_{} {}".format(prefix, name, value))
+        return "\n".join(lines) + "\n"
+
+
+    def profile_report(self, sort="cumulative", limit=25):
+        """
+            function to get the summed cProfile statistics of the profiled sections as text
+        """
+        if self.profile_stats is None:
+            return ""
+        import io
+        out = io.StringIO()
+        self.profile_stats.stream = out
+        self.profile_stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class _Timer(object):
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+METRICS = Metrics()         # process-wide registry used by the instrumented modules
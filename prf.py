@@ -1,22 +1,34 @@
 import base64
 import hashlib
+import numpy as np
 from Crypto.Cipher import AES
+from metrics import METRICS
+
+
+LONG_MESSAGE = 1024       # bytes above which encrypt uses a one-shot CBC cipher
 
 
 class PRF():
     def __init__(self, key):
-        self.key = key
-        self.private_key = hashlib.sha256(self.key.encode()).digest()
         self.block_size = 16
         self.iv = b"1234567812345678"    # Random.new().read(AES.block_size)
+        self.set_key(key)
 
 
     def set_key(self, new_key):
+        """
+            function to change the key; the AES key schedule is expanded once here
+            and reused by every encrypt/decrypt call
+        """
         self.key = new_key
+        self.private_key = hashlib.sha256(self.key.encode()).digest()
+        self.__ecb = AES.new(self.private_key, AES.MODE_ECB)
+        self.__iv_int = int.from_bytes(self.iv, "big")
 
 
     def __pad(self, raw):
-        return raw + (self.block_size - len(raw) % self.block_size) * chr(self.block_size - len(raw) % self.block_size)
+        raw = raw.encode()
+        return raw + bytes([self.block_size - len(raw) % self.block_size]) * (self.block_size - len(raw) % self.block_size)
 
 
     @staticmethod
@@ -26,16 +38,82 @@ class PRF():
         return raw[:-bytes_to_remove]
 
 
+    def __cbc_encrypt(self, padded):
+        """
+            function to run AES-CBC with the fixed iv on top of the cached ECB cipher;
+        long messages (batch insert tokens) go through a native CBC cipher instead,
+        whose one key expansion is cheaper than a python loop over their blocks
+        """
+        if len(padded) > LONG_MESSAGE:
+            return self.iv + AES.new(self.private_key, AES.MODE_CBC, iv=self.iv).encrypt(padded)
+        out = [self.iv]
+        prev = self.__iv_int
+        for i in range(0, len(padded), self.block_size):
+            x = int.from_bytes(padded[i : i + self.block_size], "big") ^ prev
+            block = self.__ecb.encrypt(x.to_bytes(self.block_size, "big"))
+            prev = int.from_bytes(block, "big")
+            out.append(block)
+        return b"".join(out)
+
+
+    def encrypt_raw(self, raw):
+        """
+            function to encrypt a string and return iv || ciphertext as raw bytes
+        """
+        if METRICS.enabled:
+            METRICS.inc("prf_calls")
+        return self.__cbc_encrypt(self.__pad(raw))
+
+
     def encrypt(self, raw):
-        cipher = AES.new(self.private_key, AES.MODE_CBC, self.iv)
-        raw = self.__pad(raw)
-        return base64.b64encode(self.iv + cipher.encrypt(raw.encode())).decode("utf-8")
-    
+        return base64.b64encode(self.encrypt_raw(raw)).decode("utf-8")
+
+
+    def encrypt_many(self, raws, raw_bytes=False):
+        """
+            function to derive many pseudo-labels in one call
+            args:
+                raws: list of strings to encrypt
+                raw_bytes: return iv || ciphertext bytes instead of base64 strings
+            return:
+                list of labels, identical to calling encrypt (or encrypt_raw) on each string
+            note:
+                the i-th blocks of all messages are chained and encrypted with a single
+                ECB call, so a batch of short labels costs one AES invocation
+        """
+        if len(raws) == 0:
+            return []
+        if METRICS.enabled:
+            METRICS.inc("prf_calls")
+            METRICS.inc("prf_messages", len(raws))
+        bs = self.block_size
+        padded = [self.__pad(raw) for raw in raws]
+        num_blocks = np.array([len(x) // bs for x in padded])
+        width = int(num_blocks.max())
+        plain = np.frombuffer(b"".join(x.ljust(width * bs, b"\0") for x in padded), dtype=np.uint8)
+        plain = plain.reshape(len(padded), width, bs)
+        cipher = np.empty_like(plain)
+        prev = np.tile(np.frombuffer(self.iv, dtype=np.uint8), (len(padded), 1))
+        for j in range(width):
+            rows = np.flatnonzero(num_blocks > j)
+            x = plain[rows, j] ^ prev[rows]
+            c = np.frombuffer(self.__ecb.encrypt(x.tobytes()), dtype=np.uint8).reshape(-1, bs)
+            cipher[rows, j] = c
+            prev[rows] = c
+        labels = [self.iv + cipher[i, :n].tobytes() for i, n in enumerate(num_blocks)]
+        if raw_bytes:
+            return labels
+        return [base64.b64encode(L).decode("utf-8") for L in labels]
+
 
     def decrypt(self, enc):
-        enc = base64.b64decode(enc)
-        cipher = AES.new(self.private_key, AES.MODE_CBC, self.iv)
-        raw = cipher.decrypt(enc[self.block_size:]).decode("utf-8")
+        if METRICS.enabled:
+            METRICS.inc("prf_calls")
+        if isinstance(enc, str):
+            enc = base64.b64decode(enc)
+        enc = np.frombuffer(enc, dtype=np.uint8)
+        raw = np.frombuffer(self.__ecb.decrypt(enc[self.block_size:].tobytes()), dtype=np.uint8)
+        raw = (raw ^ enc[:-self.block_size]).tobytes().decode("utf-8")
         return self.__unpad(raw)
     
     
@@ -45,4 +123,4 @@ class PRF():
             ascii_val = ord(char)
             binary_val = '{0:08b}'.format(ascii_val)
             bin_str.append(binary_val)
-        return ''.join(bin_str)
\ No newline at end of file
+        return ''.join(bin_str)
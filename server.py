@@ -0,0 +1,483 @@
+import os
+import json
+import socket
+import signal
+import struct
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from metrics import METRICS
+from logs import configure, get_logger
+
+
+logger = get_logger("server")
+
+
+FRAME = struct.Struct("<II")        # length of the JSON header, length of the binary payload
+
+
+def pack_frame(header, payload=b""):
+    """
+        function to encode a message: a JSON header followed by a binary payload
+    """
+    body = json.dumps(header).encode("utf-8")
+    return FRAME.pack(len(body), len(payload)) + body + payload
+
+
+def encode_result(res_batch, R):
+    """
+        function to encode the (res_batch, R) of a query: partkeys, block counts and
+        masks go in the header, the blocks are the int64 payload
+    """
+    partkeys = list(res_batch.keys())
+    blocks = [V for partkey in partkeys for V, _ in res_batch[partkey]]
+    header = {
+        "R": R,
+        "partkeys": [int(partkey) for partkey in partkeys],
+        "counts": [len(res_batch[partkey]) for partkey in partkeys],
+        "gammas": [int(gamma) for partkey in partkeys for _, gamma in res_batch[partkey]],
+    }
+    payload = np.stack(blocks).astype("<i8").tobytes() if blocks else b""
+    return header, payload
+
+
+def decode_result(header, payload, p):
+    """
+        function to rebuild the (res_batch, R) of a query encoded by encode_result
+    """
+    blocks = np.frombuffer(payload, dtype="<i8").reshape(-1, p)
+    res_batch = {}
+    i = 0
+    for partkey, count in zip(header["partkeys"], header["counts"]):
+        res_batch[partkey] = list(zip(blocks[i : i + count], header["gammas"][i : i + count]))
+        i += count
+    return res_batch, header["R"]
+
+
+class QueryServer(object):
+    """
+        asyncio server exposing an Enclave, its cache Qsgx and the untrusted storage to
+        many clients over TCP or a Unix socket
+        the event loop handles every connection, while requests run on `workers` executor
+        threads. enclave operations hold the enclave lock, so enclave, cache and index
+        state is never mutated concurrently; a query is split into enclave steps and
+        storage steps (Enclave.prefetch and Enclave.release), and the storage steps run
+        outside the lock, so that a query waiting on the untrusted storage does not hold
+        up the others (storage calls are still made one at a time, under the enclave's
+        imm_lock). the evictions of a query are still written inside its enclave step,
+        unless the enclave write-back worker is started, which writes them while the
+        next requests are served
+        each connection names a client id in its hello message and gets its own query
+        session counter in the enclave
+        with the enclave append buffer started, tails past their age are also flushed
+        between requests every flush_interval seconds
+    """
+    def __init__(self, enclave, Imm, Qsgx, address=("127.0.0.1", 0), flush_interval=1.0, workers=4):
+        self.enclave = enclave
+        self.Imm = Imm
+        self.Qsgx = Qsgx
+        self.address = address
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hybridx-enclave")
+        self.lock = threading.Lock()    # held by the enclave steps of the requests
+        self.next_id = 0                # counter for the ids of anonymous clients
+        self.connections = 0            # number of open connections
+        self.flush_interval = flush_interval
+        self.flusher = None             # task flushing the append buffer, if enabled
+        self.server = None
+
+
+    async def start(self):
+        """
+            function to bind the socket and start accepting clients
+        """
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.server = await asyncio.start_unix_server(self.__handle, path=self.address)
+        else:
+            self.server = await asyncio.start_server(self.__handle, *self.address)
+            self.address = self.server.sockets[0].getsockname()[:2]
+        if self.enclave.appends is not None:
+            self.flusher = asyncio.ensure_future(self.__flush_appends())
+        return self
+
+
+    async def __flush_appends(self):
+        """
+            function to flush the tails past their age, on an executor thread
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await loop.run_in_executor(self.executor, self.__flush_locked)
+
+
+    def __flush_locked(self):
+        with self.lock:
+            self.enclave.flush_appends(self.Imm, self.Qsgx, False)
+
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+
+    async def stop(self):
+        """
+            function to stop accepting clients and release the socket
+        """
+        if self.flusher is not None:
+            self.flusher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+    async def __handle(self, reader, writer):
+        """
+            function to serve one connection: messages are answered in order
+        """
+        self.connections += 1
+        client_id = None
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    header_len, payload_len = FRAME.unpack(await reader.readexactly(FRAME.size))
+                    msg = json.loads(await reader.readexactly(header_len))
+                    await reader.readexactly(payload_len)
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    if msg.get("op") == "hello":
+                        client_id = msg.get("client_id") or self.__new_client_id()
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("request", extra={"fields": {"client_id": client_id, "op": msg.get("op")}})
+                    header, payload = await loop.run_in_executor(self.executor, self.dispatch, client_id, msg)
+                except Exception as e:
+                    logger.warning("request failed: %s: %s", type(e).__name__, e, extra={"fields": {"client_id": client_id, "op": msg.get("op")}})
+                    header, payload = {"error": "{}: {}".format(type(e).__name__, e)}, b""
+                writer.write(pack_frame(header, payload))
+                await writer.drain()
+        finally:
+            self.connections -= 1
+            writer.close()
+
+
+    def __new_client_id(self):
+        self.next_id += 1
+        return "anon-{}".format(self.next_id)
+
+
+    def dispatch(self, client_id, msg):
+        """
+            function to run one client message against the enclave (on an executor thread)
+            args:
+                client_id: id given by the connection's hello message
+                msg: decoded JSON header of the message
+            return:
+                (header, payload) of the answer
+        """
+        op = msg.get("op")
+        if op == "query":
+            return encode_result(*self.__search(self.enclave.plan_query, msg["token"], client_id, "query_seconds")[0])
+        if op == "queries":
+            results = [encode_result(res_batch, R) for res_batch, R in self.__search(self.enclave.plan_queries, msg["tokens"], client_id, "query_batch_seconds")]
+            return {"results": [header for header, _ in results]}, b"".join(payload for _, payload in results)
+        with self.lock:
+            return self.__dispatch_locked(client_id, msg)
+
+
+    def __search(self, plan_fn, tokens, client_id, timer):
+        """
+            function to run queries with only their enclave steps under the lock: the
+            blocks are read from and deleted on the untrusted storage outside of it
+            args:
+                plan_fn: Enclave.plan_query or Enclave.plan_queries
+                tokens: token or tokens, as taken by plan_fn
+                timer: histogram of the query time, as recorded by Enclave.search_query
+            return:
+                list of (res_batch, R), one per query
+        """
+        if client_id is None:
+            raise ValueError("the first message of a connection must be hello")
+        with METRICS.timer(timer):
+            with self.lock:
+                plan = plan_fn(tokens, self.Qsgx, client_id)
+            fetched = self.enclave.prefetch(plan, self.Imm)
+            consumed = []
+            try:
+                with self.lock:
+                    results = self.enclave.finish_queries(plan, fetched, self.Imm, self.Qsgx, consumed)
+            finally:
+                # the blocks cached before a failure must still leave the storage
+                self.enclave.release(consumed, self.Imm)
+        return results
+
+
+    def __dispatch_locked(self, client_id, msg):
+        op = msg.get("op")
+        if op == "hello":
+            return {"client_id": client_id, "s": self.enclave.session_number(client_id), "p": self.enclave.p}, b""
+        if client_id is None:
+            raise ValueError("the first message of a connection must be hello")
+        if op == "add":
+            new_blocks, pad_lens, start = self.enclave.add_query(msg["token"], self.Imm, self.Qsgx, client_id)
+            payload = np.stack([V for V, _ in new_blocks]).astype("<i8").tobytes() if new_blocks else b""
+            return {"pad_lens": pad_lens, "gammas": [int(gamma) for _, gamma in new_blocks], "start": start}, payload
+        if op == "add_batch":
+            results = self.enclave.add_batch_query(msg["token"], self.Imm, self.Qsgx, client_id)
+            header, payload = encode_result({partkey: new_blocks for partkey, (new_blocks, _, _) in results.items()}, None)
+            header["pad_lens"] = [pad_lens for _, pad_lens, _ in results.values()]
+            header["starts"] = [start for _, _, start in results.values()]
+            return header, payload
+        if op == "compact":
+            results = self.enclave.compact_query(msg["token"], self.Imm, self.Qsgx, client_id)
+            return {"pads": {str(partkey): pads for partkey, pads in results.items()}}, b""
+        if op == "reset":
+            self.enclave.reset_query_sess(client_id)
+            return {}, b""
+        if op == "metrics":
+            gauges = self.gauges()
+            return {"metrics": METRICS.snapshot(), "gauges": gauges, "prometheus": METRICS.prometheus(gauges=gauges)}, b""
+        raise ValueError("unknown op {}".format(op))
+
+
+    def gauges(self):
+        """
+            function to get the point-in-time values exported next to the metrics
+        """
+        gauges = {"cache_" + name: value for name, value in self.Qsgx.stats().items()}
+        if self.enclave.writeback is not None:
+            gauges.update({"writeback_" + name: value for name, value in self.enclave.writeback.metrics().items()})
+        if self.enclave.appends is not None:
+            gauges.update({"appends_" + name: value for name, value in self.enclave.appends.stats().items()})
+        gauges["connections"] = self.connections
+        gauges["sessions"] = len(self.enclave.sessions)
+        return gauges
+
+
+class QueryConnection(object):
+    """
+        blocking client of the QueryServer: wraps a Client, whose tokens are sent over
+        one reused connection and whose results are decrypted locally
+    """
+    def __init__(self, address, client):
+        self.client = client
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile("rb")
+        header, _ = self.__call({"op": "hello", "client_id": client.client_id})
+        if header["p"] != client.p:
+            raise ValueError("server enclave has p={}, client has p={}".format(header["p"], client.p))
+        # resume the session counter the enclave keeps for this client
+        client.client_id = header["client_id"]
+        client.s = header["s"]
+
+
+    def __call(self, msg):
+        self.sock.sendall(pack_frame(msg))
+        header_len, payload_len = FRAME.unpack(self.__recv(FRAME.size))
+        header = json.loads(self.__recv(header_len))
+        payload = self.__recv(payload_len)
+        if "error" in header:
+            raise RuntimeError(header["error"])
+        return header, payload
+
+
+    def __recv(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise ConnectionError("connection closed by the query server")
+        return data
+
+
+    def query(self, partkey, cmp, q):
+        """
+            function to run a range query on the server
+            return:
+                total number of matched partkeys n; the results are in client.Qres
+        """
+        token = self.client.enc_token(partkey, cmp, q)
+        header, payload = self.__call({"op": "query", "token": token})
+        res_batch, R = decode_result(header, payload, self.client.p)
+        return self.client.dec_enclave_msg(R, res_batch)
+
+
+    def query_stream(self, partkey, cmp, q):
+        """
+            function to run a range query on the server, decrypting the result lazily
+            return:
+                n: total number of matched partkeys
+                results: generator of (partkey, values), see Client.dec_enclave_stream
+        """
+        token = self.client.enc_token(partkey, cmp, q)
+        header, payload = self.__call({"op": "query", "token": token})
+        res_batch, R = decode_result(header, payload, self.client.p)
+        return self.client.dec_enclave_stream(R, res_batch)
+
+
+    def queries(self, predicates):
+        """
+            function to run a batch of range queries on the server
+            args:
+                predicates: list of (partkey, cmp, q)
+            return:
+                list of the total match counts n, one per query
+        """
+        tokens = self.client.enc_tokens(predicates)
+        header, payload = self.__call({"op": "queries", "tokens": tokens})
+        results = []
+        offset = 0
+        for res in header["results"]:
+            size = sum(res["counts"]) * self.client.p * 8
+            results.append(decode_result(res, payload[offset : offset + size], self.client.p))
+            offset += size
+        return self.client.dec_enclave_msgs(results)
+
+
+    def insert(self, partkey, values):
+        """
+            function to insert new values for a partkey on the server
+            return:
+                pad lengths of the new blocks
+        """
+        token = self.client.add_token(int(partkey), [str(v) for v in values])
+        header, payload = self.__call({"op": "add", "token": token})
+        new_blocks = list(zip(np.frombuffer(payload, dtype="<i8").reshape(-1, self.client.p), header["gammas"]))
+        self.client.dec_add_result(int(partkey), new_blocks, header["pad_lens"], header["start"])
+        return header["pad_lens"]
+
+
+    def insert_many(self, items):
+        """
+            function to insert the values of many partkeys on the server in one message
+            args:
+                items: dict or iterable of (partkey, values)
+            return:
+                dict partkey -> pad lengths of its new blocks
+        """
+        token = self.client.add_batch_token(items)
+        header, payload = self.__call({"op": "add_batch", "token": token})
+        res_batch, _ = decode_result(header, payload, self.client.p)
+        results = {partkey: (res_batch[partkey], pad_lens, start) for partkey, pad_lens, start in zip(header["partkeys"], header["pad_lens"], header["starts"])}
+        self.client.dec_add_batch_result(results)
+        return {partkey: pad_lens for partkey, (_, pad_lens, _) in results.items()}
+
+
+    def compact(self, partkeys=None, min_saving=1):
+        """
+            function to repack partkeys into the fewest blocks on the server, as for
+            Client.compact_token
+            return:
+                dict partkey -> new pad lengths of the compacted partkeys
+        """
+        header, _ = self.__call({"op": "compact", "token": self.client.compact_token(partkeys, min_saving)})
+        results = {int(partkey): pads for partkey, pads in header["pads"].items()}
+        self.client.dec_compact_result(results)
+        return results
+
+
+    def metrics(self):
+        """
+            function to get the server metrics
+            return:
+                dict with the metrics snapshot, gauges and Prometheus text
+        """
+        header, _ = self.__call({"op": "metrics"})
+        return header
+
+
+    def reset(self):
+        """
+            function to reset the query session on both the client and the server
+        """
+        self.__call({"op": "reset"})
+        self.client.reset_query_sess()
+
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a HybrIDX enclave to query clients")
+    parser.add_argument("store", help="on-disk L-V store written by diskstore.write_store")
+    parser.add_argument("state", help="enclave state written by Enclave.save_state")
+    parser.add_argument("--k1", default=os.environ.get("HYBRIDX_K1"), help="secret key 1, or $HYBRIDX_K1")
+    parser.add_argument("--k2", default=os.environ.get("HYBRIDX_K2"), help="secret key 2, or $HYBRIDX_K2")
+    parser.add_argument("--cache", type=int, default=25, help="cache capacity in partkeys")
+    parser.add_argument("--gamma-len", type=int, default=4)
+    parser.add_argument("--writeback", action="store_true", help="write evicted partkeys back in a background thread")
+    parser.add_argument("--metrics", action="store_true", help="collect metrics, served by the metrics message")
+    parser.add_argument("--append-buffer", action="store_true", help="coalesce small inserts into full blocks in the enclave")
+    parser.add_argument("--append-max-values", type=int, default=65536, help="values buffered before the oldest tails are flushed")
+    parser.add_argument("--append-max-age", type=float, default=60.0, help="seconds a partial block is buffered")
+    parser.add_argument("--workers", type=int, default=4, help="threads serving requests; a query waiting on the storage does not block the others")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7071)
+    parser.add_argument("--unix", help="Unix socket path, used instead of --host/--port")
+    parser.add_argument("--log-level", help="DEBUG, INFO, WARNING (default, or $HYBRIDX_LOG_LEVEL)...")
+    parser.add_argument("--log-format", default="text", choices=["text", "json"])
+    args = parser.parse_args()
+    configure(args.log_level, args.log_format)
+    if not args.k1 or not args.k2:
+        parser.error("the secret keys must be given with --k1/--k2 or $HYBRIDX_K1/$HYBRIDX_K2")
+
+    from prf import PRF
+    from cache import Qsgx
+    from enclave import Enclave
+    from diskstore import MappedStorage
+    if args.metrics:
+        METRICS.enable()
+    Imm = MappedStorage(args.store)
+    enclave = Enclave(p=Imm.p, k1=args.k1, k2=args.k2, prf=PRF, node_list=[], gamma_len=args.gamma_len)
+    enclave.load_state(args.state, Imm)
+    if args.writeback:
+        enclave.start_writeback(Imm)
+    if args.append_buffer:
+        enclave.start_appends(args.append_max_values, args.append_max_age)
+    cache = Qsgx(args.cache)
+    server = QueryServer(enclave, Imm, cache, args.unix or (args.host, args.port), flush_interval=min(1.0, args.append_max_age), workers=args.workers)
+
+    async def run():
+        await server.start()
+        print("Serving HybrIDX queries on", server.address)
+        # stop cleanly on SIGINT and SIGTERM, so that the state below is saved
+        serving = asyncio.ensure_future(server.serve_forever())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, serving.cancel)
+        try:
+            await serving
+        except asyncio.CancelledError:
+            pass
+        await server.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        # put the buffered and cached blocks back and save the bumped counters t and sessions
+        enclave.stop_appends(Imm, cache)
+        enclave.stop_writeback()
+        for partkey in list(cache.kL_store.keys()):
+            enclave.rebuild(partkey, cache, Imm)
+        cache.clear()
+        enclave.save_state(args.state, cache)
+        Imm.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import copy
+import random
+import pytest
+
+
+# the modules live flat at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prf import PRF                                     # noqa: E402
+from cache import Qsgx                                  # noqa: E402
+from client import Client                               # noqa: E402
+from enclave import Enclave                             # noqa: E402
+from untrusted import UntrustedStorage, ColumnarStorage # noqa: E402
+
+
+K1 = "rtlZ6JzAq3q8ftuUW3zVuJyd5-NIfzVIVxkK4-6m-vI="
+K2 = "GKgkrTc5_EFQmU0mPnMGJRKaC0kJ_az58y0dQNwp52I="
+
+
+class Store(object):
+    """
+        client, enclave, cache and untrusted storage of a small random dataset
+    """
+    def __init__(self, p=3, cache=3, num_partkeys=20, columnar=False, seed=7):
+        rng = random.Random(seed)
+        self.p = p
+        self.k2v = {partkey: [rng.randint(-1000, 1000) for _ in range(rng.randint(1, 4 * p))] for partkey in rng.sample(range(10, 1000), num_partkeys)}
+        self.Imm = ColumnarStorage(p) if columnar else UntrustedStorage({})
+        self.client = Client(p=p, k1=K1, k2=K2, prf=PRF, gamma_len=4)
+        for partkey, values in self.k2v.items():
+            self.client.process_records(partkey, values, self.Imm)
+        self.enclave = Enclave(p=p, k1=K1, k2=K2, prf=PRF, node_list=self.client.node_list)
+        self.Qsgx = Qsgx(cache)
+
+
+    def new_client(self, client_id):
+        """
+            function to get another client of the store, with a copy of the pad lengths
+        """
+        client = Client(p=self.p, k1=K1, k2=K2, prf=PRF, gamma_len=4, client_id=client_id)
+        client.pad_len = copy.deepcopy(self.client.pad_len)
+        return client
+
+
+    def query(self, partkey, cmp, q, client=None):
+        """
+            function to run one query end to end
+            return:
+                n and the dict partkey -> values of the results
+        """
+        client = client or self.client
+        res_batch, R = self.enclave.search_query(client.enc_token(partkey, cmp, q), self.Imm, self.Qsgx, client.client_id)
+        n, results = client.dec_enclave_stream(R, res_batch)
+        return n, {partkey: values.tolist() for partkey, values in results}
+
+
+    def expected(self, partkey, cmp, q):
+        keys = sorted(self.k2v)
+        matched = [k for k in keys if k >= partkey] if cmp == ">=" else [k for k in keys if k <= partkey]
+        shown = (matched[:q] if cmp == ">=" else matched[len(matched) - q :]) if q > 0 else []
+        return len(matched) if shown else 0, {k: self.k2v[k] for k in shown}
+
+
+    def stored_blocks(self):
+        """
+            function to count the blocks held by the storage and the cache, and the
+            blocks the index expects
+        """
+        return len(self.Imm) + self.Qsgx.num_blocks, sum(node.c for node in self.enclave.traverse())
+
+
+@pytest.fixture
+def store():
+    return Store()
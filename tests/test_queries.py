@@ -0,0 +1,134 @@
+import pytest
+
+
+def test_query(store):
+    for partkey, cmp, q in [(0, ">=", 3), (500, ">=", 2), (500, "<=", 4), (2000, "<=", 5)]:
+        assert store.query(partkey, cmp, q) == store.expected(partkey, cmp, q)
+
+
+def test_empty_match(store):
+    for partkey, cmp, q in [(5000, ">=", 2), (0, "<=", 2), (500, ">=", 0), (500, "<=", 0)]:
+        assert store.query(partkey, cmp, q) == (0, {})
+    assert store.query(0, ">=", 2) == store.expected(0, ">=", 2)
+
+
+def test_empty_match_in_batch(store):
+    predicates = [(0, ">=", 3), (5000, ">=", 2), (2000, "<=", 2), (0, "<=", 1), (500, ">=", 0)]
+    tokens = store.client.enc_tokens(predicates)
+    results = store.enclave.search_queries(tokens, store.Imm, store.Qsgx)
+    assert store.client.dec_enclave_msgs(results) == [store.expected(*predicate)[0] for predicate in predicates]
+    for (res_batch, _), predicate in zip(results, predicates):
+        assert sorted(res_batch) == sorted(store.expected(*predicate)[1])
+    assert store.stored_blocks()[0] == store.stored_blocks()[1]
+
+
+def test_failed_query_releases_cached_blocks(store, tmp_path, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("remask failed")
+    monkeypatch.setattr(store.enclave, "remask", fail)
+    tokens = store.client.enc_tokens([(0, ">=", 3), (500, "<=", 2)])
+    with pytest.raises(RuntimeError):
+        store.enclave.search_queries(tokens, store.Imm, store.Qsgx)
+    assert len(store.Qsgx.kL_store)
+    stored, indexed = store.stored_blocks()
+    assert stored == indexed
+    # the store restarts once the cache is rebuilt
+    monkeypatch.undo()
+    for partkey in list(store.Qsgx.kL_store):
+        store.enclave.rebuild(partkey, store.Qsgx, store.Imm)
+    store.Qsgx.clear()
+    store.enclave.save_state(tmp_path / "enclave.npz", store.Qsgx)
+    store.enclave.load_state(tmp_path / "enclave.npz", store.Imm)
+
+
+def test_pads_shared_across_clients(store):
+    partkey = sorted(store.k2v)[3]
+    reader = store.new_client("reader")
+    writer = store.new_client("writer")
+    for values in ([1, 2], [3, 4, 5, 6, 7], [8]):
+        token = writer.add_token(partkey, [str(v) for v in values])
+        writer.dec_add_result(partkey, *store.enclave.add_query(token, store.Imm, store.Qsgx, "writer"))
+        store.k2v[partkey].extend(values)
+        assert store.query(partkey, ">=", 1, reader) == store.expected(partkey, ">=", 1)
+    results = store.enclave.compact_query(writer.compact_token([partkey]), store.Imm, store.Qsgx, "writer")
+    assert partkey in results
+    writer.dec_compact_result(results)
+    assert store.query(partkey, "<=", 1, reader) == store.expected(partkey, "<=", 1)
+    assert reader.pad_len[partkey] == writer.pad_len[partkey]
+
+
+def test_pads_saved_with_the_state(store, tmp_path):
+    partkey = sorted(store.k2v)[0]
+    token = store.client.add_token(partkey, ["5", "6"])
+    store.client.dec_add_result(partkey, *store.enclave.add_query(token, store.Imm, store.Qsgx))
+    store.k2v[partkey].extend([5, 6])
+    for key in list(store.Qsgx.kL_store):
+        store.enclave.rebuild(key, store.Qsgx, store.Imm)
+    store.Qsgx.clear()
+    store.enclave.save_state(tmp_path / "enclave.npz", store.Qsgx)
+    pads = {node.partkey: node.pads for node in store.enclave.traverse()}
+    store.enclave.load_state(tmp_path / "enclave.npz", store.Imm)
+    assert {node.partkey: node.pads for node in store.enclave.traverse()} == pads
+    reader = store.new_client("reader")
+    reader.pad_len.clear()
+    assert store.query(partkey, ">=", 2, reader) == store.expected(partkey, ">=", 2)
+
+
+def test_add_with_appends(store):
+    partkey = sorted(store.k2v)[2]
+    store.enclave.start_appends()
+    token = store.client.add_token(partkey, ["1"])
+    store.client.dec_add_result(partkey, *store.enclave.add_query(token, store.Imm, store.Qsgx))
+    store.k2v[partkey].append(1)
+    with pytest.raises(RuntimeError):
+        store.enclave.add(store.client.add_token(partkey, ["2", "3", "4"]), store.Imm)
+    with pytest.raises(RuntimeError):
+        store.enclave.add_batch(store.client.add_batch_token({partkey: [2, 3, 4], 7: [5]}), store.Imm)
+    # the rejected inserts changed nothing
+    assert len(store.enclave.appends.values(partkey)) == 1
+    assert store.query(partkey, ">=", 1) == store.expected(partkey, ">=", 1)
+    token = store.client.add_batch_token({partkey: [2, 3, 4], 7: [5]})
+    store.client.dec_add_batch_result(store.enclave.add_batch_query(token, store.Imm, store.Qsgx))
+    store.k2v[partkey].extend([2, 3, 4])
+    store.k2v[7] = [5]
+    store.enclave.stop_appends(store.Imm, store.Qsgx)
+    for key in (partkey, 7):
+        assert store.query(key, ">=", 1) == store.expected(key, ">=", 1)
+    token = store.client.add_token(partkey, ["6"])
+    L_list, pad_lens = store.enclave.add(token, store.Imm)
+    store.enclave.cache_new_blocks(partkey, L_list, store.Imm, store.Qsgx)
+    store.client.pad_len[partkey].extend(pad_lens)
+    store.k2v[partkey].append(6)
+    assert store.query(partkey, ">=", 1) == store.expected(partkey, ">=", 1)
+
+
+def test_compact_then_insert_uses_new_labels(store):
+    partkey = sorted(store.k2v)[4]
+    written = list(store.Imm.storage)
+    multi_set = store.Imm.multi_set
+    def record(L_list, V_blocks, gammas):
+        written.extend(L_list)
+        return multi_set(L_list, V_blocks, gammas)
+    store.Imm.multi_set = record
+    for values in ([1], [2, 3], [4]):
+        token = store.client.add_token(partkey, [str(v) for v in values])
+        store.client.dec_add_result(partkey, *store.enclave.add_query(token, store.Imm, store.Qsgx))
+        store.k2v[partkey].extend(values)
+    for cached in (True, False):
+        if cached:
+            assert store.query(partkey, ">=", 1) == store.expected(partkey, ">=", 1)
+        results = store.enclave.compact_query(store.client.compact_token([partkey]), store.Imm, store.Qsgx)
+        assert partkey in results
+        store.client.dec_compact_result(results)
+        token = store.client.add_token(partkey, ["5", "6"])
+        store.client.dec_add_result(partkey, *store.enclave.add_query(token, store.Imm, store.Qsgx))
+        store.k2v[partkey].extend([5, 6])
+        if cached:
+            store.enclave.retire(partkey, store.Qsgx, store.Imm)
+        assert store.query(partkey, "<=", 1) == store.expected(partkey, "<=", 1)
+        token = store.client.add_token(partkey, ["7"])
+        store.client.dec_add_result(partkey, *store.enclave.add_query(token, store.Imm, store.Qsgx))
+        store.k2v[partkey].append(7)
+        store.enclave.retire(partkey, store.Qsgx, store.Imm)
+    assert len(written) == len(set(written))
+    assert store.query(partkey, ">=", 1) == store.expected(partkey, ">=", 1)
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import pytest
+from server import QueryServer, QueryConnection
+
+
+@pytest.fixture
+def server(store):
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    srv = QueryServer(store.enclave, store.Imm, store.Qsgx)
+    asyncio.run_coroutine_threadsafe(srv.start(), loop).result()
+    yield srv
+    asyncio.run_coroutine_threadsafe(srv.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def values(conn, partkey):
+    return conn.client.get_result(partkey).tolist()
+
+
+def test_queries_with_empty_matches(store, server):
+    conn = QueryConnection(server.address, store.new_client("a"))
+    predicates = [(0, ">=", 2), (5000, ">=", 2), (0, "<=", 2), (500, "<=", 0)]
+    assert conn.queries(predicates) == [store.expected(*predicate)[0] for predicate in predicates]
+    assert conn.query(5000, ">=", 3) == 0
+    stored, indexed = store.stored_blocks()
+    assert stored == indexed
+    conn.close()
+
+
+def test_insert_seen_by_another_client(store, server):
+    partkey = sorted(store.k2v)[5]
+    writer = QueryConnection(server.address, store.new_client("writer"))
+    reader = QueryConnection(server.address, store.new_client("reader"))
+    writer.insert(partkey, [7, 8])
+    writer.insert_many({partkey: [9], partkey + 1: [10, 11]})
+    store.k2v[partkey].extend([7, 8, 9])
+    store.k2v[partkey + 1] = [10, 11]
+    for key in (partkey, partkey + 1):
+        assert reader.query(key, ">=", 1) == store.expected(key, ">=", 1)[0]
+        assert values(reader, key) == store.k2v[key]
+    writer.compact([partkey])
+    assert reader.query(partkey, "<=", 1) == store.expected(partkey, "<=", 1)[0]
+    assert values(reader, partkey) == store.k2v[partkey]
+    writer.close()
+    reader.close()
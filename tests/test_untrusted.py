@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from untrusted import ColumnarStorage, table_size
+
+
+def labels(n):
+    return [("label-%d" % i).encode() for i in range(n)]
+
+
+def test_table_size_is_a_power_of_two():
+    for n in (0, 1, 3, 1000, 2048, 2049):
+        size = table_size(n)
+        assert size >= n and size & (size - 1) == 0
+
+
+@pytest.mark.parametrize("capacity", [0, 1, 3, 1000])
+def test_capacity_not_a_power_of_two(capacity):
+    Imm = ColumnarStorage(p=8, capacity=capacity)
+    L_list = labels(3000)
+    blocks = np.arange(3000 * 8, dtype=np.int64).reshape(-1, 8)
+    Imm.multi_set(L_list, blocks, list(range(3000)))
+    assert len(Imm) == 3000 and len(Imm.table) & (len(Imm.table) - 1) == 0
+    assert labels(1)[0] in Imm and b"missing" not in Imm
+    V, gamma = Imm.get_block(L_list[1234])
+    assert V.tolist() == blocks[1234].tolist() and gamma == 1234
+    assert Imm.multi_del(L_list[:1000]) == 1000
+    assert L_list[0] not in Imm and L_list[2999] in Imm
+
+
+def test_load_arrays_not_a_power_of_two():
+    Imm = ColumnarStorage(p=2, label_width=16, capacity=100)
+    raw = np.zeros((500, 16), dtype=np.uint8)
+    raw[:, :8] = np.arange(500, dtype=np.int64).view(np.uint8).reshape(500, 8)
+    Imm.load_arrays(raw, np.ones((500, 2), dtype=np.int64), np.arange(500))
+    assert len(Imm) == 500 and all(row.tobytes() in Imm for row in raw)
@@ -0,0 +1,390 @@
+import os
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+import numpy as np
+from logs import get_logger
+from untrusted import label_key
+
+
+logger = get_logger("transport")
+
+
+REQUEST = struct.Struct("<BI")          # op, number of labels in the frame
+RESPONSE = struct.Struct("<BQ")         # status, count (blocks, or the LEN/NBYTES answer)
+LAYOUT = struct.Struct("<qq")           # p, label_width
+OP_HELLO = 1
+OP_GET = 2
+OP_SET = 3
+OP_DEL = 4
+OP_LEN = 5
+OP_NBYTES = 6
+STATUS_OK = 0
+STATUS_MISSING = 1                      # some labels of a GET/DEL frame were not stored
+
+
+def recv_exact(rfile, n):
+    """
+        function to read exactly n bytes from a buffered socket file into a bytearray
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = rfile.readinto(view[got:])
+        if not k:
+            raise ConnectionError("connection closed by peer")
+        got += k
+    return buf
+
+
+def split_labels(data, n, label_width):
+    """
+        function to cut a frame payload into n fixed-width label keys
+    """
+    return [bytes(data[i * label_width : (i + 1) * label_width]) for i in range(n)]
+
+
+class _StorageHandler(socketserver.StreamRequestHandler):
+    """
+        one connection of the storage server: frames are answered in order until the
+        client closes the connection, so a client may pipeline several frames
+        frames (little-endian):
+            request:  op (u8), n (u32), then n label keys of label_width bytes; SET
+                      frames then carry n gammas (i64) and n blocks (i64[p])
+            response: status (u8), count (u64); GET responses then carry n found
+                      flags (u8), n gammas and n blocks, missing blocks zeroed
+    """
+    def setup(self):
+        super().setup()
+        if self.request.family != socket.AF_UNIX:
+            # acknowledgements of pipelined frames are small writes, do not hold them back
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+    def handle(self):
+        server = self.server.storage_server
+        p, width = server.p, server.label_width
+        while True:
+            header = self.rfile.read(REQUEST.size)
+            if len(header) < REQUEST.size:
+                return
+            op, n = REQUEST.unpack(header)
+            if op == OP_HELLO:
+                self.wfile.write(RESPONSE.pack(STATUS_OK, 0) + LAYOUT.pack(p, width))
+                continue
+            if op in (OP_LEN, OP_NBYTES):
+                with server.lock:
+                    count = len(server.Imm) if op == OP_LEN else server.Imm.nbytes()
+                self.wfile.write(RESPONSE.pack(STATUS_OK, count))
+                continue
+            keys = split_labels(recv_exact(self.rfile, n * width), n, width)
+            if op == OP_GET:
+                found = np.zeros(n, dtype=np.uint8)
+                gammas = np.zeros(n, dtype="<i8")
+                values = np.zeros((n, p), dtype="<i8")
+                with server.lock:
+                    entries = server.Imm.multi_get(keys)
+                for i, entry in enumerate(entries):
+                    if entry is not None:
+                        found[i] = 1
+                        values[i] = entry[0]
+                        gammas[i] = entry[1]
+                status = STATUS_OK if found.all() else STATUS_MISSING
+                self.wfile.write(RESPONSE.pack(status, n) + found.tobytes() + gammas.tobytes() + values.tobytes())
+            elif op == OP_SET:
+                gammas = np.frombuffer(recv_exact(self.rfile, n * 8), dtype="<i8")
+                values = np.frombuffer(recv_exact(self.rfile, n * p * 8), dtype="<i8").reshape(n, p)
+                with server.lock:
+                    server.Imm.multi_set(keys, values.astype(np.int64), gammas.tolist())
+                self.wfile.write(RESPONSE.pack(STATUS_OK, n))
+            elif op == OP_DEL:
+                with server.lock:
+                    deleted = server.Imm.multi_del(keys)
+                self.wfile.write(RESPONSE.pack(STATUS_OK if deleted == n else STATUS_MISSING, deleted))
+            else:
+                raise ValueError("unknown storage op {}".format(op))
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class StorageServer(object):
+    """
+        stand-in for an outsourced untrusted server: serves an UntrustedStorage,
+        ColumnarStorage or MappedStorage over TCP or a Unix socket, one thread per
+        connection, with the store itself guarded by a lock
+        labels arrive as fixed-width label keys, so a store built in process should be
+        a ColumnarStorage or MappedStorage (which key base64 labels the same way)
+    """
+    def __init__(self, Imm, address=("127.0.0.1", 0), p=None, label_width=None):
+        self.Imm = Imm
+        self.p = p or Imm.p
+        self.label_width = label_width or getattr(Imm, "label_width", 48)
+        self.lock = threading.Lock()
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = _UnixServer(address, _StorageHandler)
+        else:
+            self.server = _TCPServer(address, _StorageHandler)
+        self.server.storage_server = self
+        self.address = self.server.server_address       # the bound port if port 0 was asked
+        self.thread = None
+
+
+    def start(self):
+        """
+            function to serve in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name="hybridx-storage", daemon=True)
+        self.thread.start()
+        return self
+
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+
+    def stop(self):
+        """
+            function to stop serving and release the socket
+        """
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class RemoteStorage(object):
+    """
+        client side of the storage server, with the same interface as the in-process
+        stores. one connection is opened and reused for every call. writes are
+        pipelined: SET frames are buffered and their acknowledgements read only when
+        a read or a delete needs the connection, or on sync(); multi_get and multi_del
+        split large batches into frames of batch_size labels that are all sent, with
+        the buffered writes, before any answer is read
+    """
+    def __init__(self, address, batch_size=4096, max_pending_bytes=1 << 20):
+        self.address = address
+        self.batch_size = batch_size                # labels per frame
+        self.max_pending_bytes = max_pending_bytes  # buffered write frames before a send
+        self.lock = threading.Lock()                # one request stream, shared by threads
+        self.out = bytearray()                      # frames not sent yet
+        self.pending = []                           # number of labels of each unacknowledged write frame
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile("rb")
+        with self.lock:
+            self.out += REQUEST.pack(OP_HELLO, 0)
+            self.__response()
+            self.p, self.label_width = LAYOUT.unpack(recv_exact(self.rfile, LAYOUT.size))
+
+
+    def __keys(self, L_list):
+        return b"".join(label_key(L, self.label_width) for L in L_list)
+
+
+    def __send(self):
+        if self.out:
+            self.sock.sendall(self.out)
+            self.out = bytearray()
+
+
+    def __response(self):
+        """
+            function to send the buffered frames, drain the acknowledgements of earlier
+            writes, then read the header of the next response
+        """
+        self.__send()
+        self.__acks()
+        return RESPONSE.unpack(recv_exact(self.rfile, RESPONSE.size))
+
+
+    def __acks(self):
+        self.__send()
+        for n in self.pending:
+            status, _ = RESPONSE.unpack(recv_exact(self.rfile, RESPONSE.size))
+            if status == STATUS_MISSING:
+                logger.warning("Wrong label, cannot delete cipherblock.")
+        self.pending = []
+
+
+    def __write(self, frame, n):
+        self.out += frame
+        self.pending.append(n)
+        if len(self.out) >= self.max_pending_bytes:
+            self.__send()
+
+
+    def sync(self):
+        """
+            function to wait until every buffered write is acknowledged by the server
+        """
+        with self.lock:
+            self.__acks()
+
+
+    def close(self):
+        self.sync()
+        self.rfile.close()
+        self.sock.close()
+
+
+    def __len__(self):
+        with self.lock:
+            self.out += REQUEST.pack(OP_LEN, 0)
+            return self.__response()[1]
+
+
+    def nbytes(self):
+        """
+            function to get the memory footprint of the store, as reported by the server
+        """
+        with self.lock:
+            self.out += REQUEST.pack(OP_NBYTES, 0)
+            return self.__response()[1]
+
+
+    def get_block(self, L):
+        """
+            function to get ciphertext block from pseudo-label
+            args:
+                L: pseudo-label of the block
+            return:
+                V: ciphertext block
+                gamma: the integer to decrypt V
+        """
+        return self.multi_get([L])[0]
+
+
+    def set_block(self, L, V_new, gamma_new):
+        """
+            function to set new value for a ciphertext block
+        """
+        self.multi_set([L], [V_new], [gamma_new])
+
+
+    def del_block(self, L):
+        """
+            function to delete a block from the storage using its label
+        """
+        self.multi_del([L])
+
+
+    def multi_get(self, L_list):
+        """
+            function to get the ciphertext blocks of several pseudo-labels in one round trip
+            args:
+                L_list: pseudo-labels of the blocks
+            return:
+                list of (V, gamma), None for a label that is not stored
+        """
+        frames = [L_list[i : i + self.batch_size] for i in range(0, len(L_list), self.batch_size)]
+        res = []
+        with self.lock:
+            for frame in frames:
+                self.out += REQUEST.pack(OP_GET, len(frame)) + self.__keys(frame)
+            self.__send()
+            self.__acks()
+            missing = False
+            for frame in frames:
+                n = len(frame)
+                status, _ = RESPONSE.unpack(recv_exact(self.rfile, RESPONSE.size))
+                found = recv_exact(self.rfile, n)
+                gammas = np.frombuffer(recv_exact(self.rfile, n * 8), dtype="<i8").tolist()
+                values = np.frombuffer(recv_exact(self.rfile, n * self.p * 8), dtype="<i8").reshape(n, self.p)
+                for i in range(n):
+                    res.append((values[i], gammas[i]) if found[i] else None)
+                missing |= status == STATUS_MISSING
+        if missing:
+            logger.warning("Pseudo-label is not correct. Cannot access the cipher block!")
+        return res
+
+
+    def multi_set(self, L_list, V_blocks, gammas):
+        """
+            function to set several ciphertext blocks, pipelined with the next requests
+            args:
+                L_list: pseudo-labels of the blocks
+                V_blocks: new blocks, a (len(L_list), p) array or a list of blocks
+                gammas: integer masks of the blocks
+        """
+        V_blocks = np.asarray(V_blocks, dtype="<i8").reshape(len(L_list), self.p)
+        gammas = np.asarray(gammas, dtype="<i8")
+        with self.lock:
+            for i in range(0, len(L_list), self.batch_size):
+                frame = L_list[i : i + self.batch_size]
+                self.__write(REQUEST.pack(OP_SET, len(frame)) + self.__keys(frame) + gammas[i : i + self.batch_size].tobytes() + V_blocks[i : i + self.batch_size].tobytes(), len(frame))
+
+
+    def multi_del(self, L_list):
+        """
+            function to delete several blocks in one round trip, sent together with the
+            writes still buffered
+            args:
+                L_list: labels of the deleted blocks
+            return:
+                number of blocks deleted
+        """
+        frames = [L_list[i : i + self.batch_size] for i in range(0, len(L_list), self.batch_size)]
+        deleted = 0
+        missing = False
+        with self.lock:
+            for frame in frames:
+                self.out += REQUEST.pack(OP_DEL, len(frame)) + self.__keys(frame)
+            self.__send()
+            self.__acks()
+            for frame in frames:
+                status, count = RESPONSE.unpack(recv_exact(self.rfile, RESPONSE.size))
+                deleted += count
+                missing |= status == STATUS_MISSING
+        if missing:
+            logger.warning("Wrong label, cannot delete cipherblock.")
+        return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve an untrusted L-V store over a socket")
+    parser.add_argument("--store", help="on-disk store written by diskstore.write_store, an empty in-memory store if not given")
+    parser.add_argument("--p", type=int, default=8, help="block size of an empty store")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7070)
+    parser.add_argument("--unix", help="Unix socket path, used instead of --host/--port")
+    args = parser.parse_args()
+
+    if args.store:
+        from diskstore import MappedStorage
+        Imm = MappedStorage(args.store)
+    else:
+        from untrusted import ColumnarStorage
+        Imm = ColumnarStorage(p=args.p)
+    server = StorageServer(Imm, args.unix or (args.host, args.port))
+    print("Serving untrusted storage on", server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        if args.store:
+            Imm.flush()
+
+
+if __name__ == "__main__":
+    main()
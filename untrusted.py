@@ -1,9 +1,41 @@
+import sys
+import base64
+import numpy as np
+from logs import get_logger
+
+
+logger = get_logger("storage")
+
+
+def label_key(L, label_width):
+    """
+        function to turn a label (base64 string or raw bytes) into a fixed-width key
+        args:
+            L: pseudo-label, as returned by PRF.encrypt or PRF.encrypt_raw
+            label_width: width of the key in bytes, the label is zero-padded to it
+    """
+    if isinstance(L, str):
+        L = base64.b64decode(L)
+    if len(L) > label_width:
+        raise ValueError("label of {} bytes does not fit in label_width={}".format(len(L), label_width))
+    return L.ljust(label_width, b"\0")
+
+
+def table_size(entries):
+    """
+        function to get the size of a hash index holding at least the given number of
+        entries: a power of two, since the index is probed with a bit mask
+    """
+    return 1 << max(int(entries) - 1, 1).bit_length()
 
 
 class UntrustedStorage(object):
     def __init__(self, LV_store):
         self.storage = LV_store
 
+    def __len__(self):
+        return len(self.storage)
+
     def get_block(self, L):
         """
             function to get ciphertext block from pseudo-label
@@ -11,14 +43,14 @@ class UntrustedStorage(object):
                 L: pseudo-label of the block
             return:
                 V: ciphertext block
-                gamma: the binary string to decrypt V
+                gamma: the integer to decrypt V
         """
         try:
             V = self.storage[L][0]
             gamma = self.storage[L][1]
             return V, gamma
         except KeyError:
-            print("Pseudo-label is not correct. Cannot access the cipher block!")
+            logger.warning("Pseudo-label is not correct. Cannot access the cipher block!")
 
 
     def set_block(self, L, V_new, gamma_new):
@@ -41,4 +73,361 @@ class UntrustedStorage(object):
         try:
             del self.storage[L]
         except KeyError:
-            print("Wrong label, cannot delete cipherblock.")
\ No newline at end of file
+            logger.warning("Wrong label, cannot delete cipherblock.")
+
+
+    def multi_get(self, L_list):
+        """
+            function to get the ciphertext blocks of several pseudo-labels at once
+            args:
+                L_list: pseudo-labels of the blocks
+            return:
+                list of (V, gamma), None for a label that is not stored
+        """
+        return [self.get_block(L) for L in L_list]
+
+
+    def multi_set(self, L_list, V_blocks, gammas):
+        """
+            function to set several ciphertext blocks at once
+            args:
+                L_list: pseudo-labels of the blocks
+                V_blocks: new blocks, a (len(L_list), p) array or a list of blocks
+                gammas: integer masks of the blocks
+        """
+        for L, V, gamma in zip(L_list, V_blocks, gammas):
+            self.storage[L] = (V, gamma)
+
+
+    def multi_del(self, L_list):
+        """
+            function to delete several blocks at once
+            args:
+                L_list: labels of the deleted blocks
+            return:
+                number of blocks deleted
+        """
+        deleted = 0
+        for L in L_list:
+            if L in self.storage:
+                del self.storage[L]
+                deleted += 1
+            else:
+                logger.warning("Wrong label, cannot delete cipherblock.")
+        return deleted
+
+
+    def nbytes(self):
+        """
+            function to get the memory footprint of the storage, counting every
+            label, tuple, block and gamma object rather than the dict alone
+        """
+        total = sys.getsizeof(self.storage)
+        for L, (V, gamma) in self.storage.items():
+            total += sys.getsizeof(L) + sys.getsizeof((V, gamma)) + sys.getsizeof(V) + sys.getsizeof(gamma)
+        return total
+
+
+
+    def to_arrays(self, p, label_width=48):
+        """
+            function to export the stored blocks as (labels, values, gammas) arrays
+            args:
+                p: block size
+                label_width: width of the exported label keys
+        """
+        n = len(self.storage)
+        labels = np.zeros((n, label_width), dtype=np.uint8)
+        values = np.zeros((n, p), dtype=np.int64)
+        gammas = np.zeros(n, dtype=np.int64)
+        for i, (L, (V, gamma)) in enumerate(self.storage.items()):
+            labels[i] = np.frombuffer(label_key(L, label_width), dtype=np.uint8)
+            values[i] = V
+            gammas[i] = gamma
+        return labels, values, gammas
+
+
+
+class ColumnarStorage(object):
+    """
+        memory-compact untrusted storage: labels are fixed-width bytes kept in an
+        open-addressing hash index (one int64 array of slot numbers), pointing at rows
+        of one contiguous (capacity, p) int64 array of blocks, with the gammas in a
+        parallel array. slots freed by del_block are reused.
+    """
+    EMPTY = -1                                      # hash index entry never used
+    DELETED = -2                                    # hash index entry of a deleted label
+
+    def __init__(self, p, label_width=48, capacity=1024):
+        self.p = p                                  # fixed block size
+        self.label_width = label_width              # labels are zero-padded to this many bytes
+        self.labels = np.zeros((capacity, label_width), dtype=np.uint8)
+        self.values = np.zeros((capacity, p), dtype=np.int64)
+        self.gammas = np.zeros(capacity, dtype=np.int64)
+        self.table = np.full(table_size(2 * capacity), self.EMPTY, dtype=np.int64)   # hash index of slots
+        self.count = 0                              # number of stored blocks
+        self.deleted = 0                            # number of DELETED entries in the hash index
+        self.size = 0                               # number of slots ever handed out
+        self.free_slots = []                        # slots released by del_block
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, L):
+        return self.__find(self.label_key(L))[1] >= 0
+
+
+    def label_key(self, L):
+        """
+            function to turn a label (base64 string or raw bytes) into its fixed-width key
+        """
+        return label_key(L, self.label_width)
+
+
+    def __find(self, key):
+        """
+            function to probe the hash index for a key
+            return:
+                pos: index entry holding the key, or the entry where it should be inserted
+                slot: slot of the key, or -1 if the key is not stored
+        """
+        mask = len(self.table) - 1
+        pos = hash(key) & mask
+        free_pos = -1
+        while True:
+            slot = int(self.table[pos])
+            if slot == self.EMPTY:
+                return (pos if free_pos < 0 else free_pos), -1
+            if slot == self.DELETED:
+                if free_pos < 0:
+                    free_pos = pos
+            elif self.labels[slot].tobytes() == key:
+                return pos, slot
+            pos = (pos + 1) & mask
+
+
+    def __rehash(self, entries):
+        """
+            function to rebuild the hash index (dropping DELETED entries) with a new size,
+            rounded up to a power of two
+        """
+        self.table = np.full(table_size(entries), self.EMPTY, dtype=np.int64)
+        self.deleted = 0
+        live = np.ones(self.size, dtype=bool)
+        live[self.free_slots] = False
+        self.__place(np.flatnonzero(live))
+
+
+    def __place(self, slots):
+        """
+            function to add the labels of new slots to the hash index, probing for all
+            of them at once: in each round, every slot whose entry is empty and that is
+            the first to claim it takes it, the others move to the next entry
+            args:
+                slots: int64 array of slots whose labels are not indexed yet
+        """
+        mask = len(self.table) - 1
+        w = self.label_width
+        keys = self.labels[slots].tobytes()
+        pos = np.fromiter((hash(keys[i : i + w]) for i in range(0, len(keys), w)), dtype=np.int64, count=len(slots)) & mask
+        while len(slots):
+            free = np.flatnonzero(self.table[pos] == self.EMPTY)
+            _, first = np.unique(pos[free], return_index=True)
+            placed = free[first]
+            self.table[pos[placed]] = slots[placed]
+            left = np.ones(len(slots), dtype=bool)
+            left[placed] = False
+            slots, pos = slots[left], (pos[left] + 1) & mask
+
+
+    def __grow(self, capacity=None):
+        """
+            function to grow the capacity of the block arrays, doubling it by default
+        """
+        capacity = max(capacity or 0, 2 * len(self.values), 1)
+        for name in ("labels", "values", "gammas"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: len(old)] = old
+            setattr(self, name, new)
+
+
+    def get_block(self, L):
+        """
+            function to get ciphertext block from pseudo-label
+            args: 
+                L: pseudo-label of the block
+            return:
+                V: ciphertext block (a copy, so that slot reuse cannot alter it)
+                gamma: the integer to decrypt V
+        """
+        slot = self.__find(self.label_key(L))[1]
+        if slot < 0:
+            logger.warning("Pseudo-label is not correct. Cannot access the cipher block!")
+            return None
+        return self.values[slot].copy(), int(self.gammas[slot])
+
+
+    def set_block(self, L, V_new, gamma_new):
+        """
+            function to set new value for a ciphertext block
+            args:
+                L: pseudo-label of the block
+                V_new: list of new values for the block
+                gamma_new: integer mask of the block
+        """
+        slot = self.__slot_for(self.label_key(L))
+        self.values[slot] = V_new
+        self.gammas[slot] = gamma_new
+
+
+    def __slot_for(self, key):
+        """
+            function to get the slot of a key, allocating one if the key is new
+        """
+        pos, slot = self.__find(key)
+        if slot < 0:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                if self.size == len(self.values):
+                    self.__grow()
+                slot = self.size
+                self.size += 1
+            if self.table[pos] == self.DELETED:
+                self.deleted -= 1
+            self.table[pos] = slot
+            self.labels[slot] = np.frombuffer(key, dtype=np.uint8)
+            self.count += 1
+            # keep the index at most half full, counting DELETED entries
+            if 2 * (self.count + self.deleted) > len(self.table):
+                self.__rehash(max(len(self.table), 1 << (4 * self.count).bit_length()))
+        return slot
+
+
+    def del_block(self, L):
+        """
+            function to delete a block from the storage using its label
+            args:
+                L: label of the deleted block
+        """
+        pos, slot = self.__find(self.label_key(L))
+        if slot < 0:
+            logger.warning("Wrong label, cannot delete cipherblock.")
+            return
+        self.table[pos] = self.DELETED
+        self.deleted += 1
+        self.count -= 1
+        self.free_slots.append(slot)
+
+
+    def multi_get(self, L_list):
+        """
+            function to get the ciphertext blocks of several pseudo-labels at once,
+            gathering all found rows with one fancy-indexed copy
+            args:
+                L_list: pseudo-labels of the blocks
+            return:
+                list of (V, gamma), None for a label that is not stored
+        """
+        slots = np.array([self.__find(self.label_key(L))[1] for L in L_list], dtype=np.int64)
+        found = slots >= 0
+        if not found.all():
+            logger.warning("Pseudo-label is not correct. Cannot access the cipher block!")
+        V_blocks = self.values[slots[found]]
+        gammas = self.gammas[slots[found]].tolist()
+        res = [None] * len(slots)
+        for i, V, gamma in zip(np.flatnonzero(found).tolist(), V_blocks, gammas):
+            res[i] = (V, gamma)
+        return res
+
+
+    def multi_set(self, L_list, V_blocks, gammas):
+        """
+            function to set several ciphertext blocks at once: slots are resolved per
+            label, then blocks and gammas are written with one scatter each
+            args:
+                L_list: pseudo-labels of the blocks
+                V_blocks: new blocks, a (len(L_list), p) array or a list of blocks
+                gammas: integer masks of the blocks
+        """
+        slots = np.empty(len(L_list), dtype=np.int64)
+        for i, L in enumerate(L_list):
+            slots[i] = self.__slot_for(self.label_key(L))
+        if len(slots):
+            self.values[slots] = V_blocks
+            self.gammas[slots] = gammas
+
+
+    def multi_del(self, L_list):
+        """
+            function to delete several blocks at once
+            args:
+                L_list: labels of the deleted blocks
+            return:
+                number of blocks deleted
+        """
+        count = self.count
+        for L in L_list:
+            self.del_block(L)
+        return count - self.count
+
+
+    def load_arrays(self, labels, values, gammas):
+        """
+            function to bulk-load blocks whose labels are not stored yet (e.g. a build):
+            each array is copied with one slice assignment and the hash index is filled
+            with one vectorized probe, instead of resolving a slot per label
+            args:
+                labels: (n, label_width) uint8 array of zero-padded raw labels, as
+                        returned by to_arrays
+                values: (n, p) int64 array of blocks
+                gammas: (n,) int64 array of masks
+            note:
+                a label that is already stored would be indexed twice; use multi_set
+                to overwrite blocks
+        """
+        n = len(labels)
+        if not n:
+            return
+        if self.size + n > len(self.values):
+            self.__grow(self.size + n)
+        self.labels[self.size : self.size + n] = labels
+        self.values[self.size : self.size + n] = values
+        self.gammas[self.size : self.size + n] = gammas
+        slots = np.arange(self.size, self.size + n, dtype=np.int64)
+        self.size += n
+        self.count += n
+        if 2 * (self.count + self.deleted) > len(self.table):
+            self.__rehash(max(len(self.table), 1 << (4 * self.count).bit_length()))
+        else:
+            self.__place(slots)
+
+
+    def nbytes(self):
+        """
+            function to get the memory footprint of the storage: the block, gamma,
+            label and hash index arrays plus the free-slot list
+        """
+        total = self.values.nbytes + self.gammas.nbytes + self.labels.nbytes + self.table.nbytes
+        total += sys.getsizeof(self.free_slots) + 28 * len(self.free_slots)
+        return total
+
+
+    def to_arrays(self, p=None, label_width=None):
+        """
+            function to export the stored blocks as (labels, values, gammas) arrays
+            args:
+                p, label_width: optional, checked against the storage layout
+            return:
+                labels: (n, label_width) uint8 array of label keys
+                values: (n, p) int64 array of blocks
+                gammas: (n,) int64 array of masks
+        """
+        if (p is not None and p != self.p) or (label_width is not None and label_width != self.label_width):
+            raise ValueError("storage layout is p={}, label_width={}".format(self.p, self.label_width))
+        live = np.ones(self.size, dtype=bool)
+        live[self.free_slots] = False
+        return self.labels[: self.size][live], self.values[: self.size][live], self.gammas[: self.size][live]
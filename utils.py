@@ -1,15 +1,79 @@
-import random
+import os
+import hashlib
+import secrets
+import numpy as np
+from Crypto.Cipher import AES
 
 
-def random_binary_string(str_len):
+def session_msg(s, client_id=None):
     """
-        function to create a random binary string with varying length for XOR encoding
+        function to get the PRF input of the session key k0 of query session s
         args:
-            str_len: length of the desired binary string
+            s: session number
+            client_id: id of the client owning the session counter; None for the
+                       single shared counter, whose input is str(s) alone
+    """
+    if client_id is None:
+        return str(s)
+    return str(client_id) + "|" + str(s)
+
+
+def random_gamma(gamma_len, rng=None):
+    """
+        function to create one random integer mask for XOR encoding
+        args:
+            gamma_len: number of bits of the mask (at most 63)
+            rng: optional GammaDRBG, the operating system CSPRNG is used if None
+        return:
+            a random int in [0, 2**gamma_len)
+    """
+    if rng is not None:
+        return int(rng.gammas(1, gamma_len)[0])
+    return secrets.randbits(gamma_len)
+
+
+def random_gammas(n, gamma_len, rng=None):
+    """
+        function to create many random integer masks for XOR encoding in one call
+        args:
+            n: number of masks
+            gamma_len: number of bits of each mask (at most 63)
+            rng: optional GammaDRBG, the operating system CSPRNG is used if None
         return:
-            a random binary string with length = str_len
+            int64 array of n masks in [0, 2**gamma_len)
     """
-    s = ""
-    for _ in range(str_len):
-        s += str(random.randint(0, 1))
-    return s
\ No newline at end of file
+    if rng is not None:
+        return rng.gammas(n, gamma_len)
+    return bytes_to_gammas(os.urandom(n * gamma_bytes(gamma_len)), n, gamma_len)
+
+
+def gamma_bytes(gamma_len):
+    if not 0 < gamma_len <= 63:
+        raise ValueError("gamma_len must be between 1 and 63 bits, got {}".format(gamma_len))
+    return (gamma_len + 7) // 8
+
+
+def bytes_to_gammas(raw, n, gamma_len):
+    """
+        function to turn n * gamma_bytes(gamma_len) random bytes into n masks of gamma_len bits
+    """
+    width = gamma_bytes(gamma_len)
+    buf = np.zeros((n, 8), dtype=np.uint8)
+    buf[:, :width] = np.frombuffer(raw, dtype=np.uint8).reshape(n, width)
+    return (buf.view("<u8").ravel() & np.uint64((1 << gamma_len) - 1)).astype(np.int64)
+
+
+class GammaDRBG(object):
+    """
+        seeded AES-CTR deterministic random bit generator for masks, for reproducible
+        builds and benchmarks; the keystream is cut into gamma_bytes-wide masks
+    """
+    def __init__(self, seed):
+        if isinstance(seed, str):
+            seed = seed.encode()
+        key = hashlib.sha256(seed).digest()
+        self.cipher = AES.new(key, AES.MODE_CTR, nonce=b"")
+
+    def gammas(self, n, gamma_len):
+        raw = self.cipher.encrypt(bytes(n * gamma_bytes(gamma_len)))
+        return bytes_to_gammas(raw, n, gamma_len)
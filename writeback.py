@@ -0,0 +1,164 @@
+import time
+import threading
+from collections import OrderedDict
+from logs import get_logger
+
+
+logger = get_logger("writeback")
+
+
+class WriteBackWorker(object):
+    """
+        background thread that re-encrypts evicted partkeys and writes them back to the
+        untrusted storage, so that evictions do not run on the query path
+        a job holds the cached (V, gamma) blocks of a partkey and the t its new labels
+        use; node.t is bumped when the job is queued, so later reads already look for
+        the new labels. a query that misses on a queued partkey reclaims the blocks
+        (the job is cancelled), or waits for the job if it is already being written.
+        a job whose write fails (storage error, remote disconnect) goes back to the front
+        of the queue, where queries can still reclaim it, and is retried after a delay
+        that doubles up to max_retry_delay; drain and stop raise the error meanwhile.
+    """
+    def __init__(self, enclave, Imm, retry_delay=0.5, max_retry_delay=30.0):
+        self.enclave = enclave
+        self.Imm = Imm
+        self.G1 = enclave.prf(enclave.k1)          # own PRF, not shared with the query thread
+        self.lock = enclave.imm_lock                # guards the untrusted storage
+        self.cond = threading.Condition()           # guards the queue and job states
+        self.queue = OrderedDict()                  # storage of (partkey, job) waiting to be written
+        self.running = None                         # partkey being written, if any
+        self.completed = 0                          # jobs written back
+        self.reclaimed = 0                          # jobs cancelled by a query
+        self.total_lag = 0.0                        # sum of enqueue-to-written times
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.failures = 0                           # failed writes, each retried
+        self.error = None                           # exception of the last write, None once one succeeds
+        self.retry_delay = retry_delay              # seconds before the first retry of a failed job
+        self.max_retry_delay = max_retry_delay
+        self.stopped = False
+        self.thread = threading.Thread(target=self.__run, name="hybridx-writeback", daemon=True)
+        self.thread.start()
+
+
+    def submit(self, partkey, t, blocks):
+        """
+            function to queue the blocks of an evicted partkey for write-back
+            args:
+                partkey: evicted key
+                t: counter to label the blocks with, already stored in the node
+                blocks: list of (V, gamma), in block order
+        """
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError("write-back worker is stopped")
+            if partkey in self.queue or partkey == self.running:
+                raise RuntimeError("partkey {} is already queued for write-back".format(partkey))
+            self.queue[partkey] = (t, blocks, time.time())
+            self.cond.notify_all()
+
+
+    def reclaim(self, partkey):
+        """
+            function to take back the blocks of a partkey that is queued for write-back
+            return:
+                the (V, gamma) blocks if the job had not started (it is cancelled), or None
+                if the partkey is not queued; a job being written is waited for first
+        """
+        with self.cond:
+            while self.running == partkey:
+                self.cond.wait()
+            job = self.queue.pop(partkey, None)
+            if job is None:
+                return None
+            self.reclaimed += 1
+            self.cond.notify_all()
+            return job[1]
+
+
+    def __run(self):
+        delay = self.retry_delay
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                partkey, job = self.queue.popitem(last=False)
+                self.running = partkey
+            t, blocks, enqueued_at = job
+            try:
+                self.enclave.write_back(partkey, t, blocks, self.Imm, self.G1)
+            except Exception as e:
+                logger.warning("write-back failed: %s: %s", type(e).__name__, e, extra={"fields": {"partkey": partkey, "retry_in": delay}})
+                with self.cond:
+                    # put the job back first in line, the blocks exist nowhere else
+                    self.queue[partkey] = job
+                    self.queue.move_to_end(partkey, last=False)
+                    self.running = None
+                    self.failures += 1
+                    self.error = e
+                    self.cond.notify_all()
+                    self.cond.wait_for(lambda: self.stopped or partkey not in self.queue, timeout=delay)
+                delay = min(2 * delay, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+            with self.cond:
+                lag = time.time() - enqueued_at
+                self.running = None
+                self.error = None
+                self.completed += 1
+                self.total_lag += lag
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self.cond.notify_all()
+
+
+    def drain(self):
+        """
+            function to block until every queued partkey is written back
+            raises:
+                the error of the last write if it failed; the failed job stays queued
+                and is retried
+        """
+        with self.cond:
+            while self.queue or self.running is not None:
+                if self.error is not None:
+                    raise self.error
+                self.cond.wait()
+
+
+    def stop(self):
+        """
+            function to drain the queue and stop the thread
+            raises:
+                the error of a failed write: a job waiting for its retry is retried at
+                once, and if it fails again the worker is not stopped and keeps
+                retrying, since the queued blocks exist nowhere else
+        """
+        with self.cond:
+            self.stopped = True
+            self.error = None
+            self.cond.notify_all()
+            while (self.queue or self.running is not None) and self.error is None:
+                self.cond.wait()
+            if self.queue or self.running is not None:
+                self.stopped = False
+                raise self.error
+        self.thread.join()
+
+
+    def metrics(self):
+        """
+            function to get the write-back counters
+        """
+        with self.cond:
+            return {
+                "queue_depth": len(self.queue) + int(self.running is not None),
+                "completed": self.completed,
+                "reclaimed": self.reclaimed,
+                "mean_lag": self.total_lag / self.completed if self.completed else 0.0,
+                "max_lag": self.max_lag,
+                "last_lag": self.last_lag,
+                "failures": self.failures,
+            }